@@ -6,6 +6,7 @@ Generated by 'django-admin startproject' using Django 5.2.9.
 from pathlib import Path
 import os
 import dj_database_url
+from botocore.config import Config
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -71,13 +72,18 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'config.wsgi.application'
+# Под ASGI_SERVER=1 — config.asgi.application
 
 # Database
 # Uses Supabase (PostgreSQL) on Render/Local via .env (DATABASE_URL)
+# ASGI_SERVER=1 — сервис запущен воркерами uvicorn (см. gunicorn.conf.py). Под ASGI каждый запрос ходит в базу
+# из своего потока, и постоянные соединения не переиспользуются, а копятся до conn_max_age: закрываем их сразу
+# (пул соединений — на стороне Supabase, pgbouncer)
+ASGI_SERVER = os.environ.get('ASGI_SERVER') == '1'
 DATABASES = {
     'default': dj_database_url.config(
         default='sqlite:///' + str(BASE_DIR / 'db.sqlite3'),
-        conn_max_age=600
+        conn_max_age=0 if ASGI_SERVER else 600
     )
 }
 
@@ -127,6 +133,17 @@ if AWS_S3_CUSTOM_DOMAIN:
 else:
     MEDIA_URL = '/media/'
 
+# Клиент S3: пул соединений на поток хранилища (core/storage.py), keep-alive и повторы при сбоях Supabase.
+# CERTIFICATE_STORAGE_THREADS — общий пул потоков загрузки/удаления файлов сертификатов
+CERTIFICATE_STORAGE_THREADS = int(os.environ.get('CERTIFICATE_STORAGE_THREADS', 8))
+AWS_S3_CLIENT_CONFIG = Config(
+    max_pool_connections=CERTIFICATE_STORAGE_THREADS,
+    retries={'max_attempts': 3, 'mode': 'standard'},
+    connect_timeout=5,
+    read_timeout=30,
+    tcp_keepalive=True,
+)
+
 # Единая настройка хранилищ
 STORAGES = {
     "staticfiles": {
@@ -137,4 +154,79 @@ STORAGES = {
     },
 }
 
-DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
\ No newline at end of file
+DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+# --- ГЕНЕРАЦИЯ СЕРТИФИКАТОВ ---
+# Рендер в фоне: рядом с веб-сервисом должен работать `python manage.py run_generation_worker`.
+# CERTIFICATE_ASYNC_GENERATION=0 возвращает синхронную генерацию прямо в Certificate.save
+CERTIFICATE_ASYNC_GENERATION = os.environ.get('CERTIFICATE_ASYNC_GENERATION', '1') == '1'
+
+# CERTIFICATE_LAZY_ARTIFACTS=1: при сохранении рендерится только PDF для клиента, а печатный PDF и превью —
+# при первом запросе (/certificates/<id>/<print|web|preview>/), после чего отдаются из хранилища
+CERTIFICATE_LAZY_ARTIFACTS = os.environ.get('CERTIFICATE_LAZY_ARTIFACTS', '0') == '1'
+
+# Массовая перегенерация (админка без очереди, manage.py regenerate_certificates):
+# процессов рендера (по умолчанию — число ядер) и потоков загрузки в хранилище
+CERTIFICATE_BULK_WORKERS = int(os.environ.get('CERTIFICATE_BULK_WORKERS', 0)) or None
+CERTIFICATE_UPLOAD_THREADS = int(os.environ.get('CERTIFICATE_UPLOAD_THREADS', 8))
+
+# PDF по реестрам: 'raster' — страница целиком картинкой 300 DPI,
+# 'vector' — шаблон картинкой + текст со встроенными шрифтами (manage.py compare_pdf_backends)
+CERTIFICATE_PDF_BACKENDS = {
+    'CSE': os.environ.get('CERTIFICATE_PDF_BACKEND_CSE', 'raster'),
+    'NIKA': os.environ.get('CERTIFICATE_PDF_BACKEND_NIKA', 'raster'),
+}
+
+# --- КЭШ ПУБЛИЧНОГО РЕЕСТРА ---
+# REGISTRY_CACHE: locmem (по умолчанию; у каждого процесса свой, сброс по сигналам виден только в нём, поэтому
+# записи и версия реестра для ETag живут REGISTRY_CACHE_TIMEOUT секунд — столько веб-воркер может не видеть
+# сертификаты, отрендеренные run_generation_worker), file или db — общий для всех воркеров и для
+# run_generation_worker, изменения видны сразу.
+# Для db таблицу создаёт `manage.py createcachetable` (есть в build.sh)
+REGISTRY_CACHE = os.environ.get('REGISTRY_CACHE', 'locmem')
+_REGISTRY_CACHE_BACKENDS = {
+    'locmem': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'registry'},
+    'file': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+             'LOCATION': os.environ.get('REGISTRY_CACHE_DIR', '/tmp/registry_cache')},
+    'db': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'registry_cache'},
+}
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'registry': {
+        **_REGISTRY_CACHE_BACKENDS[REGISTRY_CACHE],
+        'TIMEOUT': int(os.environ.get('REGISTRY_CACHE_TIMEOUT', 300)),
+        # Новый деплой (новый шаблон страницы) начинает с чистого кэша и новых ETag
+        'KEY_PREFIX': os.environ.get('RENDER_GIT_COMMIT', '')[:12],
+    },
+}
+
+# --- МЕТРИКИ И ПРОФИЛИРОВАНИЕ ---
+# Время этапов генерации, хранилища и поиска: строкой в лог (logger core.metrics) и гистограммами на /metrics.
+# Каждый процесс считает своё; чтобы /metrics суммировал все воркеры gunicorn, задайте общий каталог
+# CERTIFICATE_METRICS_DIR. /metrics отдаётся по METRICS_TOKEN (Authorization: Bearer <токен>) для сборщика,
+# а без токена — только персоналу, вошедшему в админку
+CERTIFICATE_METRICS_DIR = os.environ.get('CERTIFICATE_METRICS_DIR') or None
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# Рендер дольше этого пишется в лог предупреждением; остальные — INFO (в DEBUG не выводятся, METRICS_LOG_LEVEL)
+CERTIFICATE_SLOW_SECONDS = float(os.environ.get('CERTIFICATE_SLOW_SECONDS', 2.0))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        # Ошибки рендера с трейсбеком (core.utils)
+        'core': {'handlers': ['console'], 'level': 'WARNING'},
+        'core.metrics': {'handlers': ['console'], 'propagate': False,
+                         'level': os.environ.get('METRICS_LOG_LEVEL', 'WARNING' if DEBUG else 'INFO')},
+    },
+}
+
+# --- API ПРОВЕРКИ СЕРТИФИКАТОВ (/api/<cse|nika>/verify/) ---
+# Не больше API_MAX_BATCH номеров и УНП за запрос и API_RATE_LIMIT запросов за API_RATE_WINDOW секунд с адреса
+# (0 — без лимита). API_PROXY_COUNT — сколько прокси перед приложением дописывают X-Forwarded-For (на Render — 1)
+API_MAX_BATCH = int(os.environ.get('API_MAX_BATCH', 100))
+API_RATE_LIMIT = int(os.environ.get('API_RATE_LIMIT', 60))
+API_RATE_WINDOW = int(os.environ.get('API_RATE_WINDOW', 60))
+API_PROXY_COUNT = int(os.environ.get('API_PROXY_COUNT', 0 if DEBUG else 1))
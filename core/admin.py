@@ -1,10 +1,25 @@
+import logging
+from django.conf import settings
 from django.contrib import admin
+from django.core.exceptions import ValidationError
 from django.utils.html import format_html
 from django.db import models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
 from django.forms import Textarea
 from django.contrib import messages
-from .models import Seminar, Certificate
-from django.urls import reverse
+from django.shortcuts import get_object_or_404, redirect
+from django.template.response import TemplateResponse
+from . import bulk
+from .export import export_response
+from .forms import ParticipantImportForm
+from .importer import import_participants, parse_names, read_names, validate_names
+from .jobs import enqueue_many
+from .models import Seminar, Certificate, GenerationJob
+from django.urls import path, reverse
+
+logger = logging.getLogger(__name__)
+
 
 def get_company_badge(company_code, company_label):
     colors = {'CSE': '#b40000', 'NIKA': '#004099'}
@@ -15,53 +30,67 @@ def get_company_badge(company_code, company_label):
     )
 
 
-@admin.action(description="⚡ Перегенерировать документы (PDF/JPG)")
-def regenerate_certificates(modeladmin, request, queryset):
-    count = 0
-    for cert in queryset:
-        if cert.manual_upload and cert.manual_upload.name:
-            continue
+def get_status_badge(status, status_label):
+    colors = {'pending': '#b58900', 'running': '#268bd2', 'done': '#2e7d32', 'failed': '#b40000'}
+    return format_html('<span style="color: {}; font-weight: bold;">{}</span>', colors.get(status, 'gray'),
+                       status_label)
+
+
+# В ленивом режиме печатного PDF может ещё не быть: ссылка ведёт на отрисовку по запросу
+def get_print_url(obj):
+    if obj.file_print:
+        return obj.file_print.url
+    if obj.file_web and not obj.manual_upload:
+        return reverse('certificate_file', args=[obj.pk, 'print'])
+    return None
+
+
+def run_regeneration(modeladmin, request, certificates):
+    if getattr(settings, 'CERTIFICATE_ASYNC_GENERATION', True):
+        count = enqueue_many(certificates)
+        modeladmin.message_user(request, f"Поставлено в очередь на генерацию: {count}", messages.SUCCESS)
+        return count
 
-        if cert.file_print: cert.file_print.delete(save=False)
-        if cert.file_web: cert.file_web.delete(save=False)
-        if cert.preview_image: cert.preview_image.delete(save=False)
+    done, failed = bulk.regenerate(certificates)
+    if failed:
+        modeladmin.message_user(request, f"Не удалось сгенерировать: {failed}", messages.ERROR)
+    modeladmin.message_user(request, f"Успешно обновлено сертификатов: {done}", messages.SUCCESS)
+    return done
 
-        cert.file_print = None
-        cert.file_web = None
-        cert.preview_image = None
 
-        cert.save()
-        count += 1
-    modeladmin.message_user(request, f"Успешно обновлено сертификатов: {count}", messages.SUCCESS)
+@admin.action(description="⚡ Перегенерировать документы (PDF/JPG)")
+def regenerate_certificates(modeladmin, request, queryset):
+    run_regeneration(modeladmin, request, bulk.generated_only(queryset))
 
 
 @admin.action(description="⚡ Обновить сертификаты всех участников")
 def regenerate_seminar_certificates(modeladmin, request, queryset):
-    total = 0
-    for seminar in queryset:
-        certs = seminar.certificates.all()
-        for cert in certs:
-            if cert.manual_upload and cert.manual_upload.name:
-                continue
-
-            if cert.file_print: cert.file_print.delete(save=False)
-            if cert.file_web: cert.file_web.delete(save=False)
-            if cert.preview_image: cert.preview_image.delete(save=False)
-
-            cert.file_print = None
-            cert.file_web = None
-            cert.preview_image = None
-            cert.save()
-            total += 1
-    modeladmin.message_user(request, f"Семинаров обработано: {queryset.count()}. Сертификатов обновлено: {total}",
-                            messages.SUCCESS)
+    run_regeneration(modeladmin, request, bulk.generated_only(Certificate.objects.filter(seminar__in=queryset)))
+    modeladmin.message_user(request, f"Семинаров обработано: {queryset.count()}", messages.SUCCESS)
+
+
+def run_export(modeladmin, request, seminars, kind):
+    response = export_response(seminars, kind, 'certificates')
+    if response is None:
+        modeladmin.message_user(request, "У выбранных семинаров нет готовых файлов", messages.WARNING)
+    return response
+
+
+@admin.action(description="📦 Скачать ZIP со всеми PDF")
+def export_zip(modeladmin, request, queryset):
+    return run_export(modeladmin, request, queryset, 'zip')
+
+
+@admin.action(description="🖨 Скачать общий PDF для печати")
+def export_print_pdf(modeladmin, request, queryset):
+    return run_export(modeladmin, request, queryset, 'pdf')
 
 
 class CertificateInline(admin.TabularInline):
     model = Certificate
     extra = 0
-    fields = ('full_name', 'certificate_number', 'manual_upload', 'link_files')
-    readonly_fields = ('certificate_number','link_files')
+    fields = ('full_name', 'certificate_number', 'manual_upload', 'display_status', 'link_files')
+    readonly_fields = ('certificate_number', 'display_status', 'link_files')
     can_delete = True
     show_change_link = True
     verbose_name = "Участник"
@@ -69,8 +98,9 @@ class CertificateInline(admin.TabularInline):
 
     def link_files(self, obj):
         links = []
-        if obj.file_print:
-            links.append(f'<a href="{obj.file_print.url}" target="_blank" style="color:white;">📄 PDF(чистый) </a>')
+        print_url = get_print_url(obj)
+        if print_url:
+            links.append(f'<a href="{print_url}" target="_blank" style="color:white;">📄 PDF(чистый) </a>')
         if obj.file_web:
             links.append(
                 f'<a href="{obj.file_web.url}" target="_blank" style="color:green; font-weight:bold;">📥 PDF(c печатью) </a>')
@@ -80,6 +110,12 @@ class CertificateInline(admin.TabularInline):
 
     link_files.short_description = "Скачать"
 
+    def display_status(self, obj):
+        if not obj.pk: return "-"
+        return get_status_badge(obj.render_status, obj.get_render_status_display())
+
+    display_status.short_description = "Генерация"
+
 
 @admin.register(Seminar)
 class SeminarAdmin(admin.ModelAdmin):
@@ -93,7 +129,7 @@ class SeminarAdmin(admin.ModelAdmin):
     list_filter = ('company', 'date_start')
 
     inlines = [CertificateInline]
-    actions = [regenerate_seminar_certificates]
+    actions = [regenerate_seminar_certificates, export_zip, export_print_pdf]
 
     formfield_overrides = {
         models.CharField: {'widget': Textarea(attrs={'rows': 2, 'cols': 90, 'style': 'resize:vertical;'})},
@@ -111,22 +147,87 @@ class SeminarAdmin(admin.ModelAdmin):
 
     display_title.short_description = "Название семинара"
 
+    def get_queryset(self, request):
+        # Подзапрос, а не Count по join: COUNT(*) пагинатора тогда идёт по одной таблице без GROUP BY
+        participants = (Certificate.objects.filter(seminar=OuterRef('pk')).order_by()
+                        .values('seminar').annotate(count=Count('pk')).values('count'))
+        return super().get_queryset(request).annotate(
+            participant_count=Coalesce(Subquery(participants), Value(0)))
+
     def display_count(self, obj):
-        count = obj.certificates.count()
-        return format_html(f'<b>{count}</b> чел.')
+        return format_html('<b>{}</b> чел.', obj.participant_count)
 
     display_count.short_description = "Участников"
+    display_count.admin_order_field = 'participant_count'
+
+    def get_urls(self):
+        urls = [
+            path('<int:object_id>/import/', self.admin_site.admin_view(self.import_view),
+                 name='core_seminar_import'),
+            path('<int:object_id>/export/<str:kind>/', self.admin_site.admin_view(self.export_view),
+                 name='core_seminar_export'),
+        ]
+        return urls + super().get_urls()
+
+    def import_view(self, request, object_id):
+        seminar = get_object_or_404(Seminar, pk=object_id)
+        if not self.has_change_permission(request, seminar):
+            return redirect('admin:core_seminar_changelist')
+
+        form = ParticipantImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            names = parse_names(form.cleaned_data['names'])
+            if form.cleaned_data['file']:
+                try:
+                    names += read_names(form.cleaned_data['file'])
+                except ValidationError as e:
+                    form.add_error('file', e)
+                except Exception:
+                    logger.exception("Import Error: seminar %s", seminar.pk)
+                    form.add_error('file', "Не удалось прочитать файл.")
+
+            if form.is_valid():
+                try:
+                    validate_names(names)
+                except ValidationError as e:
+                    form.add_error(None, e)
+            if form.is_valid():
+                created = import_participants(seminar, names)
+                self.message_user(request, f"Добавлено участников: {len(created)}", messages.SUCCESS)
+                return redirect('admin:core_seminar_change', seminar.pk)
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': "Импорт участников",
+            'opts': self.model._meta,
+            'original': seminar,
+            'form': form,
+        }
+        return TemplateResponse(request, 'admin/core/seminar/import_participants.html', context)
+
+    def export_view(self, request, object_id, kind):
+        seminar = get_object_or_404(Seminar, pk=object_id)
+        if kind not in ('zip', 'pdf') or not self.has_view_permission(request, seminar):
+            return redirect('admin:core_seminar_changelist')
+
+        response = export_response(Seminar.objects.filter(pk=seminar.pk), kind,
+                                   f"{seminar.organization_name[:60]} {seminar.date_start:%d.%m.%Y}")
+        if response is None:
+            self.message_user(request, "У семинара нет готовых файлов", messages.WARNING)
+            return redirect('admin:core_seminar_change', seminar.pk)
+        return response
 
 
 @admin.register(Certificate)
 class CertificateAdmin(admin.ModelAdmin):
     list_display = ('display_date', 'display_company', 'display_org', 'display_unp', 'display_seminar', 'full_name',
-                    'certificate_number','link_print', 'link_web')
+                    'certificate_number', 'display_status', 'link_print', 'link_web')
     list_display_links = ('full_name',)
+    list_select_related = ('seminar',)
 
     search_fields = ('full_name', 'certificate_number', 'seminar__title', 'seminar__organization_name',
                      'seminar__registration_number')
-    list_filter = ('seminar__company', 'seminar__date_start')
+    list_filter = ('seminar__company', 'seminar__date_start', 'render_status')
 
     actions = [regenerate_certificates]
 
@@ -139,14 +240,23 @@ class CertificateAdmin(admin.ModelAdmin):
             'description': 'Загрузите сюда PDF, чтобы отключить авто-генерацию для этого человека.'
         }),
         ("Файлы системы (Только чтение)", {
-            'fields': ('preview_image', 'file_print', 'file_web'),
+            'fields': ('render_status', 'template_version', 'preview_image', 'thumbnail', 'thumbnail_jpeg',
+                       'file_print', 'file_web'),
         }),
     )
-    readonly_fields = ('certificate_number', 'file_print', 'file_web', 'preview_image', 'seminar')
+    readonly_fields = ('certificate_number', 'render_status', 'template_version', 'file_print', 'file_web',
+                       'preview_image', 'thumbnail', 'thumbnail_jpeg', 'seminar')
 
     def has_add_permission(self, request):
         return False
 
+    def changelist_view(self, request, extra_context=None):
+        in_queue = Certificate.objects.filter(
+            render_status__in=[Certificate.STATUS_PENDING, Certificate.STATUS_RUNNING]).count()
+        if in_queue:
+            self.message_user(request, f"В очереди на генерацию: {in_queue}", messages.INFO)
+        return super().changelist_view(request, extra_context)
+
     def display_date(self, obj):
         return obj.seminar.date_start
 
@@ -181,8 +291,9 @@ class CertificateAdmin(admin.ModelAdmin):
     display_seminar.admin_order_field = 'seminar__title'
 
     def link_print(self, obj):
-        if obj.file_print:
-            return format_html('<a href="{}" target="_blank" style="color:white;">📄 Чистый</a>', obj.file_print.url)
+        print_url = get_print_url(obj)
+        if print_url:
+            return format_html('<a href="{}" target="_blank" style="color:white;">📄 Чистый</a>', print_url)
         return "—"
 
     link_print.short_description = "Без печати"
@@ -195,3 +306,29 @@ class CertificateAdmin(admin.ModelAdmin):
         return "—"
 
     link_web.short_description = "С печатью"
+
+    def display_status(self, obj):
+        return get_status_badge(obj.render_status, obj.get_render_status_display())
+
+    display_status.short_description = "Генерация"
+    display_status.admin_order_field = 'render_status'
+
+
+@admin.register(GenerationJob)
+class GenerationJobAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'certificate', 'display_status', 'attempts', 'started_at', 'finished_at')
+    list_filter = ('status',)
+    list_select_related = ('certificate',)
+    readonly_fields = ('certificate', 'status', 'attempts', 'error', 'created_at', 'started_at', 'finished_at')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def display_status(self, obj):
+        return get_status_badge(obj.status, obj.get_status_display())
+
+    display_status.short_description = "Статус"
+    display_status.admin_order_field = 'status'
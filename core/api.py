@@ -0,0 +1,147 @@
+import hashlib
+import time
+from functools import wraps
+from django.conf import settings
+from django.db.models import Count
+from django.http import Http404, JsonResponse
+from django.views.decorators.http import require_GET
+from . import metrics
+from .cache import aregistry_version, get_registry_cache, registry_condition
+from .models import Seminar, Certificate
+from .search import NUMBER_PREFIXES
+from .utils import normalize_code, normalize_number
+
+COMPANIES = {code.lower(): code for code, _ in Seminar.COMPANY_CHOICES}
+
+
+def api_company(company):
+    code = COMPANIES.get(company)
+    if not code:
+        raise Http404
+    return code
+
+
+def error(message, status):
+    return JsonResponse({'error': message}, status=status, json_dumps_params={'ensure_ascii': False})
+
+
+# Номера и УНП из ?number=...&unp=... без повторов, в написании клиента: оно же ключ в ответе
+def lookup_values(request):
+    def values(name):
+        return list(dict.fromkeys(value.strip() for value in request.GET.getlist(name) if value.strip()))
+    return values('number'), values('unp')
+
+
+def client_ip(request):
+    # За прокси (Render) REMOTE_ADDR — адрес прокси. Клиент — API_PROXY_COUNT-й адрес с конца X-Forwarded-For:
+    # всё левее него клиент мог дописать сам
+    proxies = getattr(settings, 'API_PROXY_COUNT', 0)
+    forwarded = [ip.strip() for ip in request.headers.get('X-Forwarded-For', '').split(',') if ip.strip()]
+    if proxies and len(forwarded) >= proxies:
+        return forwarded[-proxies]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+# Фиксированное окно: не больше API_RATE_LIMIT запросов за API_RATE_WINDOW секунд с одного адреса.
+# Счётчики лежат в кэше реестра, поэтому с общим бэкендом (file, db) лимит общий для всех воркеров
+def rate_limited(view):
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        limit = getattr(settings, 'API_RATE_LIMIT', 0)
+        if limit:
+            window = getattr(settings, 'API_RATE_WINDOW', 60)
+            now = int(time.time())
+            key = f"api:rate:{client_ip(request)}:{now // window}"
+            cache = get_registry_cache()
+            await cache.aadd(key, 0, window)
+            try:
+                count = await cache.aincr(key)
+            except ValueError:
+                # Окно истекло между add и incr
+                count = 1
+            if count > limit:
+                response = error("Слишком много запросов", 429)
+                response['Retry-After'] = str(window - now % window)
+                return response
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+# Часть ETag и ключа кэша: набор значений без учёта порядка и повторов
+def lookup_digest(request, company):
+    numbers, unps = lookup_values(request)
+    return hashlib.md5(repr((company, sorted(numbers), sorted(unps))).encode()).hexdigest()
+
+
+def certificate_record(request, cert):
+    seminar = cert.seminar
+    return {
+        'number': cert.certificate_number,
+        'full_name': cert.full_name,
+        'organization': seminar.organization_name,
+        'unp': seminar.registration_number,
+        'seminar': seminar.title,
+        'date_start': seminar.date_start.isoformat(),
+        'date_end': seminar.date_end.isoformat() if seminar.date_end else None,
+        'file_web': request.build_absolute_uri(cert.file_web.url) if cert.file_web else None,
+    }
+
+
+# Один запрос на все номера пачки: точное совпадение по certificate_number_rev (индекс).
+# Номер не уникален между семинарами с одной датой окончания, поэтому на номер — список
+async def verify_numbers(request, company, numbers):
+    keys = {number: normalize_number(number, NUMBER_PREFIXES[company])[::-1] for number in numbers}
+    wanted = {key for key in keys.values() if key}
+    found = {}
+    certificates = (Certificate.objects.filter(seminar__company=company, certificate_number_rev__in=wanted)
+                    .select_related('seminar').order_by('seminar__date_start', 'order_number'))
+    async for cert in certificates:
+        found.setdefault(cert.certificate_number_rev, []).append(certificate_record(request, cert))
+    return {number: found.get(key, []) for number, key in keys.items()}
+
+
+# Один запрос на все УНП пачки: семинары организации с числом выданных сертификатов
+async def verify_unps(company, unps):
+    keys = {unp: normalize_code(unp) for unp in unps}
+    found = {}
+    seminars = (Seminar.objects.filter(company=company, registration_number_search__in=set(keys.values()))
+                .annotate(certificates_count=Count('certificates')).order_by('date_start', 'pk'))
+    async for seminar in seminars:
+        found.setdefault(seminar.registration_number_search, []).append({
+            'organization': seminar.organization_name,
+            'unp': seminar.registration_number,
+            'seminar': seminar.title,
+            'date_start': seminar.date_start.isoformat(),
+            'date_end': seminar.date_end.isoformat() if seminar.date_end else None,
+            'certificates': seminar.certificates_count,
+        })
+    return {unp: found.get(key, []) for unp, key in keys.items()}
+
+
+# GET /api/<cse|nika>/verify/?number=...&number=...&unp=... — проверка номеров сертификатов и УНП пачкой.
+# Ответ кэшируется до следующего изменения реестра и отдаётся с ETag/Last-Modified; база и кэш — без блокировки
+# цикла событий под ASGI
+@rate_limited
+@require_GET
+@registry_condition(lambda request, company: api_company(company), lookup_digest)
+async def verify(request, company):
+    code = api_company(company)
+    numbers, unps = lookup_values(request)
+    if not numbers and not unps:
+        return error("Укажите параметры number и/или unp", 400)
+    max_batch = getattr(settings, 'API_MAX_BATCH', 100)
+    if len(numbers) + len(unps) > max_batch:
+        return error(f"Не больше {max_batch} значений за запрос", 400)
+
+    cache = get_registry_cache()
+    key = f"api:verify:{code}:{await aregistry_version(code)}:{lookup_digest(request, code)}"
+    payload = await cache.aget(key)
+    if payload is None:
+        with metrics.timed('api_verify', code):
+            payload = {'company': code}
+            if numbers:
+                payload['numbers'] = await verify_numbers(request, code, numbers)
+            if unps:
+                payload['unps'] = await verify_unps(code, unps)
+        await cache.aset(key, payload)
+    return JsonResponse(payload, json_dumps_params={'ensure_ascii': False})
@@ -0,0 +1,230 @@
+import ctypes
+import ctypes.util
+import datetime
+import gc
+import json
+import os
+import statistics
+import threading
+import time
+import tracemalloc
+from io import BytesIO
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from . import layout
+from .models import Seminar, Certificate
+from .utils import (generate_certificates, get_style, load_template, pdf_previews, normalize_text, normalize_code,
+                    encode_previews)
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+
+SHORT_NAME = "Иванов Иван"
+LONG_NAME = "Константинопольский Александр Вениаминович-Оглы"
+SHORT_TITLE = "Экспортный контроль"
+LONG_TITLE = "Экспортный контроль, санкционные ограничения и порядок оформления внешнеэкономических сделок в 2025 году"
+SHORT_PROGRAM = "1. Введение\n2. Практика"
+LONG_PROGRAM = '\n'.join(
+    f"{i}. Порядок оформления экспортных документов, таможенные процедуры и валютный контроль при поставках "
+    f"продукции двойного назначения" for i in range(1, 11))
+
+
+def sample_certificate(company, long=False):
+    # Несохранённые объекты: рендеру база не нужна
+    seminar = Seminar(company=company, organization_name="ООО «Бенчмарк»", registration_number="100000000",
+                      title=LONG_TITLE if long else SHORT_TITLE, program=LONG_PROGRAM if long else SHORT_PROGRAM,
+                      date_start=datetime.date(2025, 3, 1), date_end=datetime.date(2025, 3, 3))
+    return Certificate(seminar=seminar, full_name=LONG_NAME if long else SHORT_NAME, order_number=1,
+                       certificate_number="№ 01-03032025")
+
+
+def build_registry(seminars, participants):
+    # Синтетический реестр: семинары поровну по реестрам, номера и поисковые колонки как у Certificate.save
+    companies = [code for code, _ in Seminar.COMPANY_CHOICES]
+    objects = []
+    for i in range(seminars):
+        seminar = Seminar(company=companies[i % len(companies)], organization_name=f"ООО Клиент {i}",
+                          registration_number=f"19{i:07d}", title=f"Семинар {i}", program=SHORT_PROGRAM,
+                          date_start=datetime.date(2020, 1, 1) + datetime.timedelta(days=i % 2000))
+        seminar.organization_name_search = normalize_text(seminar.organization_name)
+        seminar.registration_number_search = normalize_code(seminar.registration_number)
+        objects.append(seminar)
+    Seminar.objects.bulk_create(objects, batch_size=500)
+
+    certificates = []
+    for seminar in Seminar.objects.order_by('pk'):
+        for order in range(1, participants + 1):
+            cert = Certificate(seminar=seminar, full_name=f"Участник {seminar.pk}-{order}", order_number=order,
+                               file_web=f"certificates/web/web_{seminar.pk}_{order}.pdf",
+                               preview_image=f"certificates/previews/preview_{seminar.pk}_{order}.jpg")
+            cert.certificate_number = Certificate.make_certificate_number(seminar, order)
+            cert.fill_search_fields()
+            certificates.append(cert)
+    Certificate.objects.bulk_create(certificates, batch_size=500)
+
+
+class Case:
+    # setup() выполняется вне замера и возвращает аргумент для run()
+    def __init__(self, name, run, setup=None, group='render'):
+        self.name = name
+        self.run = run
+        self.setup = setup or (lambda: None)
+        self.group = group
+
+
+def release_free_memory():
+    # glibc держит освобождённую кучу у процесса; без этого пик RSS следующего случая был бы занижен
+    gc.collect()
+    try:
+        ctypes.CDLL(ctypes.util.find_library('c')).malloc_trim(0)
+    except (OSError, AttributeError, TypeError):
+        pass
+
+
+class PeakRSS:
+    # Пик резидентной памяти процесса за время замера (Linux, /proc). Картинки Pillow выделяются
+    # мимо аллокатора Python и tracemalloc их не видит
+    INTERVAL = 0.002
+
+    def __init__(self):
+        self.peak = self.start = self.read()
+        self.stop = threading.Event()
+
+    @staticmethod
+    def read():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return 0
+
+    def poll(self):
+        while not self.stop.is_set():
+            self.peak = max(self.peak, self.read())
+            time.sleep(self.INTERVAL)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.poll, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.read())
+
+    @property
+    def delta_kb(self):
+        return (self.peak - self.start) // 1024
+
+
+def measure(case, repeat):
+    case.run(case.setup())  # прогрев кэшей процесса
+
+    times = []
+    for _ in range(repeat):
+        state = case.setup()
+        gc.collect()
+        started = time.perf_counter()
+        case.run(state)
+        times.append(time.perf_counter() - started)
+
+    # Память и запросы — отдельным прогоном: tracemalloc заметно замедляет код
+    state = case.setup()
+    release_free_memory()
+    tracemalloc.start()
+    with CaptureQueriesContext(connection) as queries, PeakRSS() as rss:
+        case.run(state)
+    _, py_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'median_ms': round(statistics.median(times) * 1000, 2),
+        'min_ms': round(min(times) * 1000, 2),
+        'py_peak_kb': py_peak // 1024,
+        'rss_peak_kb': rss.delta_kb,
+        'queries': len(queries),
+    }
+
+
+def render_cases():
+    cases = []
+    for company, _ in Seminar.COMPANY_CHOICES:
+        for long in (False, True):
+            cert = sample_certificate(company, long)
+            cases.append(Case(f"generate_certificates[{company}-{'long' if long else 'short'}]",
+                              lambda _, cert=cert: generate_certificates(cert, backend='raster')))
+
+    font = layout.get_font(get_style('CSE')['font_sec'], 40)
+
+    def cold_measure_caches():
+        layout.measure.cache_clear()
+        layout.advance.cache_clear()
+
+    cases.append(Case("wrap_text[program, cold]",
+                      lambda _: [layout.wrap_text(line, font, 2200) for line in LONG_PROGRAM.split('\n')],
+                      setup=cold_measure_caches))
+
+    template = load_template(get_style('CSE')['tpl_stamp'])
+    cases.append(Case("encode[pdf 300dpi]", lambda _: template.save(BytesIO(), format='PDF', resolution=300.0)))
+
+    cases.append(Case("encode[preview + thumbnails]", lambda _: encode_previews(template)))
+
+    web_pdf = generate_certificates(sample_certificate('CSE'), fields=('file_web',))[1].read()
+    cases.append(Case("pdf_previews", lambda pdf: pdf_previews(pdf), setup=lambda: ContentFile(web_pdf, 'web.pdf')))
+    return cases
+
+
+def search_cases(seminars):
+    client = Client()
+    registry = caches['registry']
+    # Чётные семинары — CSE (см. build_registry)
+    org_query = f"ООО Клиент {seminars // 4 * 2}"
+    # Номер из NIKA ищем в англоязычной записи "No", как это делают клиенты
+    cse_number = (Certificate.objects.filter(seminar__company='CSE').values_list('certificate_number', flat=True)
+                  .first() or '')
+    nika_number = (Certificate.objects.filter(seminar__company='NIKA').values_list('certificate_number', flat=True)
+                   .first() or '').replace('№', 'No')
+
+    def get(path, query):
+        response = client.get(path, {'q': query})
+        assert response.status_code == 200, response.status_code
+
+    return [
+        Case("cse_search[organization]", lambda _: get('/cse/', org_query), setup=registry.clear, group='search'),
+        Case("cse_search[number]", lambda _: get('/cse/', cse_number), setup=registry.clear, group='search'),
+        Case("nika_search[number]", lambda _: get('/nika/', nika_number), setup=registry.clear, group='search'),
+        Case("cse_search[cached]", lambda _: get('/cse/', org_query), group='search'),
+    ]
+
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path): return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(results, meta, path=BASELINE_PATH):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'meta': meta, 'results': results}, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+# Регрессии относительно базовой линии: время и память — с допуском, число запросов — точно.
+# Меньше запросов — тоже расхождение: базовую линию надо обновить, иначе следующий рост его съест
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base: continue
+        if result['queries'] != base['queries']:
+            regressions.append(f"{name}: запросов {result['queries']} вместо {base['queries']}")
+        if result['median_ms'] > base['median_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: {result['median_ms']} мс > {base['median_ms']} мс")
+        for key in ('py_peak_kb', 'rss_peak_kb'):
+            # Мелкие пики шумят сильнее допуска, поэтому сравниваем только от 1 МБ
+            if result[key] > max(base[key], 1024) * (1 + tolerance):
+                regressions.append(f"{name}: {key} {result[key]} > {base[key]}")
+    return regressions
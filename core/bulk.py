@@ -0,0 +1,165 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import get_all_start_methods, get_context
+from django.conf import settings
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from . import storage
+from .cache import invalidate_registry
+from .models import Certificate, GenerationJob
+from .utils import (generate_certificates, init_render_process, eager_fields, encode_thumbnails, encoded_file,
+                    ARTIFACT_FIELD_NAMES)
+
+logger = logging.getLogger(__name__)
+
+FILE_FIELDS = ARTIFACT_FIELD_NAMES
+
+
+def get_bulk_workers():
+    return getattr(settings, 'CERTIFICATE_BULK_WORKERS', None) or os.cpu_count() or 1
+
+
+def generated_only(certificates):
+    # Сертификаты с ручной загрузкой не перегенерируются
+    return certificates.filter(Q(manual_upload__isnull=True) | Q(manual_upload=''))
+
+
+def render_files(certificate, fields):
+    # Выполняется в дочернем процессе, поэтому наружу отдаём простые байты, а не ContentFile.
+    # Набор полей приходит от родителя: настройки дочернего процесса могут отличаться (override_settings)
+    return [(f.name, f.read()) if f else None for f in generate_certificates(certificate, fields=fields)]
+
+
+def store_files(certificate, rendered):
+    rendered = [(field, result) for field, result in zip(FILE_FIELDS, rendered) if field in eager_fields()]
+    if not all(result for _, result in rendered): return False
+
+    storage.save_files(certificate, [(field, ContentFile(data, name)) for field, (name, data) in rendered])
+    certificate.finish_render()
+    return True
+
+
+def _render_pool(workers):
+    # Рендер упирается в CPU и GIL, поэтому процессы. Не fork: regenerate зовут и из веб-воркера (админка, импорт,
+    # правка семинара без очереди), где уже работают потоки storage.executor() — форк с живыми потоками может
+    # зависнуть на чужой блокировке, а потомку достался бы пул с мёртвыми потоками. forkserver порождает процессы
+    # из чистого сервера. Без него (не Unix) остаёмся в одном процессе
+    if workers <= 1 or 'forkserver' not in get_all_start_methods():
+        return ThreadPoolExecutor(max_workers=1)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=get_context('forkserver'),
+                               initializer=init_render_process)
+
+
+# force — рендерить и загружать заново даже при наличии файлов с тем же ключом (испорченный объект в хранилище)
+def regenerate(certificates, workers=None, upload_threads=None, force=False):
+    certs = list(generated_only(certificates).select_related('seminar').order_by('seminar_id', 'order_number'))
+    if not certs: return 0, 0
+
+    workers = workers or get_bulk_workers()
+    upload_threads = upload_threads or getattr(settings, 'CERTIFICATE_UPLOAD_THREADS', 8)
+    old_names = {cert.pk: [getattr(cert, field).name for field in FILE_FIELDS] for cert in certs}
+    old_keys = {cert.pk: (cert.render_key, cert.template_version) for cert in certs}
+    failed = []
+
+    # Сертификаты, чьи файлы с тем же ключом рендера уже в хранилище, не рендерятся и не загружаются.
+    # Проверка существования — сетевой запрос к S3, поэтому в общем пуле хранилища; совпадению имён в полях
+    # не доверяем: перегенерация должна чинить пропавшие объекты
+    if force:
+        reused = [False] * len(certs)
+    else:
+        reused = list(storage.executor().map(lambda cert: cert.reuse_stored_files(verify=True), certs))
+    done = [cert for cert, ok in zip(certs, reused) if ok]
+    to_render = [cert for cert, ok in zip(certs, reused) if not ok]
+
+    # Потоки uploader только раздают файлы в общий пул хранилища (storage.executor) и ждут их
+    with ThreadPoolExecutor(max_workers=upload_threads) as uploader, _render_pool(workers) as renderer:
+        # Участники одного семинара идут подряд, чтобы процессы попадали в кэш слоя семинара
+        render_futures = {renderer.submit(render_files, cert, eager_fields()): cert for cert in to_render}
+        upload_futures = {}
+        for future in as_completed(render_futures):
+            cert = render_futures[future]
+            try:
+                upload_futures[uploader.submit(store_files, cert, future.result())] = cert
+            except Exception:
+                # Ошибка из процесса пула приходит с его трейсбеком (_RemoteTraceback в __cause__)
+                logger.exception("Bulk Render Error: certificate %s", cert.pk)
+                failed.append(cert)
+
+        for future in as_completed(upload_futures):
+            cert = upload_futures[future]
+            try:
+                ok = future.result()
+            except Exception:
+                logger.exception("Bulk Upload Error: certificate %s", cert.pk)
+                ok = False
+            (done if ok else failed).append(cert)
+
+    changed = [cert for cert in done if cert.render_status != Certificate.STATUS_DONE
+               or (cert.render_key, cert.template_version) != old_keys[cert.pk]
+               or [getattr(cert, field).name for field in FILE_FIELDS] != old_names[cert.pk]]
+    for cert in changed:
+        Certificate.objects.filter(pk=cert.pk).update(
+            **{field: getattr(cert, field) for field in FILE_FIELDS},
+            render_key=cert.render_key,
+            template_version=cert.template_version,
+            render_status=Certificate.STATUS_DONE,
+        )
+    Certificate.objects.filter(pk__in=[cert.pk for cert in failed]).update(render_status=Certificate.STATUS_FAILED)
+    GenerationJob.objects.filter(certificate__in=[cert.pk for cert in done],
+                                 status=GenerationJob.STATUS_PENDING).delete()
+    invalidate_registry(*{cert.seminar.company for cert in changed})
+
+    # Старые версии удаляются, только когда база уже ссылается на новые
+    Certificate.delete_unreferenced_files(name for names in old_names.values() for name in names)
+    return len(done), len(failed)
+
+
+def missing_thumbnails(certificates):
+    return (certificates.exclude(Q(preview_image__isnull=True) | Q(preview_image=''))
+            .filter(Q(thumbnail__isnull=True) | Q(thumbnail='') | Q(thumbnail_jpeg__isnull=True) | Q(thumbnail_jpeg='')))
+
+
+# Миниатюры из уже сохранённого превью, без рендера листа. Имена — по имени превью:
+# preview_<номер>_<ключ>.jpg -> thumb_<номер>_<ключ>.webp/.jpg, как их назвал бы рендер с тем же ключом
+def make_thumbnails(certificate):
+    base = os.path.splitext(os.path.basename(certificate.preview_image.name))[0].removeprefix('preview_')
+    names = [certificate._meta.get_field(field).generate_filename(certificate, f"thumb_{base}.{ext}")
+             for field, ext in (('thumbnail', 'webp'), ('thumbnail_jpeg', 'jpg'))]
+    if not all(default_storage.exists(name) for name in names):
+        with default_storage.open(certificate.preview_image.name, 'rb') as f:
+            preview = Image.open(f).convert('RGB')
+        names = [default_storage.save(name, encoded_file(buf, name))
+                 for name, buf in zip(names, encode_thumbnails(preview))]
+    certificate.thumbnail.name, certificate.thumbnail_jpeg.name = names
+
+
+def _make_thumbnails(certificate):
+    try:
+        make_thumbnails(certificate)
+        return True
+    except Exception:
+        logger.exception("Thumbnail Error: certificate %s", certificate.pk)
+        return False
+
+
+# Досоздаёт миниатюры сертификатам, у которых есть превью (manage.py backfill_thumbnails).
+# Скачивание, уменьшение и загрузка идут в общем пуле хранилища, пачками по batch_size
+def backfill_thumbnails(certificates, batch_size=500):
+    ids = list(missing_thumbnails(certificates).order_by('pk').values_list('pk', flat=True))
+    done, failed, companies = 0, 0, set()
+    for i in range(0, len(ids), batch_size):
+        certs = list(Certificate.objects.filter(pk__in=ids[i:i + batch_size]).select_related('seminar'))
+        for cert, ok in zip(certs, storage.executor().map(_make_thumbnails, certs)):
+            # Превью могли перерисовать, пока считались миниатюры: тогда их сделает рендер
+            ok = ok and Certificate.objects.filter(pk=cert.pk, preview_image=cert.preview_image.name).update(
+                thumbnail=cert.thumbnail, thumbnail_jpeg=cert.thumbnail_jpeg)
+            if ok:
+                done += 1
+                companies.add(cert.seminar.company)
+            else:
+                failed += 1
+    invalidate_registry(*companies)
+    return done, failed
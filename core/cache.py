@@ -0,0 +1,94 @@
+import hashlib
+import time
+from functools import wraps
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from . import metrics
+from .search import normalize_query, asearch_results
+
+REGISTRY_CACHE = 'registry'
+
+
+def get_registry_cache():
+    return caches[REGISTRY_CACHE]
+
+
+def _version_key(company):
+    return f"registry:version:{company}"
+
+
+def _version_timeout(cache):
+    # locmem у каждого процесса свой: сброс из run_generation_worker или другого воркера сюда не доходит.
+    # Поэтому версия живёт столько же, сколько закэшированные поиски (TIMEOUT), и устаревшие ETag не вечны.
+    # Общий бэкенд (db, file) видит все сбросы — там версия хранится бессрочно
+    return DEFAULT_TIMEOUT if isinstance(cache, LocMemCache) else None
+
+
+# Версия реестра — момент последнего изменения (unix-время в наносекундах, строго растёт).
+# Входит в ключи кэша и в ETag, поэтому смена версии разом "выключает" все закэшированные поиски реестра.
+# Last-Modified — та же версия в секундах: несколько изменений за секунду не уводят его в будущее.
+# Читается из async-представлений: у кэша db синхронный доступ из цикла событий запрещён
+async def aregistry_version(company):
+    cache = get_registry_cache()
+    version = await cache.aget(_version_key(company))
+    if version is None:
+        await cache.aadd(_version_key(company), time.time_ns(), _version_timeout(cache))
+        version = await cache.aget(_version_key(company), time.time_ns())
+    return version
+
+
+def last_modified(version):
+    return version // 10 ** 9
+
+
+def invalidate_registry(*companies):
+    cache = get_registry_cache()
+    for company in dict.fromkeys(companies):
+        previous = cache.get(_version_key(company)) or 0
+        cache.set(_version_key(company), max(time.time_ns(), previous + 1), _version_timeout(cache))
+
+
+# Возвращает (семинары, есть ли ещё семинары сверх потолка выдачи)
+async def acached_search(company, query, number_prefixes=('№',)):
+    cache = get_registry_cache()
+    digest = hashlib.md5(repr(normalize_query(query, number_prefixes)).encode()).hexdigest()
+    # v2: в кэше лежит пара (семинары, обрезано ли)
+    key = f"registry:search:v2:{company}:{await aregistry_version(company)}:{digest}"
+
+    results = await cache.aget(key)
+    if results is None:
+        # Кэшируем уже вычисленные семинары вместе с участниками: повторный поиск не ходит в базу
+        with metrics.timed('search_query', company):
+            results = await asearch_results(company, query, number_prefixes)
+        await cache.aset(key, results)
+    return results
+
+
+# Условный GET (ETag/Last-Modified по версии реестра) для async-представлений. django condition() вызывает
+# etag_func синхронно прямо в цикле событий, а версия лежит в кэше, который может быть в базе.
+# company_func(request, **kwargs) — код реестра, etag_func(request, company) — часть ETag сверх версии
+def registry_condition(company_func, etag_func):
+    def decorator(view):
+        @wraps(view)
+        async def inner(request, *args, **kwargs):
+            company = company_func(request, *args, **kwargs)
+            version = await aregistry_version(company)
+            etag = quote_etag(f"{version}-{etag_func(request, company)}")
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified(version))
+            if response is None:
+                response = await view(request, *args, **kwargs)
+            if request.method in ('GET', 'HEAD'):
+                if not response.has_header('Last-Modified'):
+                    response['Last-Modified'] = http_date(last_modified(version))
+                if not response.has_header('ETag'):
+                    response['ETag'] = etag
+            return response
+        return inner
+    return decorator
+
+
+def query_etag(request, company):
+    return hashlib.md5(request.GET.get('q', '').encode()).hexdigest()
@@ -0,0 +1,155 @@
+import io
+import logging
+import os
+import tempfile
+import zipfile
+import fitz
+from django.core.files.storage import default_storage
+from django.http import StreamingHttpResponse
+from django.utils.http import content_disposition_header
+from django.utils.text import get_valid_filename
+from .models import Certificate
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# Сколько файлов вклеивается в общий PDF между инкрементальными сохранениями
+MERGE_BATCH = 10
+
+
+class StreamBuffer(io.RawIOBase):
+    # Незакрываемый буфер без seek: zipfile пишет в него с data descriptor, а мы забираем байты по мере записи
+    def __init__(self):
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts.clear()
+        return data
+
+
+def export_rows(seminars):
+    # Только имена файлов: сами файлы читаются из хранилища по одному во время отдачи
+    return list(Certificate.objects.filter(seminar__in=seminars)
+                .order_by('seminar__date_start', 'seminar_id', 'order_number')
+                .values_list('pk', 'seminar_id', 'seminar__organization_name', 'order_number', 'full_name',
+                             'file_print', 'file_web', 'manual_upload'))
+
+
+def seminar_folder(seminar_id, organization_name):
+    return get_valid_filename(f"{seminar_id} {organization_name}"[:80])
+
+
+# Файл выгрузки: (pk, поле, имя). Пустое имя — печатный PDF ещё не отрисован (ленивый режим),
+# его рисуют прямо во время отдачи
+def print_source(pk, file_print, file_web, manual):
+    if file_print or (file_web and not manual):
+        return pk, 'file_print', file_print
+    return None
+
+
+def resolve(pk, field, name):
+    return name or Certificate.ensure_file(pk, field)
+
+
+def zip_entries(rows):
+    entries = []
+    for pk, seminar_id, org, order, full_name, file_print, file_web, manual in rows:
+        prefix = f"{seminar_folder(seminar_id, org)}/{get_valid_filename(f'{order:02d} {full_name}')}"
+        source = print_source(pk, file_print, file_web, manual)
+        if source:
+            entries.append((f"{prefix} (print).pdf", source))
+        if file_web or manual:
+            entries.append((f"{prefix} (web).pdf", (pk, 'file_web', file_web or manual)))
+    return entries
+
+
+def print_files(rows):
+    # Для печати нужен чистый бланк; у ручных загрузок его нет, берём сам загруженный файл
+    files = []
+    for pk, *_, file_print, file_web, manual in rows:
+        source = print_source(pk, file_print, file_web, manual)
+        if source:
+            files.append(source)
+        elif manual:
+            files.append((pk, 'manual_upload', manual))
+    return files
+
+
+def stream_zip(entries):
+    buffer = StreamBuffer()
+    # PDF уже сжаты, поэтому ZIP_STORED: повторное сжатие только тратит CPU
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for arcname, source in entries:
+            try:
+                name = resolve(*source)
+                with default_storage.open(name, 'rb') as src, archive.open(arcname, 'w') as dest:
+                    for chunk in src.chunks(CHUNK_SIZE):
+                        dest.write(chunk)
+                        yield buffer.drain()
+            except Exception:
+                logger.exception("Export Error: certificate %s, %s", source[0], arcname)
+            yield buffer.drain()
+    yield buffer.drain()
+
+
+def stream_merged_pdf(sources):
+    # Общий PDF собирается во временном файле инкрементальными сохранениями: каждое только дописывает
+    # хвост файла, поэтому уже записанные байты можно сразу отдавать, а в памяти держится одна пачка
+    fd, path = tempfile.mkstemp(suffix='.pdf')
+    os.close(fd)
+    doc = fitz.open()
+    sent = 0
+    pending = 0
+    try:
+        for i, source in enumerate(sources):
+            try:
+                with default_storage.open(resolve(*source), 'rb') as src:
+                    with fitz.open(stream=src.read(), filetype='pdf') as part:
+                        doc.insert_pdf(part)
+                pending += 1
+            except Exception:
+                logger.exception("Export Error: certificate %s, %s", source[0], source[1])
+
+            if pending and (sent == 0 or pending >= MERGE_BATCH or i == len(sources) - 1):
+                if sent == 0:
+                    doc.save(path)
+                else:
+                    doc.saveIncr()
+                doc.close()
+                pending = 0
+
+                with open(path, 'rb') as f:
+                    f.seek(sent)
+                    while chunk := f.read(CHUNK_SIZE):
+                        sent += len(chunk)
+                        yield chunk
+                doc = fitz.open(path)
+    finally:
+        doc.close()
+        os.remove(path)
+
+
+def export_response(seminars, kind, filename):
+    rows = export_rows(seminars)
+    if kind == 'pdf':
+        sources = print_files(rows)
+        if not sources:
+            return None
+        response = StreamingHttpResponse(stream_merged_pdf(sources), content_type='application/pdf')
+        filename += '.pdf'
+    else:
+        entries = zip_entries(rows)
+        if not entries:
+            return None
+        response = StreamingHttpResponse(stream_zip(entries), content_type='application/zip')
+        filename += '.zip'
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
@@ -0,0 +1,17 @@
+from django import forms
+
+
+class ParticipantImportForm(forms.Form):
+    names = forms.CharField(
+        label="Список участников", required=False,
+        widget=forms.Textarea(attrs={'rows': 15, 'cols': 90, 'style': 'resize:vertical;'}),
+        help_text="Одно ФИО на строку.")
+    file = forms.FileField(
+        label="Файл", required=False,
+        help_text="CSV, XLSX или TXT: ФИО берутся из первой колонки.")
+
+    def clean(self):
+        cleaned = super().clean()
+        if not cleaned.get('names', '').strip() and not cleaned.get('file'):
+            raise forms.ValidationError("Вставьте список или выберите файл.")
+        return cleaned
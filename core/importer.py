@@ -0,0 +1,137 @@
+import codecs
+import csv
+import io
+import zipfile
+from xml.etree import ElementTree
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from . import bulk
+from .cache import invalidate_registry
+from .models import Certificate, GenerationJob
+
+# Файлы списков участников: из CSV и XLSX берётся первая колонка, из TXT — строки целиком
+NAME_FILE_EXTENSIONS = ('.txt', '.csv', '.xlsx')
+XLSX_NS = {'x': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+# Заголовки колонки ФИО в выгрузках (после приведения к нижнему регистру и без знаков препинания)
+HEADER_LABELS = {'фио', 'ф и о', 'фамилия имя отчество', 'фамилия и имя', 'участник', 'участники', 'слушатель',
+                 'слушатели', 'сотрудник', 'name', 'full name', 'fullname'}
+
+
+def parse_names(text):
+    # Одно ФИО на строку, лишние пробелы схлопываются, пустые строки пропускаются
+    return [' '.join(line.split()) for line in str(text).splitlines() if line.strip()]
+
+
+def decode_bytes(data):
+    # "Текст в Юникоде" из Excel — UTF-16 с BOM; прочие выгрузки из Excel под Windows часто приходят в cp1251
+    if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        text = data.decode('utf-16')
+    else:
+        try:
+            text = data.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            text = data.decode('cp1251')
+    # cp1251 "декодирует" любые байты: нулевые символы выдают двоичный файл (doc, xls, картинку)
+    if '\x00' in text:
+        raise ValidationError("Файл не похож на текстовый список.")
+    return text
+
+
+def read_csv(data):
+    text = decode_bytes(data)
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    return [row[0] for row in csv.reader(io.StringIO(text), dialect) if row]
+
+
+def read_xlsx(data):
+    # Берём колонку A первого листа; openpyxl ради одной колонки не тянем
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        shared = []
+        if 'xl/sharedStrings.xml' in archive.namelist():
+            root = ElementTree.fromstring(archive.read('xl/sharedStrings.xml'))
+            for item in root.findall('x:si', XLSX_NS):
+                shared.append(''.join(t.text or '' for t in item.iter(f"{{{XLSX_NS['x']}}}t")))
+        sheet = ElementTree.fromstring(archive.read('xl/worksheets/sheet1.xml'))
+
+    values = []
+    for cell in sheet.iter(f"{{{XLSX_NS['x']}}}c"):
+        if not cell.get('r', '').rstrip('0123456789') == 'A':
+            continue
+        if cell.get('t') == 'inlineStr':
+            values.append(''.join(t.text or '' for t in cell.iter(f"{{{XLSX_NS['x']}}}t")))
+            continue
+        value = cell.find('x:v', XLSX_NS)
+        if value is None or value.text is None:
+            continue
+        values.append(shared[int(value.text)] if cell.get('t') == 's' else value.text)
+    return values
+
+
+def is_header(value):
+    return ' '.join(''.join(c if c.isalnum() else ' ' for c in value.lower()).split()) in HEADER_LABELS
+
+
+def skip_header(rows):
+    # Строка заголовка таблицы — не участник: иначе она получит сертификат и займёт номер
+    rows = [row for row in rows if row.strip()]
+    return rows[1:] if rows and is_header(rows[0]) else rows
+
+
+def read_names(uploaded_file):
+    name = uploaded_file.name.lower()
+    if not name.endswith(NAME_FILE_EXTENSIONS):
+        raise ValidationError("Поддерживаются файлы CSV, XLSX и TXT.")
+    data = uploaded_file.read()
+    if name.endswith('.xlsx'):
+        try:
+            rows = read_xlsx(data)
+        except (zipfile.BadZipFile, KeyError, ElementTree.ParseError, ValueError, IndexError):
+            raise ValidationError("Не удалось прочитать файл XLSX.")
+        rows = skip_header(rows)
+    elif name.endswith('.csv'):
+        rows = skip_header(read_csv(data))
+    else:
+        rows = decode_bytes(data).splitlines()
+    return parse_names('\n'.join(rows))
+
+
+# ФИО длиннее поля Certificate.full_name не влезут в базу (на Postgres bulk_create упал бы с DataError)
+def validate_names(names):
+    max_length = Certificate._meta.get_field('full_name').max_length
+    too_long = [name for name in names if len(name) > max_length]
+    if too_long:
+        raise ValidationError(f"ФИО длиннее {max_length} символов: {too_long[0][:60]}… (всего строк: {len(too_long)})")
+
+
+def import_participants(seminar, names):
+    names = [name for name in names if name]
+    if not names:
+        return []
+    validate_names(names)
+
+    # Семинар блокируется один раз на весь список: номера идут сплошным блоком без гонок с админкой
+    with transaction.atomic():
+        start = Certificate.next_order_number(seminar)
+        certificates = []
+        for i, full_name in enumerate(names):
+            cert = Certificate(seminar=seminar, full_name=full_name, order_number=start + i,
+                               render_status=Certificate.STATUS_PENDING)
+            cert.certificate_number = Certificate.make_certificate_number(seminar, cert.order_number)
+            cert.fill_search_fields()
+            certificates.append(cert)
+        Certificate.objects.bulk_create(certificates)
+
+        async_generation = getattr(settings, 'CERTIFICATE_ASYNC_GENERATION', True)
+        if async_generation:
+            GenerationJob.objects.bulk_create([GenerationJob(certificate=cert) for cert in certificates])
+
+    # bulk_create не шлёт сигналов
+    invalidate_registry(seminar.company)
+
+    if not async_generation:
+        bulk.regenerate(Certificate.objects.filter(seminar=seminar, pk__in=[c.pk for c in certificates]))
+    return certificates
@@ -0,0 +1,105 @@
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from . import bulk
+from .cache import invalidate_registry
+from .models import Certificate, GenerationJob
+from .utils import ARTIFACT_FIELD_NAMES
+
+MAX_ATTEMPTS = 3
+
+
+def claim_next_job():
+    # skip_locked позволяет запускать несколько воркеров на Postgres; на SQLite блокировка игнорируется
+    with transaction.atomic():
+        job = (GenerationJob.objects.select_for_update(skip_locked=True)
+               .filter(status=GenerationJob.STATUS_PENDING)
+               .order_by('created_at')
+               .first())
+        if not job:
+            return None
+
+        job.status = GenerationJob.STATUS_RUNNING
+        job.attempts += 1
+        job.started_at = timezone.now()
+        job.save(update_fields=['status', 'attempts', 'started_at'])
+        Certificate.objects.filter(pk=job.certificate_id).update(render_status=Certificate.STATUS_RUNNING)
+    return job
+
+
+def run_job(job):
+    try:
+        cert = Certificate.objects.select_related('seminar').get(pk=job.certificate_id)
+    except Certificate.DoesNotExist:
+        # Сертификат удалили, пока задача ждала: вместе с ним каскадом ушла и задача
+        return None
+
+    old_names = [getattr(cert, field).name for field in ARTIFACT_FIELD_NAMES]
+    try:
+        # Задачу ставят и правки, и явная перегенерация: файлы с тем же ключом переиспользуются,
+        # только если они действительно есть в хранилище
+        ok = cert.generate_files(verify=True)
+        error = '' if ok else getattr(cert, 'render_error', '') or 'Генератор не вернул файлы'
+    except Exception:
+        ok = False
+        error = traceback.format_exc()
+
+    if ok:
+        status = GenerationJob.STATUS_DONE
+    elif job.attempts < MAX_ATTEMPTS:
+        status = GenerationJob.STATUS_PENDING
+    else:
+        status = GenerationJob.STATUS_FAILED
+
+    # update() вместо save(): save() снова поставил бы сертификат в очередь
+    Certificate.objects.filter(pk=cert.pk).update(
+        **{field: getattr(cert, field) for field in ARTIFACT_FIELD_NAMES},
+        render_key=cert.render_key,
+        template_version=cert.template_version,
+        render_status=status,
+    )
+    GenerationJob.objects.filter(pk=job.pk).update(
+        status=status,
+        error=error,
+        finished_at=timezone.now() if status != GenerationJob.STATUS_PENDING else None,
+    )
+
+    # update() не шлёт сигналов, а ссылки на файлы в публичной выдаче поменялись
+    invalidate_registry(cert.seminar.company)
+
+    # Старые файлы удаляем только когда новые уже сохранены и записаны в базу
+    if ok:
+        Certificate.delete_unreferenced_files(old_names)
+    return status
+
+
+def enqueue_many(certificates):
+    ids = list(certificates.values_list('pk', flat=True))
+    queued = set(GenerationJob.objects.filter(certificate_id__in=ids, status=GenerationJob.STATUS_PENDING)
+                 .values_list('certificate_id', flat=True))
+    GenerationJob.objects.bulk_create([GenerationJob(certificate_id=pk) for pk in ids if pk not in queued])
+    Certificate.objects.filter(pk__in=ids).update(render_status=Certificate.STATUS_PENDING)
+    return len(ids)
+
+
+def requeue_stale_jobs(minutes):
+    # Задачи упавшего воркера так и остались бы в статусе "running"
+    border = timezone.now() - timedelta(minutes=minutes)
+    stale = GenerationJob.objects.filter(status=GenerationJob.STATUS_RUNNING, started_at__lt=border)
+    Certificate.objects.filter(jobs__in=stale).update(render_status=Certificate.STATUS_PENDING)
+    return stale.update(status=GenerationJob.STATUS_PENDING)
+
+
+# Сертификаты, чьи файлы отрисованы не из текущих данных (ключ рендера не совпадает) или отсутствуют
+def stale_certificates(certificates):
+    certs = bulk.generated_only(certificates).select_related('seminar')
+    return [cert.pk for cert in certs.iterator(chunk_size=500) if cert.needs_generation() or cert.is_stale()]
+
+
+def schedule_generation(certificates):
+    if getattr(settings, 'CERTIFICATE_ASYNC_GENERATION', True):
+        return enqueue_many(certificates)
+    done, failed = bulk.regenerate(certificates)
+    return done
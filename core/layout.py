@@ -0,0 +1,131 @@
+from functools import lru_cache
+from PIL import ImageFont
+from django.conf import settings
+
+LINE_SPACING = 13
+PARAGRAPH_SPACING = 13
+
+# Шрифты живут весь процесс: autofit перебирает десятки размеров на каждый сертификат
+FONT_CACHE_SIZE = getattr(settings, 'CERTIFICATE_FONT_CACHE_SIZE', 256)
+MEASURE_CACHE_SIZE = getattr(settings, 'CERTIFICATE_MEASURE_CACHE_SIZE', 65536)
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def get_font(path, size):
+    try:
+        return ImageFont.truetype(path, size)
+    except:
+        return ImageFont.load_default()
+
+
+# Объекты шрифтов берутся из get_font и не пересоздаются, поэтому (font, text) — стабильный ключ
+@lru_cache(maxsize=MEASURE_CACHE_SIZE)
+def measure(font, text):
+    return font.getbbox(text)
+
+
+@lru_cache(maxsize=MEASURE_CACHE_SIZE)
+def advance(font, text):
+    return font.getlength(text)
+
+
+def text_width(font, text):
+    bbox = measure(font, text)
+    return bbox[2] - bbox[0]
+
+
+def text_height(font, text):
+    bbox = measure(font, text)
+    return bbox[3] - bbox[1]
+
+
+def wrap_text(text, font, max_width):
+    # Ширина строки оценивается суммой ширин слов. Точный textbbox нужен только когда
+    # оценка попадает в полосу около max_width (там решают отступы крайних глифов).
+    slack = getattr(font, 'size', 0) / 2
+    space_w = advance(font, ' ')
+
+    lines = []
+    current_line = []
+    current_w = 0
+    for word in text.split(' '):
+        word_w = advance(font, word)
+        estimate = current_w + (space_w if current_line else 0) + word_w
+
+        if estimate <= max_width - slack:
+            fits = True
+        elif estimate > max_width + slack:
+            fits = False
+        else:
+            fits = text_width(font, ' '.join(current_line + [word])) <= max_width
+
+        if fits:
+            current_line.append(word)
+            current_w = estimate
+        else:
+            if current_line:
+                lines.append(' '.join(current_line))
+                current_line = [word]
+                current_w = word_w
+            else:
+                lines.append(word)
+    if current_line:
+        lines.append(' '.join(current_line))
+    return lines
+
+
+def layout_block(paragraphs, font, max_width):
+    structure = []
+    total_h = 0
+    for para in paragraphs:
+        if not para.strip(): continue
+        lines = wrap_text(para, font, max_width)
+        structure.append(lines)
+        for line in lines:
+            total_h += text_height(font, line) + LINE_SPACING
+        total_h += PARAGRAPH_SPACING
+    if total_h > 0: total_h -= PARAGRAPH_SPACING
+    return structure, total_h
+
+
+def largest_fitting(sizes, attempt):
+    # sizes идут по убыванию, attempt(size) -> результат или None.
+    # Если влезает размер s, влезает и любой меньший, поэтому ищем бинарным поиском.
+    sizes = list(sizes)
+    lo, hi = 0, len(sizes)
+    found = None
+    while lo < hi:
+        mid = (lo + hi) // 2
+        result = attempt(sizes[mid])
+        if result is not None:
+            found = result
+            hi = mid
+        else:
+            lo = mid + 1
+    return found
+
+
+def fit_line(text, font_path, cfg):
+    def attempt(size):
+        font = get_font(font_path, size)
+        return font if text_width(font, text) <= cfg['max_width'] else None
+
+    font = largest_fitting(range(cfg['max_size'], cfg['min_size'] - 1, -2), attempt)
+    return font or get_font(font_path, cfg['min_size'])
+
+
+def fit_block(text, font_path, cfg):
+    paragraphs = str(text).replace('\r\n', '\n').split('\n')
+    max_h = cfg['y_end'] - cfg['y_start']
+
+    def attempt(size):
+        font = get_font(font_path, size)
+        structure, total_h = layout_block(paragraphs, font, cfg['max_width'])
+        return (font, structure, total_h) if total_h <= max_h else None
+
+    found = largest_fitting(range(cfg['max_size'], cfg['min_size'] - 1, -2), attempt)
+    if found: return found
+
+    font = get_font(font_path, cfg['min_size'])
+    structure, total_h = layout_block(paragraphs, font, cfg['max_width'])
+    return font, structure, total_h
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from core.bulk import backfill_thumbnails, missing_thumbnails
+from core.models import Certificate, Seminar
+
+
+class Command(BaseCommand):
+    help = ("Досоздаёт миниатюры выдачи поиска из уже сохранённых превью, без перерендера сертификатов. "
+            "Запускать после деплоя миниатюр, до reconcile_certificates: иначе тот перерендерит всех без миниатюр")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', choices=[code for code, _ in Seminar.COMPANY_CHOICES],
+                            help="Только один реестр")
+        parser.add_argument('--seminar', type=int, action='append', help="ID семинара (можно несколько)")
+        parser.add_argument('--batch-size', type=int, default=500, help="Сертификатов за проход")
+        parser.add_argument('--dry-run', action='store_true', help="Только посчитать, ничего не менять")
+
+    def handle(self, *args, **options):
+        certificates = Certificate.objects.all()
+        if options['company']:
+            certificates = certificates.filter(seminar__company=options['company'])
+        if options['seminar']:
+            certificates = certificates.filter(seminar_id__in=options['seminar'])
+
+        self.stdout.write(f"Без миниатюр: {missing_thumbnails(certificates).count()}")
+        if options['dry_run']:
+            return
+
+        done, failed = backfill_thumbnails(certificates, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Миниатюр создано: {done}, ошибок: {failed}"))
@@ -0,0 +1,38 @@
+import datetime
+import time
+from django.core.management.base import BaseCommand
+from core.models import Seminar, Certificate
+from core.utils import generate_certificates
+
+SAMPLE_PROGRAM = '\n'.join(
+    f"{i}. Порядок оформления экспортных документов, таможенные процедуры и валютный контроль" for i in range(1, 9))
+
+
+class Command(BaseCommand):
+    help = "Сравнивает растровый и векторный PDF: время генерации и размер файлов"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help="Сертификатов на каждый замер")
+
+    def handle(self, *args, **options):
+        runs = options['runs']
+        self.stdout.write(f"{'Реестр':<8}{'PDF':<8}{'сек/серт.':>10}{'print, КБ':>12}{'web, КБ':>12}")
+
+        for company, _ in Seminar.COMPANY_CHOICES:
+            # Объекты не сохраняются: база для замера не нужна
+            seminar = Seminar(company=company, organization_name="ООО «Бенчмарк»", registration_number="100000000",
+                              title="Экспортный контроль и санкционные ограничения", program=SAMPLE_PROGRAM,
+                              date_start=datetime.date(2025, 3, 1), date_end=datetime.date(2025, 3, 3))
+            certs = [Certificate(seminar=seminar, full_name=f"Участник Бенчмарка {i}", order_number=i,
+                                 certificate_number=f"№ {i:02d}-03032025") for i in range(1, runs + 1)]
+
+            for backend in ('raster', 'vector'):
+                generate_certificates(certs[0], backend=backend)  # прогрев кэшей
+
+                started = time.perf_counter()
+                results = [generate_certificates(cert, backend=backend) for cert in certs]
+                elapsed = (time.perf_counter() - started) / runs
+
+                print_kb = sum(r[0].size for r in results) / runs / 1024
+                web_kb = sum(r[1].size for r in results) / runs / 1024
+                self.stdout.write(f"{company:<8}{backend:<8}{elapsed:>10.3f}{print_kb:>12.0f}{web_kb:>12.0f}")
@@ -0,0 +1,56 @@
+import cProfile
+import io
+import pstats
+from django.core.management.base import BaseCommand, CommandError
+from core.benchmarks import sample_certificate
+from core.models import Seminar, Certificate
+from core.utils import ARTIFACT_FIELD_NAMES, generate_certificates, get_pdf_backend
+
+
+class Command(BaseCommand):
+    help = ("Профиль cProfile одного рендера сертификата (ничего не сохраняет): "
+            "топ функций в консоль и, при --output, файл .prof для snakeviz/pstats")
+
+    def add_arguments(self, parser):
+        parser.add_argument('certificate', nargs='?', type=int,
+                            help="ID сертификата; без него — синтетический участник")
+        parser.add_argument('--company', choices=[code for code, _ in Seminar.COMPANY_CHOICES], default='CSE',
+                            help="Реестр синтетического участника")
+        parser.add_argument('--long', action='store_true', help="Синтетический участник с длинными текстами")
+        parser.add_argument('--backend', choices=['raster', 'vector'], help="По умолчанию — как в настройках")
+        parser.add_argument('--field', action='append', choices=ARTIFACT_FIELD_NAMES,
+                            help="Рендерить только эти файлы (можно несколько)")
+        parser.add_argument('--cold', action='store_true',
+                            help="Без прогрева: в профиль попадут загрузка шаблонов и шрифтов")
+        parser.add_argument('--sort', default='cumulative', help="Сортировка pstats")
+        parser.add_argument('--limit', type=int, default=30, help="Сколько строк вывести")
+        parser.add_argument('--output', help="Сохранить сырые данные профиля в файл")
+
+    def handle(self, *args, **options):
+        if options['certificate']:
+            try:
+                cert = Certificate.objects.select_related('seminar').get(pk=options['certificate'])
+            except Certificate.DoesNotExist:
+                raise CommandError(f"Сертификат {options['certificate']} не найден")
+        else:
+            cert = sample_certificate(options['company'], options['long'])
+
+        backend = options['backend'] or get_pdf_backend(cert.seminar.company)
+        fields = tuple(options['field'] or ARTIFACT_FIELD_NAMES)
+        if not options['cold']:
+            generate_certificates(cert, backend=backend, fields=fields)
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        result = generate_certificates(cert, backend=backend, fields=fields)
+        profiler.disable()
+
+        if not any(result):
+            raise CommandError("Рендер не удался, см. Gen Error выше")
+        if options['output']:
+            profiler.dump_stats(options['output'])
+            self.stdout.write(f"Профиль сохранён: {options['output']}")
+
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats(options['sort']).print_stats(options['limit'])
+        self.stdout.write(out.getvalue())
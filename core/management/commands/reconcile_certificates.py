@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from core.bulk import generated_only
+from core.jobs import schedule_generation
+from core.models import Certificate, Seminar
+from core.styles import get_style
+from core.utils import compute_render_key
+
+
+class Command(BaseCommand):
+    help = ("Сверяет ключ рендера каждого сертификата с текущими данными семинара и участника "
+            "и перегенерирует только расходящиеся")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', choices=[code for code, _ in Seminar.COMPANY_CHOICES],
+                            help="Только один реестр")
+        parser.add_argument('--seminar', type=int, action='append', help="ID семинара (можно несколько)")
+        parser.add_argument('--dry-run', action='store_true', help="Только посчитать, ничего не менять")
+        parser.add_argument('--adopt-existing', action='store_true',
+                            help="Файлам без ключа (созданным до его появления) проставить текущий ключ "
+                                 "без перерендера")
+
+    def handle(self, *args, **options):
+        certificates = Certificate.objects.all()
+        if options['company']:
+            certificates = certificates.filter(seminar__company=options['company'])
+        if options['seminar']:
+            certificates = certificates.filter(seminar_id__in=options['seminar'])
+        certificates = generated_only(certificates).select_related('seminar')
+
+        current, adopted, stale = 0, [], []
+        for cert in certificates.iterator(chunk_size=500):
+            key = compute_render_key(cert)
+            version = get_style(cert.seminar.company).version
+            if cert.needs_generation():
+                stale.append(cert.pk)
+            elif cert.render_key == key and cert.template_version == version:
+                current += 1
+            elif cert.render_key == key or (not cert.render_key and options['adopt_existing']):
+                # Новая версия оформления рисует так же, как прежняя: достаточно записать её номер
+                adopted.append((cert.pk, key, version))
+            else:
+                stale.append(cert.pk)
+
+        self.stdout.write(f"Актуальны: {current}, ключ и версия оформления без перерендера: {len(adopted)}, "
+                          f"к перегенерации: {len(stale)}")
+        if options['dry_run']:
+            return
+
+        for pk, key, version in adopted:
+            Certificate.objects.filter(pk=pk).update(render_key=key, template_version=version)
+
+        if stale:
+            count = schedule_generation(Certificate.objects.filter(pk__in=stale))
+            self.stdout.write(self.style.SUCCESS(f"Отправлено на генерацию: {count}"))
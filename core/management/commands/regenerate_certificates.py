@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.bulk import regenerate, generated_only, get_bulk_workers
+from core.jobs import enqueue_many
+from core.models import Certificate, Seminar
+
+
+class Command(BaseCommand):
+    help = "Перегенерирует сертификаты реестра параллельно (например, после замены шаблона)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', choices=[code for code, _ in Seminar.COMPANY_CHOICES],
+                            help="Только один реестр")
+        parser.add_argument('--seminar', type=int, action='append', help="ID семинара (можно несколько)")
+        parser.add_argument('--year', type=int, help="Год начала семинара")
+        parser.add_argument('--workers', type=int, help="Число процессов рендера (по умолчанию — число ядер)")
+        parser.add_argument('--queue', action='store_true', help="Не рендерить сразу, а поставить в очередь воркера")
+        parser.add_argument('--force', action='store_true',
+                            help="Рендерить заново, даже если файлы с тем же ключом уже в хранилище (испорченные файлы)")
+
+    def handle(self, *args, **options):
+        certificates = Certificate.objects.all()
+        if options['company']:
+            certificates = certificates.filter(seminar__company=options['company'])
+        if options['seminar']:
+            certificates = certificates.filter(seminar_id__in=options['seminar'])
+        if options['year']:
+            certificates = certificates.filter(seminar__date_start__year=options['year'])
+        certificates = generated_only(certificates)
+
+        if options['queue'] and options['force']:
+            raise CommandError("--force работает только без --queue")
+        if options['queue']:
+            count = enqueue_many(certificates)
+            self.stdout.write(self.style.SUCCESS(f"Поставлено в очередь: {count}"))
+            return
+
+        workers = options['workers'] or get_bulk_workers()
+        self.stdout.write(f"Сертификатов: {certificates.count()}, процессов: {workers}")
+        done, failed = regenerate(certificates, workers=workers, force=options['force'])
+        self.stdout.write(self.style.SUCCESS(f"Обновлено: {done}, ошибок: {failed}"))
@@ -0,0 +1,75 @@
+import fnmatch
+import platform
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from core import benchmarks
+
+# Хранилище в памяти: замеры не должны ходить в S3 и зависеть от collectstatic
+BENCHMARK_STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.InMemoryStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+
+class Command(BaseCommand):
+    help = ("Замеры рендера сертификатов и публичного поиска: время, пик памяти, число запросов. "
+            "Поиск идёт по синтетическому реестру во временной тестовой базе (без DATABASE_URL — SQLite в памяти)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seminars', type=int, default=1000, help="Семинаров в синтетическом реестре")
+        parser.add_argument('--participants', type=int, default=10, help="Участников на семинар")
+        parser.add_argument('--repeat', type=int, default=5, help="Замеров на случай (берётся медиана)")
+        parser.add_argument('--only', help="Шаблон имён случаев, например 'generate_*'")
+        parser.add_argument('--baseline', default=benchmarks.BASELINE_PATH, help="Файл базовой линии")
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help="Допустимое ухудшение времени и памяти относительно базовой линии")
+        parser.add_argument('--save-baseline', action='store_true', help="Записать результаты как базовую линию")
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(STORAGES=BENCHMARK_STORAGES, CERTIFICATE_ASYNC_GENERATION=True):
+                results = self.run_cases(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        baseline = benchmarks.load_baseline(options['baseline'])
+        self.report(results, baseline.get('results', {}))
+
+        if options['save_baseline']:
+            meta = {'seminars': options['seminars'], 'participants': options['participants'],
+                    'repeat': options['repeat'], 'python': platform.python_version(), 'machine': platform.machine()}
+            benchmarks.save_baseline(results, meta, options['baseline'])
+            self.stdout.write(self.style.SUCCESS(f"Базовая линия записана: {options['baseline']}"))
+            return
+
+        regressions = benchmarks.compare(results, baseline.get('results', {}), options['tolerance'])
+        if regressions:
+            raise CommandError("Регрессии относительно базовой линии:\n" + '\n'.join(regressions))
+        if baseline:
+            self.stdout.write(self.style.SUCCESS("Регрессий нет"))
+
+    def run_cases(self, options):
+        self.stdout.write(f"Реестр: {options['seminars']} семинаров × {options['participants']} участников")
+        benchmarks.build_registry(options['seminars'], options['participants'])
+
+        cases = benchmarks.render_cases() + benchmarks.search_cases(options['seminars'])
+        if options['only']:
+            cases = [case for case in cases if fnmatch.fnmatch(case.name, options['only'])]
+
+        results = {}
+        for case in cases:
+            results[case.name] = benchmarks.measure(case, options['repeat'])
+        return results
+
+    def report(self, results, baseline):
+        self.stdout.write(f"{'Случай':<36}{'медиана, мс':>12}{'мин, мс':>10}{'Py, КБ':>10}{'RSS, КБ':>10}"
+                          f"{'запросов':>10}{'к базе':>10}")
+        for name, result in results.items():
+            base = baseline.get(name)
+            change = f"{result['median_ms'] / base['median_ms'] - 1:+.0%}" if base and base['median_ms'] else '—'
+            self.stdout.write(f"{name:<36}{result['median_ms']:>12.2f}{result['min_ms']:>10.2f}"
+                              f"{result['py_peak_kb']:>10}{result['rss_peak_kb']:>10}{result['queries']:>10}"
+                              f"{change:>10}")
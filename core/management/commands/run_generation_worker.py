@@ -0,0 +1,39 @@
+import time
+from django.core.management.base import BaseCommand
+from core.jobs import claim_next_job, run_job, requeue_stale_jobs
+from core.utils import warm_render_caches
+
+
+class Command(BaseCommand):
+    help = "Обрабатывает очередь генерации сертификатов (PDF/JPG)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Разобрать очередь и выйти")
+        parser.add_argument('--sleep', type=float, default=2.0, help="Пауза между опросами пустой очереди, сек")
+        parser.add_argument('--stale-minutes', type=int, default=15,
+                            help="Через сколько минут зависшая задача возвращается в очередь")
+
+    def handle(self, *args, **options):
+        warm_render_caches()
+
+        requeued = requeue_stale_jobs(options['stale_minutes'])
+        if requeued:
+            self.stdout.write(f"Возвращено в очередь зависших задач: {requeued}")
+
+        processed = 0
+        try:
+            while True:
+                job = claim_next_job()
+                if not job:
+                    if options['once']:
+                        break
+                    time.sleep(options['sleep'])
+                    continue
+
+                status = run_job(job)
+                processed += 1
+                self.stdout.write(f"Сертификат #{job.certificate_id}: {status}")
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(f"Обработано задач: {processed}"))
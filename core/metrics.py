@@ -0,0 +1,161 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+
+logger = logging.getLogger('core.metrics')
+
+METRIC_NAME = 'certificate_stage_seconds'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Как часто процесс сбрасывает свои гистограммы в CERTIFICATE_METRICS_DIR
+DUMP_INTERVAL = 5.0
+
+_lock = threading.Lock()
+_histograms = {}  # (stage, company) -> [счётчики по корзинам..., сумма, количество]
+# Этапы текущего рендера (trace); contextvars, чтобы параллельные потоки и корутины не смешивались
+_trace = ContextVar('metrics_trace', default=None)
+_last_dump = 0.0
+
+
+def observe(stage, seconds, company=''):
+    global _last_dump
+    key = (stage, company or '')
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [0] * len(BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist[i] += 1
+        hist[-2] += seconds
+        hist[-1] += 1
+        dump_due = time.monotonic() - _last_dump > DUMP_INTERVAL
+        if dump_due:
+            _last_dump = time.monotonic()
+    if dump_due:
+        dump()
+
+    trace = _trace.get()
+    if trace is not None:
+        trace[stage] = trace.get(stage, 0.0) + seconds
+
+
+# Контекстный менеджер и декоратор, в том числе для async-представлений: у них замер идёт до конца корутины
+class timed:
+    def __init__(self, stage, company=''):
+        self.stage = stage
+        self.company = company
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self.started, self.company)
+
+    def __call__(self, func):
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def inner(*args, **kwargs):
+                with timed(self.stage, self.company):
+                    return await func(*args, **kwargs)
+        else:
+            @wraps(func)
+            def inner(*args, **kwargs):
+                with timed(self.stage, self.company):
+                    return func(*args, **kwargs)
+        return inner
+
+
+# Собирает этапы одного рендера/запроса и пишет их одной строкой лога; медленные — предупреждением
+@contextmanager
+def trace(operation, company='', **context):
+    stages = {}
+    token = _trace.set(stages)
+    started = time.perf_counter()
+    try:
+        yield stages
+    finally:
+        total = time.perf_counter() - started
+        _trace.reset(token)
+        observe(operation, total, company)
+
+        slow = total >= getattr(settings, 'CERTIFICATE_SLOW_SECONDS', 2.0)
+        details = ' '.join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in stages.items())
+        fields = ' '.join(f"{key}={value}" for key, value in context.items())
+        logger.log(logging.WARNING if slow else logging.INFO, "%s company=%s %s total=%.0fms %s",
+                   operation, company, fields, total * 1000, details,
+                   extra={'operation': operation, 'company': company, 'total': total, 'stages': dict(stages)})
+
+
+def snapshot():
+    with _lock:
+        return {key: list(values) for key, values in _histograms.items()}
+
+
+# Несколько процессов (воркеры gunicorn) пишут свои гистограммы в общий каталог, а /metrics их суммирует
+def metrics_dir():
+    return getattr(settings, 'CERTIFICATE_METRICS_DIR', None)
+
+
+def dump():
+    directory = metrics_dir()
+    if not directory: return
+    data = [[stage, company, values] for (stage, company), values in snapshot().items()]
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        logger.exception("Metrics Dump Error: %s", path)
+
+
+atexit.register(dump)
+
+
+def collect():
+    directory = metrics_dir()
+    if not directory:
+        return snapshot()
+
+    dump()
+    merged = {}
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        if not name.endswith('.json'): continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                rows = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for stage, company, values in rows:
+            current = merged.setdefault((stage, company), [0] * len(values))
+            for i, value in enumerate(values):
+                current[i] += value
+    return merged
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Текстовый формат экспозиции Prometheus 0.0.4
+def render_prometheus():
+    lines = [f"# HELP {METRIC_NAME} Время этапов генерации сертификатов, хранилища и поиска",
+             f"# TYPE {METRIC_NAME} histogram"]
+    for (stage, company), values in sorted(collect().items()):
+        labels = f'stage="{_label(stage)}",company="{_label(company)}"'
+        for bound, count in zip(BUCKETS, values):
+            lines.append(f'{METRIC_NAME}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'{METRIC_NAME}_bucket{{{labels},le="+Inf"}} {values[-1]}')
+        lines.append(f'{METRIC_NAME}_sum{{{labels}}} {values[-2]}')
+        lines.append(f'{METRIC_NAME}_count{{{labels}}} {values[-1]}')
+    return '\n'.join(lines) + '\n'
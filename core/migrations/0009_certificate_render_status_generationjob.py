@@ -0,0 +1,57 @@
+# Generated by Django 5.2.9 on 2026-10-18 14:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_alter_seminar_title'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='certificate',
+            name='render_status',
+            field=models.CharField(choices=[('pending', 'В очереди'), ('running', 'Генерируется'), ('done', 'Готово'), ('failed', 'Ошибка')], default='done', max_length=10, verbose_name='Статус генерации'),
+        ),
+        migrations.AlterField(
+            model_name='certificate',
+            name='file_print',
+            field=models.FileField(blank=True, null=True, upload_to='certificates/print/', verbose_name='PDF для печати'),
+        ),
+        migrations.AlterField(
+            model_name='certificate',
+            name='file_web',
+            field=models.FileField(blank=True, null=True, upload_to='certificates/web/', verbose_name='PDF для клиента'),
+        ),
+        migrations.AlterField(
+            model_name='certificate',
+            name='manual_upload',
+            field=models.FileField(blank=True, null=True, upload_to='certificates/manual/', verbose_name='Ручная загрузка (PDF)'),
+        ),
+        migrations.AlterField(
+            model_name='certificate',
+            name='preview_image',
+            field=models.ImageField(blank=True, null=True, upload_to='certificates/previews/', verbose_name='JPG Превью'),
+        ),
+        migrations.CreateModel(
+            name='GenerationJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('running', 'Генерируется'), ('done', 'Готово'), ('failed', 'Ошибка')], db_index=True, default='pending', max_length=10, verbose_name='Статус')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Попыток')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создано')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Начато')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Завершено')),
+                ('certificate', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='core.certificate', verbose_name='Сертификат')),
+            ],
+            options={
+                'verbose_name': 'Задача генерации',
+                'verbose_name_plural': 'Очередь генерации',
+                'ordering': ['created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 5.2.9 on 2026-10-18 14:24
+
+from django.db import migrations, models
+
+
+def normalize_text(value):
+    return ' '.join(str(value or '').split()).casefold()
+
+
+def normalize_code(value):
+    return ''.join(str(value or '').split()).casefold()
+
+
+def fill_search_columns(apps, schema_editor):
+    Seminar = apps.get_model('core', 'Seminar')
+    Certificate = apps.get_model('core', 'Certificate')
+
+    seminars = list(Seminar.objects.only('organization_name', 'registration_number'))
+    for seminar in seminars:
+        seminar.organization_name_search = normalize_text(seminar.organization_name)
+        seminar.registration_number_search = normalize_code(seminar.registration_number)
+    Seminar.objects.bulk_update(seminars, ['organization_name_search', 'registration_number_search'], batch_size=500)
+
+    certificates = list(Certificate.objects.only('full_name', 'certificate_number'))
+    for cert in certificates:
+        cert.full_name_search = normalize_text(cert.full_name)
+        cert.certificate_number_rev = normalize_code(cert.certificate_number.replace('№', ''))[::-1]
+    Certificate.objects.bulk_update(certificates, ['full_name_search', 'certificate_number_rev'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_certificate_render_status_generationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='certificate',
+            name='certificate_number_rev',
+            field=models.CharField(blank=True, default='', editable=False, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='certificate',
+            name='full_name_search',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='seminar',
+            name='organization_name_search',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='seminar',
+            name='registration_number_search',
+            field=models.CharField(blank=True, default='', editable=False, max_length=50),
+        ),
+        migrations.RunPython(fill_search_columns, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['full_name_search'], name='cert_name_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['certificate_number_rev'], name='cert_number_rev_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='seminar',
+            index=models.Index(fields=['company', 'organization_name_search'], name='seminar_org_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='seminar',
+            index=models.Index(fields=['company', 'registration_number_search'], name='seminar_unp_search_idx'),
+        ),
+    ]
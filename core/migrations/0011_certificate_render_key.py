@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-18 14:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_search_columns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='certificate',
+            name='render_key',
+            field=models.CharField(blank=True, default='', editable=False, max_length=32),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.9 on 2026-10-18 14:52
+
+import core.utils
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_certificate_render_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='certificate',
+            name='manual_upload',
+            field=models.FileField(blank=True, null=True, upload_to='certificates/manual/', validators=[core.utils.validate_pdf], verbose_name='Ручная загрузка (PDF)'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.9 on 2026-10-18 15:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_manual_upload_validation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='certificate',
+            name='thumbnail',
+            field=models.ImageField(blank=True, null=True, upload_to='certificates/thumbnails/', verbose_name='Миниатюра (WebP)'),
+        ),
+        migrations.AddField(
+            model_name='certificate',
+            name='thumbnail_jpeg',
+            field=models.ImageField(blank=True, null=True, upload_to='certificates/thumbnails/', verbose_name='Миниатюра (JPG)'),
+        ),
+    ]
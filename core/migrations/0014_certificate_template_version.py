@@ -0,0 +1,25 @@
+# Generated by Django 5.2.9 on 2026-10-18 15:08
+
+from django.db import migrations, models
+
+
+# До реестра оформлений у каждого реестра был один дизайн — он стал версией 1
+def mark_rendered_as_v1(apps, schema_editor):
+    Certificate = apps.get_model('core', 'Certificate')
+    Certificate.objects.exclude(render_key='').update(template_version=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_certificate_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='certificate',
+            name='template_version',
+            field=models.PositiveSmallIntegerField(blank=True, editable=False, null=True, verbose_name='Версия оформления'),
+        ),
+        migrations.RunPython(mark_rendered_as_v1, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,36 @@
-from django.db import models
-from django.db.models import Max
-from .utils import generate_certificates, pdf_to_jpg
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Max, Q
+from django.urls import reverse
+from .utils import (generate_certificates, pdf_previews, normalize_text, normalize_code, normalize_number,
+                    stored_artifacts, delete_stored_files, compute_render_key, artifact_names, eager_fields,
+                    validate_pdf, ARTIFACT_FIELD_NAMES, PREVIEW_FIELDS)
+from .storage import save_files
+from .styles import get_style
 
 
-class Seminar(models.Model):
+# Запоминает значения полей, загруженные из базы, чтобы save() знал, что именно изменилось
+class TrackedFieldsMixin:
+    TRACKED_FIELDS = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_tracked_fields()
+        return instance
+
+    def remember_tracked_fields(self):
+        # Отложенные (deferred) поля не трогаем, иначе каждое обращение стоило бы запроса
+        deferred = self.get_deferred_fields()
+        self._loaded_values = {f: getattr(self, f) for f in self.TRACKED_FIELDS if f not in deferred}
+
+    def changed_fields(self):
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None: return set(self.TRACKED_FIELDS)
+        return {f for f, value in loaded.items() if getattr(self, f) != value}
+
+
+class Seminar(TrackedFieldsMixin, models.Model):
     COMPANY_CHOICES = [
         ('CSE', 'ЦСЭ'),
         ('NIKA', 'NIKA'),
@@ -17,15 +44,45 @@ class Seminar(models.Model):
     date_start = models.DateField(verbose_name="Дата начала")
     date_end = models.DateField(null=True, blank=True, verbose_name="Дата окончания")
 
+    # Нормализованные копии для публичного поиска (заполняются в save)
+    organization_name_search = models.CharField(max_length=255, blank=True, default='', editable=False)
+    registration_number_search = models.CharField(max_length=50, blank=True, default='', editable=False)
+
     def __str__(self):
         return f"{self.date_start} | {self.organization_name} | {self.title}"
 
+    # Поля, от которых зависит картинка сертификата
+    TRACKED_FIELDS = ('company', 'title', 'program', 'date_start', 'date_end')
+
+    def save(self, *args, **kwargs):
+        self.organization_name_search = normalize_text(self.organization_name)
+        self.registration_number_search = normalize_code(self.registration_number)
+        # signals.py по этому списку ставит в очередь только затронутые сертификаты
+        self.render_fields_changed = self.changed_fields() if self.pk else set()
+        super().save(*args, **kwargs)
+        self.remember_tracked_fields()
+
     class Meta:
         verbose_name = "Семинар"
         verbose_name_plural = "Семинары"
+        indexes = [
+            models.Index(fields=['company', 'organization_name_search'], name='seminar_org_search_idx'),
+            models.Index(fields=['company', 'registration_number_search'], name='seminar_unp_search_idx'),
+        ]
 
 
-class Certificate(models.Model):
+class Certificate(TrackedFieldsMixin, models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'В очереди'),
+        (STATUS_RUNNING, 'Генерируется'),
+        (STATUS_DONE, 'Готово'),
+        (STATUS_FAILED, 'Ошибка'),
+    ]
+
     seminar = models.ForeignKey(Seminar, on_delete=models.CASCADE, related_name='certificates', verbose_name="Семинар")
     full_name = models.CharField(max_length=255, verbose_name="ФИО участника")
     order_number = models.PositiveIntegerField(verbose_name="Порядковый номер", blank=True, null=True)
@@ -35,46 +92,257 @@ class Certificate(models.Model):
     file_web = models.FileField(upload_to='certificates/web/', null=True, blank=True, verbose_name="PDF для клиента")
     preview_image = models.ImageField(upload_to='certificates/previews/', null=True, blank=True,
                                       verbose_name="JPG Превью")
+    # Миниатюры для выдачи поиска (utils.THUMBNAIL_WIDTH): WebP и JPEG для браузеров без WebP
+    thumbnail = models.ImageField(upload_to='certificates/thumbnails/', null=True, blank=True,
+                                  verbose_name="Миниатюра (WebP)")
+    thumbnail_jpeg = models.ImageField(upload_to='certificates/thumbnails/', null=True, blank=True,
+                                       verbose_name="Миниатюра (JPG)")
 
     manual_upload = models.FileField(upload_to='certificates/manual/', null=True, blank=True,
-                                     verbose_name="Ручная загрузка (PDF)")
+                                     validators=[validate_pdf], verbose_name="Ручная загрузка (PDF)")
+
+    render_status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_DONE,
+                                     verbose_name="Статус генерации")
+
+    # Нормализованные копии для публичного поиска (заполняются в save).
+    # Номер хранится перевёрнутым: поиск "по окончанию номера" становится префиксным и идёт по индексу
+    full_name_search = models.CharField(max_length=255, blank=True, default='', editable=False)
+    certificate_number_rev = models.CharField(max_length=50, blank=True, default='', editable=False)
+
+    # Ключ рендера (utils.compute_render_key) текущих файлов; пусто — файлы ручные или созданы до его появления
+    render_key = models.CharField(max_length=32, blank=True, default='', editable=False)
+    # Версия оформления реестра (assets/templates/styles.json), по которой отрисованы текущие файлы
+    template_version = models.PositiveSmallIntegerField(null=True, blank=True, editable=False,
+                                                        verbose_name="Версия оформления")
+
+    TRACKED_FIELDS = ('seminar_id', 'full_name', 'certificate_number')
 
     def __str__(self):
         return f"{self.full_name} ({self.certificate_number})"
 
+    # Номер выдаётся под блокировкой семинара, иначе параллельные сохранения получат один и тот же номер
+    @transaction.atomic
     def save(self, *args, **kwargs):
         if not self.order_number:
-            max_number = Certificate.objects.filter(seminar=self.seminar).aggregate(Max('order_number'))[
-                'order_number__max']
-            self.order_number = (max_number or 0) + 1
+            self.order_number = Certificate.next_order_number(self.seminar)
 
         if not self.certificate_number:
-            target_date = self.seminar.date_end if self.seminar.date_end else self.seminar.date_start
-            date_str = target_date.strftime('%d%m%Y')
-            order_str = f"{self.order_number:02d}"
-            self.certificate_number = f"№ {order_str}-{date_str}"
+            self.certificate_number = Certificate.make_certificate_number(self.seminar, self.order_number)
+
+        self.fill_search_fields()
 
         # --- Исправленная логика ---
+        enqueue = False
 
         # Если есть ручной файл (проверяем .name, чтобы избежать ошибок с пустыми объектами)
         if self.manual_upload and self.manual_upload.name:
             self.file_web = self.manual_upload
-            if not self.preview_image:
-                jpg_preview = pdf_to_jpg(self.manual_upload)
-                if jpg_preview:
-                    self.preview_image.save(jpg_preview.name, jpg_preview, save=False)
-
-        # Если ручного нет -> запускаем генерацию, если файлов не хватает
-        elif not self.file_print or not self.file_web or not self.preview_image:
-            pdf_print, pdf_web, jpg_preview = generate_certificates(self)
+            if not all(getattr(self, field) for field in PREVIEW_FIELDS):
+                # Превью скана рисует воркер очереди, а не запрос админки
+                if getattr(settings, 'CERTIFICATE_ASYNC_GENERATION', True):
+                    self.render_status = self.STATUS_PENDING
+                    enqueue = True
+                else:
+                    self.render_status = self.STATUS_DONE if self.generate_files() else self.STATUS_FAILED
 
-            if pdf_print: self.file_print.save(pdf_print.name, pdf_print, save=False)
-            if pdf_web: self.file_web.save(pdf_web.name, pdf_web, save=False)
-            if jpg_preview: self.preview_image.save(jpg_preview.name, jpg_preview, save=False)
+        # Если ручного нет -> запускаем генерацию, если файлов не хватает или поменялось ФИО/номер.
+        # По умолчанию рендер уходит в очередь (manage.py run_generation_worker), чтобы не держать запрос админки
+        elif self.needs_generation() or (self.pk and self.changed_fields() and self.is_stale()):
+            if getattr(settings, 'CERTIFICATE_ASYNC_GENERATION', True):
+                self.render_status = self.STATUS_PENDING
+                enqueue = True
+            else:
+                replaced = [getattr(self, field).name for field in ARTIFACT_FIELD_NAMES]
+                self.render_status = self.STATUS_DONE if self.generate_files() else self.STATUS_FAILED
+                transaction.on_commit(lambda: Certificate.delete_unreferenced_files(replaced))
 
         super().save(*args, **kwargs)
+        self.remember_tracked_fields()
+
+        if enqueue:
+            GenerationJob.enqueue(self)
+
+    # Блокирует строку семинара до конца транзакции и возвращает следующий свободный порядковый номер
+    @staticmethod
+    def next_order_number(seminar):
+        Seminar.objects.select_for_update().only('pk').get(pk=seminar.pk)
+        max_number = Certificate.objects.filter(seminar=seminar).aggregate(Max('order_number'))['order_number__max']
+        return (max_number or 0) + 1
+
+    @staticmethod
+    def make_certificate_number(seminar, order_number):
+        target_date = seminar.date_end if seminar.date_end else seminar.date_start
+        date_str = target_date.strftime('%d%m%Y')
+        order_str = f"{order_number:02d}"
+        return f"№ {order_str}-{date_str}"
+
+    def fill_search_fields(self):
+        self.full_name_search = normalize_text(self.full_name)
+        self.certificate_number_rev = normalize_number(self.certificate_number)[::-1]
+
+    # Превью для публичной выдачи: готовый файл или, в ленивом режиме, отрисовка по первому запросу.
+    # Без ленивого режима view файла ответил бы 404 — тогда None, и выдача покажет «Нет фото»
+    @property
+    def preview_url(self):
+        if self.preview_image:
+            return self.preview_image.url
+        return self._on_demand_url('preview')
+
+    # Миниатюры так же. Пока backfill_thumbnails не дошёл до старого сертификата с превью — None:
+    # выдача покажет превью, а не станет рендерить миниатюры по запросу страницы
+    @property
+    def thumbnail_url(self):
+        return self._thumbnail_url('thumbnail', 'thumb')
+
+    @property
+    def thumbnail_jpeg_url(self):
+        return self._thumbnail_url('thumbnail_jpeg', 'thumb-jpeg')
+
+    def _thumbnail_url(self, field, kind):
+        if getattr(self, field):
+            return getattr(self, field).url
+        if self.preview_image:
+            return None
+        return self._on_demand_url(kind)
+
+    def _on_demand_url(self, kind):
+        if getattr(settings, 'CERTIFICATE_LAZY_ARTIFACTS', False):
+            return reverse('certificate_file', args=[self.pk, kind])
+        return None
+
+    def needs_generation(self):
+        return any(not getattr(self, field) for field in eager_fields())
+
+    # Файлы отрисованы не из текущих данных семинара и участника
+    def is_stale(self):
+        return self.render_key != compute_render_key(self)
+
+    # Проставляет ключ рендера. Файлы, отрисованные под другим ключом, сбрасываются:
+    # в ленивом режиме их перерисует первый запрос
+    def finish_render(self):
+        self.render_key = compute_render_key(self)
+        self.template_version = get_style(self.seminar.company).version
+        for field, name in zip(ARTIFACT_FIELD_NAMES, artifact_names(self, self.render_key)):
+            if getattr(self, field).name != name:
+                getattr(self, field).name = ''
+
+    # Файлы с тем же ключом рендера уже в хранилище: достаточно сослаться на них
+    def reuse_stored_files(self, fields=None, verify=False):
+        names = stored_artifacts(self, fields or eager_fields(), verify=verify)
+        if not names: return False
+        for field, name in names.items():
+            getattr(self, field).name = name
+        self.finish_render()
+        return True
+
+    def generate_files(self, fields=None, verify=False):
+        # У ручной загрузки генерируются только превью и миниатюры первой страницы
+        if self.manual_upload:
+            previews = pdf_previews(self.manual_upload)
+            if not all(previews): return False
+            save_files(self, list(zip(PREVIEW_FIELDS, previews)))
+            return True
+
+        fields = fields or eager_fields()
+        if self.reuse_stored_files(fields, verify): return True
+
+        rendered = generate_certificates(self, fields=fields)
+        files = [(field, content) for field, content in zip(ARTIFACT_FIELD_NAMES, rendered) if field in fields]
+        if not all(content for _, content in files): return False
+
+        # Файлы уходят в хранилище параллельно
+        save_files(self, files)
+        self.finish_render()
+        return True
+
+    # Отдаёт имя файла, при необходимости отрисовав его (ленивый режим). Строка сертификата блокируется,
+    # поэтому одновременные запросы одного файла не рендерят его дважды: второй дождётся первого.
+    # only_done — рисовать только у готовых сертификатов: стоящие в очереди рисует воркер (без блокировки строки,
+    # рендер здесь шёл бы наперегонки с ним), а упавшие не перерисовываются на каждый запрос
+    @classmethod
+    def ensure_file(cls, pk, field, only_done=False):
+        with transaction.atomic():
+            cert = cls.objects.select_for_update(of=('self',)).select_related('seminar').get(pk=pk)
+            if getattr(cert, field):
+                return getattr(cert, field).name
+            if cert.manual_upload and field not in PREVIEW_FIELDS:
+                return None
+            if only_done and cert.render_status != cls.STATUS_DONE:
+                return None
+
+            # Превью и миниатюры получаются из одного уменьшения листа, поэтому рисуются вместе
+            fields = set(PREVIEW_FIELDS) if field in PREVIEW_FIELDS else {field}
+            if not cert.manual_upload and (cert.needs_generation() or cert.is_stale()):
+                fields.update(eager_fields())
+            old_names = [getattr(cert, name).name for name in ARTIFACT_FIELD_NAMES]
+            if not cert.generate_files(tuple(fields)):
+                return None
+
+            # update(), а не save(): save() снова поставил бы сертификат в очередь
+            cls.objects.filter(pk=pk).update(render_key=cert.render_key, template_version=cert.template_version,
+                                             **{name: getattr(cert, name) for name in ARTIFACT_FIELD_NAMES})
+            cls.delete_unreferenced_files(old_names)
+        return getattr(cert, field).name
+
+    # Одинаковые сертификаты делят файлы, поэтому удаляем только те, на которые больше никто не ссылается.
+    # Проверка идёт после коммита, когда база уже ссылается на новые версии; само удаление — в фоне
+    @staticmethod
+    def delete_unreferenced_files(names):
+        names = sorted({name for name in names if name})
+        if not names: return
+
+        def delete():
+            referenced = set()
+            for i in range(0, len(names), 300):
+                batch = names[i:i + 300]
+                query = Q()
+                for field in ARTIFACT_FIELD_NAMES:
+                    query |= Q(**{f'{field}__in': batch})
+                for row in Certificate.objects.filter(query).values_list(*ARTIFACT_FIELD_NAMES):
+                    referenced.update(row)
+            delete_stored_files(names, keep=referenced)
+
+        transaction.on_commit(delete)
 
     class Meta:
         verbose_name = "Сертификат"
         verbose_name_plural = "Сертификаты"
-        unique_together = ['seminar', 'order_number']
\ No newline at end of file
+        unique_together = ['seminar', 'order_number']
+        indexes = [
+            models.Index(fields=['full_name_search'], name='cert_name_search_idx'),
+            # varchar_pattern_ops нужен Postgres для LIKE 'x%' по индексу; на SQLite opclass игнорируется
+            models.Index(fields=['certificate_number_rev'], name='cert_number_rev_idx',
+                         opclasses=['varchar_pattern_ops']),
+        ]
+
+
+class GenerationJob(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = Certificate.STATUS_CHOICES
+
+    certificate = models.ForeignKey(Certificate, on_delete=models.CASCADE, related_name='jobs',
+                                    verbose_name="Сертификат")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True,
+                              verbose_name="Статус")
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name="Попыток")
+    error = models.TextField(blank=True, verbose_name="Ошибка")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Создано")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="Начато")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="Завершено")
+
+    def __str__(self):
+        return f"{self.certificate_id} | {self.get_status_display()}"
+
+    @classmethod
+    def enqueue(cls, certificate):
+        # Не плодим дубликаты: одна ожидающая задача на сертификат
+        job, _ = cls.objects.get_or_create(certificate=certificate, status=cls.STATUS_PENDING)
+        return job
+
+    class Meta:
+        verbose_name = "Задача генерации"
+        verbose_name_plural = "Очередь генерации"
+        ordering = ['created_at']
@@ -0,0 +1,59 @@
+from django.db.models import Prefetch, Q
+from .models import Seminar, Certificate
+from .utils import normalize_text, normalize_code, normalize_number
+
+# Потолок публичной выдачи: размер ответа и число запросов не зависят от размера найденных семинаров
+MAX_SEMINARS = 20
+MAX_CERTIFICATES = 48
+
+# Как клиенты реестров пишут знак номера: в NIKA — и английским "No"
+NUMBER_PREFIXES = {'CSE': ('№',), 'NIKA': ('№', 'No')}
+
+
+def normalize_query(query, number_prefixes=('№',)):
+    return normalize_text(query), normalize_code(query), normalize_number(query, number_prefixes)
+
+
+def search_seminars(company, query, number_prefixes=('№',)):
+    # Каждое условие — отдельный поиск по своему индексу, объединённые через UNION.
+    # OR по join с certificates + distinct не даёт Postgres использовать индексы
+    text, code, number = normalize_query(query, number_prefixes)
+
+    lookups = [
+        Seminar.objects.filter(company=company, organization_name_search=text).values('pk'),
+        Seminar.objects.filter(company=company, registration_number_search=code).values('pk'),
+        Certificate.objects.filter(seminar__company=company, full_name_search=text).values('seminar_id'),
+    ]
+    if number:
+        lookups.append(Certificate.objects.filter(seminar__company=company,
+                                                  certificate_number_rev__startswith=number[::-1])
+                       .values('seminar_id'))
+
+    seminar_ids = lookups[0].union(*lookups[1:])
+    return Seminar.objects.filter(pk__in=seminar_ids)
+
+
+# Участники для выдачи: по компании или УНП — все участники семинара, по ФИО или номеру — только совпавшие
+def matching_certificates(query, number_prefixes=('№',)):
+    text, code, number = normalize_query(query, number_prefixes)
+    condition = (Q(seminar__organization_name_search=text) | Q(seminar__registration_number_search=code)
+                 | Q(full_name_search=text))
+    if number:
+        condition |= Q(certificate_number_rev__startswith=number[::-1])
+    return (Certificate.objects.filter(condition).order_by('order_number')
+            .only('pk', 'seminar_id', 'full_name', 'file_web', 'preview_image', 'thumbnail', 'thumbnail_jpeg'))
+
+
+# Семинары для выдачи (не больше MAX_SEMINARS) с участниками в matched_certificates (не больше MAX_CERTIFICATES
+# на семинар) и флагами обрезки. Два запроса при любом размере результата: срез в Prefetch Django делает оконной
+# функцией, по-прежнему одним запросом. Асинхронный обход выполняет оба запроса в потоке базы, не блокируя цикл событий
+async def asearch_results(company, query, number_prefixes=('№',)):
+    certificates = matching_certificates(query, number_prefixes)[:MAX_CERTIFICATES + 1]
+    seminars = [seminar async for seminar in search_seminars(company, query, number_prefixes)
+                .order_by('-date_start', '-pk')
+                .prefetch_related(Prefetch('certificates', queryset=certificates,
+                                           to_attr='matched_certificates'))[:MAX_SEMINARS + 1]]
+    for seminar in seminars:
+        seminar.more_certificates = len(seminar.matched_certificates) > MAX_CERTIFICATES
+        del seminar.matched_certificates[MAX_CERTIFICATES:]
+    return seminars[:MAX_SEMINARS], len(seminars) > MAX_SEMINARS
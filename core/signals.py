@@ -0,0 +1,37 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .cache import invalidate_registry
+from .jobs import stale_certificates, schedule_generation
+from .models import Seminar, Certificate
+
+
+@receiver([post_save, post_delete], sender=Seminar)
+def seminar_changed(sender, instance, **kwargs):
+    # Семинар, перенесённый в другой реестр, пропадает из выдачи прежнего — сбрасываем оба
+    previous = getattr(instance, '_loaded_values', {}).get('company', instance.company)
+    invalidate_registry(previous, instance.company)
+
+
+@receiver(post_save, sender=Seminar)
+def seminar_render_fields_changed(sender, instance, created, **kwargs):
+    if created or not getattr(instance, 'render_fields_changed', None):
+        return
+
+    # После коммита: инлайны участников сохраняются в той же транзакции и сами ставят себя в очередь,
+    # а синхронная генерация не должна идти внутри транзакции админки
+    def schedule():
+        stale = stale_certificates(instance.certificates.all())
+        if stale:
+            schedule_generation(Certificate.objects.filter(pk__in=stale))
+
+    transaction.on_commit(schedule)
+
+
+@receiver([post_save, post_delete], sender=Certificate)
+def certificate_changed(sender, instance, **kwargs):
+    # При каскадном удалении семинар может быть не загружен — не дёргаем базу ради одного кода реестра
+    if Certificate.seminar.is_cached(instance):
+        invalidate_registry(instance.seminar.company)
+    else:
+        invalidate_registry(*[code for code, _ in Seminar.COMPANY_CHOICES])
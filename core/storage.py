@@ -0,0 +1,87 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+from django.conf import settings
+from django.core.files.storage import default_storage
+from storages.utils import clean_name
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Лимит DeleteObjects в S3
+DELETE_BATCH = 1000
+
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+# Общий пул потоков для хранилища. S3Storage держит boto3-ресурс на поток, поэтому долгоживущие потоки
+# переиспользуют сессии и keep-alive соединения вместо нового TLS-рукопожатия на каждый файл
+@lru_cache(maxsize=1)
+def executor():
+    return ThreadPoolExecutor(max_workers=getattr(settings, 'CERTIFICATE_STORAGE_THREADS', 8),
+                              thread_name_prefix='storage')
+
+
+# Загружает файлы записи параллельно: files — пары (поле, ContentFile)
+def save_files(instance, files):
+    futures = [executor().submit(_save_file, getattr(instance, field), content) for field, content in files]
+    for future in futures:
+        future.result()
+
+
+def _save_file(field_file, content):
+    with metrics.timed('storage_upload'):
+        field_file.save(content.name, content, save=False)
+
+
+def delete_files(names):
+    with metrics.timed('storage_delete'):
+        _delete_files(names)
+
+
+def _delete_files(names):
+    names = [name for name in names if name]
+    if not names: return
+
+    bucket = getattr(default_storage, 'bucket', None)
+    if bucket is None:
+        # Не S3 (локальная разработка, тесты): удаляем по одному
+        for name in names:
+            default_storage.delete(name)
+        return
+
+    keys = [default_storage._normalize_name(clean_name(name)) for name in names]
+    for i in range(0, len(keys), DELETE_BATCH):
+        response = bucket.delete_objects(Delete={
+            'Objects': [{'Key': key} for key in keys[i:i + DELETE_BATCH]],
+            'Quiet': True,
+        })
+        for error in response.get('Errors', []):
+            logger.error("Storage Delete Error: %s: %s", error.get('Key'), error.get('Message'))
+
+
+def _report(future):
+    with _pending_lock:
+        _pending.discard(future)
+    if future.exception():
+        logger.error("Storage Delete Error", exc_info=future.exception())
+
+
+# Удаление не задерживает ни запрос, ни воркер: идёт в фоне общего пула
+def delete_files_later(names):
+    names = [name for name in names if name]
+    if not names: return None
+    future = executor().submit(delete_files, names)
+    with _pending_lock:
+        _pending.add(future)
+    future.add_done_callback(_report)
+    return future
+
+
+# Дождаться фоновых удалений (тесты, завершение команд)
+def wait_for_deletes():
+    with _pending_lock:
+        pending = list(_pending)
+    wait(pending)
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+from functools import lru_cache
+from PIL import Image, ImageFont
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .layout import get_font
+
+ASSETS_DIR = os.path.join(settings.BASE_DIR, 'assets')
+FONTS_DIR = os.path.join(ASSETS_DIR, 'fonts')
+TEMPLATES_DIR = os.path.join(ASSETS_DIR, 'templates')
+
+# Реестр оформлений сертификатов: {реестр: {"current": версия, "versions": {версия: стиль}}}.
+# Новый дизайн — новая версия рядом со старыми (старые остаются, на них ссылаются Certificate.template_version),
+# затем "current" переключается на неё. Шрифты — имена файлов из assets/fonts, шаблоны — из assets/templates
+MANIFEST_PATH = os.path.join(TEMPLATES_DIR, 'styles.json')
+
+# Поля сертификата и обязательные параметры каждого типа раскладки
+STYLE_FIELDS = ('name', 'title', 'program', 'number', 'date')
+FIELD_PARAMS = {
+    'autofit': ('align', 'y_start', 'y_end', 'max_width', 'max_size', 'min_size'),
+    'autofit_one_line': ('y_center', 'max_width', 'max_size', 'min_size'),
+    'simple': ('x', 'y', 'size'),
+}
+STYLE_FONTS = ('font_main', 'font_title', 'font_sec')
+STYLE_COLORS = ('color_title', 'color_text')
+
+
+# Полный лист (~35 МБ) декодируется только на пути рендера (utils.composed_template, load_template)
+@lru_cache(maxsize=16)
+def decode_template(path):
+    image = Image.open(path).convert('RGB')
+    image.load()
+    return image
+
+
+# Размер из заголовка файла, без декодирования пикселей: компиляция оформления идёт и в веб-процессе
+# (ключ рендера при каждом Certificate.save), где шаблоны не рисуются
+def template_size(path):
+    with Image.open(path) as image:
+        return image.size
+
+
+@lru_cache(maxsize=32)
+def file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return ''
+
+
+@lru_cache(maxsize=1)
+def load_manifest():
+    with open(MANIFEST_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+
+# Скомпилированное оформление: словарь стиля (шрифты — полные пути, цвета — кортежи), как его читает раскладка,
+# плюс реквизиты реестра, размер шаблона и готовая часть ключа рендера
+class CompiledStyle(dict):
+    def __init__(self, company, version, style, size, key_parts):
+        super().__init__(style)
+        self.company = company
+        self.version = version
+        self.size = size
+        self.key_parts = key_parts
+
+
+def _check_field(fail, key, cfg, size):
+    width, height = size
+    params = FIELD_PARAMS.get(cfg.get('type'))
+    if params is None:
+        fail(f"поле {key}: неизвестный тип {cfg.get('type')!r}")
+    missing = [param for param in params if param not in cfg]
+    if missing:
+        fail(f"поле {key}: нет {', '.join(missing)}")
+
+    if cfg['type'] == 'simple':
+        if not (0 <= cfg['x'] < width and 0 <= cfg['y'] < height):
+            fail(f"поле {key}: точка ({cfg['x']}, {cfg['y']}) вне шаблона {width}x{height}")
+        return
+    if not 0 < cfg['min_size'] <= cfg['max_size']:
+        fail(f"поле {key}: min_size {cfg['min_size']} > max_size {cfg['max_size']}")
+    if not 0 < cfg['max_width'] <= width:
+        fail(f"поле {key}: max_width {cfg['max_width']} шире шаблона {width}")
+    if cfg['type'] == 'autofit':
+        if cfg['align'] not in ('center', 'left'):
+            fail(f"поле {key}: неизвестное выравнивание {cfg['align']!r}")
+        if not 0 <= cfg['y_start'] < cfg['y_end'] <= height:
+            fail(f"поле {key}: блок {cfg['y_start']}..{cfg['y_end']} вне шаблона высотой {height}")
+    elif not 0 <= cfg['y_center'] < height:
+        fail(f"поле {key}: y_center {cfg['y_center']} вне шаблона высотой {height}")
+
+
+# Проверяет стиль один раз на процесс: шрифты находятся и читаются, шаблоны читаются и одного размера,
+# поля лежат внутри листа. Ошибка в манифесте видна при старте воркера, а не на сотом сертификате
+def compile_style(company, version, spec):
+    def fail(message):
+        raise ImproperlyConfigured(f"Оформление {company} v{version}: {message}")
+
+    style = dict(spec)
+    for key in STYLE_FONTS:
+        path = os.path.join(FONTS_DIR, spec.get(key) or '')
+        try:
+            ImageFont.truetype(path, 10)
+        except OSError:
+            fail(f"{key}: шрифт {spec.get(key)!r} не найден или не читается")
+        style[key] = path
+        get_font(path, 50)
+    for key in STYLE_COLORS:
+        color = spec.get(key)
+        if not (isinstance(color, list) and len(color) == 3 and all(0 <= c <= 255 for c in color)):
+            fail(f"{key}: ожидается [r, g, b], получено {color!r}")
+        style[key] = tuple(color)
+
+    sizes = set()
+    for key in ('tpl_clean', 'tpl_stamp'):
+        path = os.path.join(TEMPLATES_DIR, spec.get(key) or '')
+        try:
+            sizes.add(template_size(path))
+        except OSError:
+            fail(f"{key}: шаблон {spec.get(key)!r} не найден или не читается")
+    if len(sizes) != 1:
+        fail(f"шаблоны разного размера: {sorted(sizes)}")
+    size = sizes.pop()
+
+    for key in STYLE_FIELDS:
+        if not isinstance(spec.get(key), dict):
+            fail(f"нет поля {key}")
+        _check_field(fail, key, spec[key], size)
+
+    # Пути к шрифтам зависят от каталога деплоя, поэтому в ключ рендера идут имена и содержимое файлов
+    assets = [os.path.join(TEMPLATES_DIR, style['tpl_clean']), os.path.join(TEMPLATES_DIR, style['tpl_stamp']),
+              style['font_main'], style['font_title'], style['font_sec']]
+    style_items = sorted((k, os.path.basename(v) if isinstance(v, str) else v) for k, v in style.items())
+    return CompiledStyle(company, version, style, size, (style_items, [file_digest(path) for path in assets]))
+
+
+def current_version(company):
+    entry = load_manifest().get(company)
+    if not entry:
+        raise ImproperlyConfigured(f"Нет оформления для реестра {company}")
+    return entry['current']
+
+
+# Оформление реестра: текущая версия или заданная. Компилируется один раз на (реестр, версия)
+@lru_cache(maxsize=None)
+def get_style(company, version=None):
+    if version is None:
+        return get_style(company, current_version(company))
+    spec = load_manifest().get(company, {}).get('versions', {}).get(str(version))
+    if spec is None:
+        raise ImproperlyConfigured(f"Нет оформления {company} v{version}")
+    return compile_style(company, version, spec)
+
+
+# Все версии всех реестров (прогрев воркера, проверка манифеста в тестах)
+def all_styles():
+    return [get_style(company, int(version))
+            for company, entry in load_manifest().items() for version in entry['versions']]
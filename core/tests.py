@@ -1,3 +1,875 @@
-from django.test import TestCase
+import copy
+import datetime
+import hashlib
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import zipfile
+import fitz
+from PIL import Image
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import parse_http_date
+from . import benchmarks, bulk, metrics, storage, styles, utils
+from .cache import aregistry_version, invalidate_registry
+from .importer import import_participants, read_names
+from .jobs import MAX_ATTEMPTS, claim_next_job, enqueue_many, requeue_stale_jobs, run_job
+from .models import Seminar, Certificate, GenerationJob
 
-# Create your tests here.
+# S3 и манифест collectstatic в тестах недоступны
+TEST_STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.InMemoryStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+
+def create_seminar(company='CSE', participants=3, **kwargs):
+    index = Seminar.objects.count() + 1
+    seminar = Seminar.objects.create(
+        company=company,
+        organization_name=kwargs.get('organization_name', f"ООО Клиент {index}"),
+        registration_number=kwargs.get('registration_number', f"19{index:07d}"),
+        title=f"Семинар {index}",
+        program="1. Введение\n2. Практика",
+        date_start=datetime.date(2025, 3, 1),
+    )
+    for i in range(participants):
+        Certificate.objects.create(seminar=seminar, full_name=f"Участник {index}-{i}")
+    return seminar
+
+
+# Генерация уходит в очередь, поэтому тесты не рендерят
+@override_settings(CERTIFICATE_ASYNC_GENERATION=True, STORAGES=TEST_STORAGES)
+class QueryCountTests(TestCase):
+    # Число запросов не должно зависеть от числа строк на странице или найденных участников
+    SEMINAR_CHANGELIST_QUERIES = 5
+    CERTIFICATE_CHANGELIST_QUERIES = 6
+    SEARCH_QUERIES = 2
+
+    def setUp(self):
+        caches['registry'].clear()
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.user)
+
+    def assert_stable_queries(self, expected, url, grow):
+        self.client.get(url)  # прогрев сессии и ContentType
+        with self.assertNumQueries(expected):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        grow()
+        with self.assertNumQueries(expected):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_seminar_changelist(self):
+        create_seminar()
+        self.assert_stable_queries(self.SEMINAR_CHANGELIST_QUERIES, '/admin/core/seminar/',
+                                   lambda: [create_seminar(participants=5) for _ in range(10)])
+
+    def test_certificate_changelist(self):
+        create_seminar()
+        self.assert_stable_queries(self.CERTIFICATE_CHANGELIST_QUERIES, '/admin/core/certificate/',
+                                   lambda: [create_seminar(company='NIKA', participants=5) for _ in range(10)])
+
+    def test_cse_search(self):
+        self.client.logout()
+        create_seminar(organization_name="ООО Ромашка", participants=2)
+        with self.assertNumQueries(self.SEARCH_QUERIES):
+            response = self.client.get('/cse/', {'q': 'ооо ромашка'})
+        self.assertEqual(len(response.context['results']), 1)
+
+        create_seminar(organization_name="ООО Ромашка", participants=30)
+        with self.assertNumQueries(self.SEARCH_QUERIES):
+            response = self.client.get('/cse/', {'q': 'ООО Ромашка'})
+        self.assertEqual(len(response.context['results']), 2)
+
+        # Повтор того же запроса отдаётся из кэша реестра
+        with self.assertNumQueries(0):
+            self.client.get('/cse/', {'q': 'ООО  РОМАШКА'})
+
+    def test_nika_search(self):
+        self.client.logout()
+        seminar = create_seminar(company='NIKA', participants=20)
+        number = seminar.certificates.first().certificate_number
+        with self.assertNumQueries(self.SEARCH_QUERIES):
+            response = self.client.get('/nika/', {'q': number.replace('№', 'No')})
+        self.assertEqual([s.pk for s in response.context['results']], [seminar.pk])
+
+    @mock.patch('core.search.MAX_CERTIFICATES', 3)
+    @mock.patch('core.search.MAX_SEMINARS', 2)
+    def test_search_results_are_capped(self):
+        self.client.logout()
+        for _ in range(3):
+            create_seminar(organization_name="ООО Ромашка", participants=5)
+        with self.assertNumQueries(self.SEARCH_QUERIES):
+            response = self.client.get('/cse/', {'q': 'ООО Ромашка'})
+        results = response.context['results']
+        self.assertEqual(len(results), 2)
+        self.assertTrue(response.context['truncated'])
+        self.assertEqual([len(s.matched_certificates) for s in results], [3, 3])
+        self.assertTrue(all(s.more_certificates for s in results))
+
+        # По ФИО выдаются только совпавшие участники, а не весь семинар
+        response = self.client.get('/cse/', {'q': results[0].matched_certificates[1].full_name})
+        self.assertEqual([[c.full_name for c in s.matched_certificates] for s in response.context['results']],
+                         [[results[0].matched_certificates[1].full_name]])
+        self.assertFalse(response.context['truncated'])
+
+
+@override_settings(CERTIFICATE_ASYNC_GENERATION=True, STORAGES=TEST_STORAGES)
+class ImportTests(TestCase):
+    # Блокировка, MAX и пачки INSERT (SQLite режет bulk_create по лимиту переменных, Postgres вставляет одним запросом)
+    MAX_IMPORT_QUERIES = 10
+
+    def test_import_allocates_contiguous_numbers(self):
+        seminar = create_seminar(participants=2)
+        names = [f"Слушатель {i}" for i in range(200)]
+        with CaptureQueriesContext(connection) as queries:
+            import_participants(seminar, names)
+        self.assertLessEqual(len(queries), self.MAX_IMPORT_QUERIES)
+
+        numbers = list(seminar.certificates.order_by('order_number').values_list('order_number', flat=True))
+        self.assertEqual(numbers, list(range(1, 203)))
+        last = seminar.certificates.get(order_number=202)
+        self.assertEqual(last.certificate_number, "№ 202-01032025")
+        self.assertEqual(last.render_status, Certificate.STATUS_PENDING)
+        self.assertEqual(GenerationJob.objects.filter(certificate__seminar=seminar).count(), 202)
+
+    def test_read_names_csv(self):
+        data = "ФИО;Должность\nИванов  Иван;инженер\n\nПетров Пётр;бухгалтер\n".encode('cp1251')
+        names = read_names(SimpleUploadedFile('list.csv', data))
+        self.assertEqual(names, ["Иванов Иван", "Петров Пётр"])
+        # Без заголовка первая строка — участник
+        data = "Иванов Иван;инженер\nПетров Пётр;бухгалтер\n".encode('utf-8')
+        self.assertEqual(read_names(SimpleUploadedFile('list.csv', data)), ["Иванов Иван", "Петров Пётр"])
+
+    def test_read_names_xlsx_skips_header(self):
+        cells = ''.join(f'<row><c r="A{i}" t="inlineStr"><is><t>{value}</t></is></c></row>'
+                        for i, value in enumerate(["Ф.И.О.", "Иванов Иван", "Петров Пётр"], 1))
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as archive:
+            archive.writestr('xl/worksheets/sheet1.xml', '<worksheet xmlns="http://schemas.openxmlformats.org/'
+                                                         f'spreadsheetml/2006/main"><sheetData>{cells}</sheetData></worksheet>')
+        names = read_names(SimpleUploadedFile('list.xlsx', buf.getvalue()))
+        self.assertEqual(names, ["Иванов Иван", "Петров Пётр"])
+
+    def test_read_names_utf16_csv(self):
+        # "Текст в Юникоде" из Excel: UTF-16 с BOM
+        data = "ФИО\tДолжность\r\nИванов Иван\tинженер\r\n".encode('utf-16')
+        self.assertEqual(read_names(SimpleUploadedFile('list.csv', data)), ["Иванов Иван"])
+
+    def test_unreadable_files_are_rejected(self):
+        for name, data in [('list.docx', make_pdf("x")), ('list.xls', b'\xd0\xcf\x11\xe0' + bytes(64)),
+                           ('list.txt', b'PK\x03\x04' + bytes(64)), ('list.xlsx', b'not a zip')]:
+            with self.assertRaises(ValidationError, msg=name):
+                read_names(SimpleUploadedFile(name, data))
+
+    def test_too_long_names_are_rejected(self):
+        seminar = create_seminar(participants=0)
+        with self.assertRaises(ValidationError):
+            import_participants(seminar, ["Иванов Иван", "Я" * 256])
+        self.assertFalse(seminar.certificates.exists())
+
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        url = reverse('admin:core_seminar_import', args=[seminar.pk])
+        response = self.client.post(url, {'names': "Я" * 256})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].non_field_errors())
+        response = self.client.post(url, {'file': SimpleUploadedFile('list.docx', b'PK\x03\x04')})
+        self.assertTrue(response.context['form'].errors['file'])
+        self.assertFalse(seminar.certificates.exists())
+
+
+@override_settings(CERTIFICATE_ASYNC_GENERATION=True, STORAGES=TEST_STORAGES, API_RATE_LIMIT=0)
+class VerifyApiTests(TestCase):
+    def setUp(self):
+        caches['registry'].clear()
+
+    def test_batch_lookup_is_one_query_per_kind(self):
+        seminar = create_seminar(company='NIKA', participants=3, registration_number="190 000 777")
+        numbers = [cert.certificate_number for cert in seminar.certificates.order_by('order_number')]
+        query = {'number': [numbers[0], numbers[2].replace('№', 'No'), "№ 99-01012000"], 'unp': ["190000777"]}
+
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/nika/verify/', query)
+        data = response.json()
+        self.assertEqual(data['numbers'][numbers[0]][0]['full_name'], seminar.certificates.get(order_number=1).full_name)
+        self.assertEqual(len(data['numbers'][numbers[2].replace('№', 'No')]), 1)
+        self.assertEqual(data['numbers']["№ 99-01012000"], [])
+        self.assertEqual(data['unps']["190000777"][0]['certificates'], 3)
+
+        # Другой реестр этих номеров не видит
+        self.assertEqual(self.client.get('/api/cse/verify/', {'number': numbers[0]}).json()['numbers'][numbers[0]], [])
+        self.assertEqual(self.client.get('/api/other/verify/', {'number': numbers[0]}).status_code, 404)
+
+    def test_conditional_get_and_limits(self):
+        create_seminar()
+        response = self.client.get('/api/cse/verify/', {'unp': "190000001"})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/api/cse/verify/', {'unp': "190000001"},
+                                             HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        self.assertEqual(self.client.get('/api/cse/verify/').status_code, 400)
+        with self.settings(API_MAX_BATCH=2):
+            self.assertEqual(self.client.get('/api/cse/verify/', {'number': ['1', '2', '3']}).status_code, 400)
+        with self.settings(API_RATE_LIMIT=2):
+            statuses = [self.client.get('/api/cse/verify/', {'unp': "190000001"}).status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+
+
+@override_settings(STORAGES=TEST_STORAGES, API_RATE_LIMIT=0)
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        caches['registry'].clear()
+        self.seminar = create_seminar(participants=2)
+
+    async def test_search_and_api_in_event_loop(self):
+        # Как под ASGI: представления выполняются в цикле событий, где синхронный доступ к базе запрещён
+        query = {'q': self.seminar.organization_name}
+        response = await self.async_client.get('/cse/', query)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['results'][0].matched_certificates), 2)
+        not_modified = await self.async_client.get('/cse/', query, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(not_modified.status_code, 304)
+
+        response = await self.async_client.get('/api/cse/verify/', {'unp': self.seminar.registration_number})
+        self.assertEqual(response.json()['unps'][self.seminar.registration_number][0]['certificates'], 2)
+
+
+    async def test_registry_version(self):
+        cse, nika = await aregistry_version('CSE'), await aregistry_version('NIKA')
+        # Перенос семинара в другой реестр меняет выдачу обоих
+        self.seminar.company = 'NIKA'
+        await self.seminar.asave()
+        self.assertGreater(await aregistry_version('CSE'), cse)
+        self.assertGreater(await aregistry_version('NIKA'), nika)
+
+        # Пачка сбросов за одну секунду не уводит Last-Modified в будущее
+        for _ in range(50):
+            invalidate_registry('NIKA')
+        response = await self.async_client.get('/nika/', {'q': self.seminar.organization_name})
+        self.assertLessEqual(parse_http_date(response['Last-Modified']), time.time())
+
+
+def make_pdf(text):
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), text)
+    return doc.tobytes()
+
+
+@override_settings(CERTIFICATE_ASYNC_GENERATION=True, STORAGES=TEST_STORAGES)
+class ExportTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        self.seminar = create_seminar(participants=12)
+        for cert in self.seminar.certificates.all():
+            Certificate.objects.filter(pk=cert.pk).update(
+                file_print=default_storage.save(f"print/{cert.pk}.pdf", ContentFile(make_pdf(f"print {cert.pk}"))),
+                file_web=default_storage.save(f"web/{cert.pk}.pdf", ContentFile(make_pdf(f"web {cert.pk}"))))
+
+    def test_zip(self):
+        response = self.client.get(f'/admin/core/seminar/{self.seminar.pk}/export/zip/')
+        self.assertTrue(response.streaming)
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(len(archive.namelist()), 24)
+        self.assertIsNone(archive.testzip())
+
+    def test_merged_pdf(self):
+        response = self.client.get(f'/admin/core/seminar/{self.seminar.pk}/export/pdf/')
+        self.assertTrue(response.streaming)
+        doc = fitz.open(stream=b''.join(response.streaming_content), filetype='pdf')
+        self.assertEqual(doc.page_count, 12)
+        first = self.seminar.certificates.order_by('order_number').first()
+        self.assertIn(f"print {first.pk}", doc[0].get_text())
+
+    def test_missing_file_is_skipped_and_logged(self):
+        first = self.seminar.certificates.order_by('order_number').first()
+        default_storage.delete(first.file_print.name)
+        with self.assertLogs('core.export', 'ERROR') as logs:
+            response = self.client.get(f'/admin/core/seminar/{self.seminar.pk}/export/pdf/')
+            doc = fitz.open(stream=b''.join(response.streaming_content), filetype='pdf')
+        self.assertEqual(doc.page_count, 11)
+        self.assertIn(f"certificate {first.pk}", logs.output[0])
+
+    def test_empty_seminar(self):
+        seminar = create_seminar(participants=0)
+        response = self.client.get(f'/admin/core/seminar/{seminar.pk}/export/pdf/')
+        self.assertRedirects(response, f'/admin/core/seminar/{seminar.pk}/change/')
+
+
+@override_settings(CERTIFICATE_ASYNC_GENERATION=True, STORAGES=TEST_STORAGES)
+class RenderCacheTests(TestCase):
+    def test_bulk_errors_are_logged_with_traceback(self):
+        cert = create_seminar(participants=1).certificates.get()
+        with mock.patch.object(Certificate, 'reuse_stored_files', return_value=False), \
+                mock.patch('core.bulk.render_files', side_effect=RuntimeError("шаблон не найден")), \
+                self.assertLogs('core.bulk', 'ERROR') as logs:
+            self.assertEqual(bulk.regenerate(Certificate.objects.filter(pk=cert.pk), workers=1), (0, 1))
+        self.assertIn(f"Bulk Render Error: certificate {cert.pk}", logs.output[0])
+        self.assertIn('Traceback', logs.output[0])
+
+    def test_regenerate_repairs_missing_files(self):
+        seminar = create_seminar(participants=1)
+        bulk.regenerate(seminar.certificates.all(), workers=1)
+        cert = seminar.certificates.get()
+        default_storage.delete(cert.file_web.name)
+
+        # Имена в полях совпадают с ключом рендера, но объекта в хранилище нет — рисуем заново
+        with mock.patch('core.bulk.render_files', wraps=bulk.render_files) as render:
+            self.assertEqual(bulk.regenerate(seminar.certificates.all(), workers=1), (1, 0))
+        self.assertEqual(render.call_count, 1)
+        self.assertTrue(default_storage.exists(cert.file_web.name))
+
+        with mock.patch('core.bulk.render_files', wraps=bulk.render_files) as render:
+            bulk.regenerate(seminar.certificates.all(), workers=1, force=True)
+        self.assertEqual(render.call_count, 1)
+
+    def test_render_processes_with_live_storage_threads(self):
+        # Как в веб-воркере: потоки общего пула хранилища уже запущены, а рендер уходит в процессы
+        storage.executor().submit(lambda: None).result()
+        seminar = create_seminar(participants=2)
+        with mock.patch.object(Certificate, 'reuse_stored_files', return_value=False):
+            self.assertEqual(bulk.regenerate(seminar.certificates.all(), workers=2), (2, 0))
+        for cert in seminar.certificates.all():
+            self.assertTrue(default_storage.exists(cert.file_web.name))
+        with bulk._render_pool(2) as pool:
+            self.assertEqual(pool._mp_context.get_start_method(), 'forkserver')
+
+    def test_unchanged_certificates_skip_render(self):
+        seminar = create_seminar(participants=2)
+        self.assertEqual(bulk.regenerate(seminar.certificates.all(), workers=1), (2, 0))
+        names = sorted(seminar.certificates.values_list('file_print', 'file_web', 'preview_image'))
+
+        # Повторная перегенерация ничего не рендерит и ничего не пишет в хранилище
+        with mock.patch('core.bulk.generate_certificates') as render, \
+                mock.patch.object(default_storage, 'save') as save:
+            self.assertEqual(bulk.regenerate(seminar.certificates.all(), workers=1), (2, 0))
+        render.assert_not_called()
+        save.assert_not_called()
+        self.assertEqual(sorted(seminar.certificates.values_list('file_print', 'file_web', 'preview_image')), names)
+
+        # Правка участника меняет ключ только у него; старые файлы удаляются
+        cert = seminar.certificates.order_by('order_number').first()
+        old_print = cert.file_print.name
+        Certificate.objects.filter(pk=cert.pk).update(full_name="Новое Имя")
+        with mock.patch('core.bulk.render_files', wraps=bulk.render_files) as render, \
+                self.captureOnCommitCallbacks(execute=True):
+            bulk.regenerate(seminar.certificates.all(), workers=1)
+        self.assertEqual(render.call_count, 1)
+        storage.wait_for_deletes()
+        self.assertFalse(default_storage.exists(old_print))
+
+    def test_background_delete_errors_are_logged(self):
+        with mock.patch.object(default_storage, 'delete', side_effect=OSError("boom")), \
+                self.assertLogs('core.storage', 'ERROR') as logs:
+            storage.delete_files_later(['print/missing.pdf'])
+            storage.wait_for_deletes()
+        self.assertIn('Storage Delete Error', logs.output[0])
+        self.assertIn('OSError: boom', logs.output[0])
+
+
+@override_settings(CERTIFICATE_ASYNC_GENERATION=True, STORAGES=TEST_STORAGES)
+class GenerationQueueTests(TestCase):
+    def setUp(self):
+        self.cert = create_seminar(participants=1).certificates.get()
+
+    def test_job_renders_certificate(self):
+        self.assertEqual(self.cert.render_status, Certificate.STATUS_PENDING)
+        job = claim_next_job()
+        self.assertEqual((job.certificate_id, job.status, job.attempts), (self.cert.pk, GenerationJob.STATUS_RUNNING, 1))
+        self.cert.refresh_from_db()
+        self.assertEqual(self.cert.render_status, Certificate.STATUS_RUNNING)
+        self.assertIsNone(claim_next_job())
+
+        self.assertEqual(run_job(job), GenerationJob.STATUS_DONE)
+        job.refresh_from_db()
+        self.cert.refresh_from_db()
+        self.assertEqual(job.status, GenerationJob.STATUS_DONE)
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(self.cert.render_status, Certificate.STATUS_DONE)
+        self.assertTrue(self.cert.file_web and self.cert.render_key)
+
+    def test_retries_then_fails(self):
+        statuses = []
+        # Файлы с тем же ключом рендера могли остаться в хранилище от других тестов
+        with mock.patch.object(Certificate, 'reuse_stored_files', return_value=False), \
+                mock.patch('core.models.generate_certificates', return_value=utils.NO_FILES):
+            for _ in range(MAX_ATTEMPTS):
+                statuses.append(run_job(claim_next_job()))
+                self.cert.refresh_from_db()
+                self.assertEqual(self.cert.render_status, statuses[-1])
+        self.assertEqual(statuses, [GenerationJob.STATUS_PENDING] * (MAX_ATTEMPTS - 1) + [GenerationJob.STATUS_FAILED])
+
+        job = GenerationJob.objects.get(certificate=self.cert)
+        self.assertEqual(job.attempts, MAX_ATTEMPTS)
+        self.assertTrue(job.error and job.finished_at)
+        self.assertIsNone(claim_next_job())
+
+    def test_requeue_stale_jobs(self):
+        stale = claim_next_job()
+        GenerationJob.objects.filter(pk=stale.pk).update(started_at=timezone.now() - datetime.timedelta(minutes=30))
+        fresh = create_seminar(participants=1).certificates.get()
+        self.assertEqual(claim_next_job().certificate_id, fresh.pk)
+
+        self.assertEqual(requeue_stale_jobs(15), 1)
+        stale.refresh_from_db()
+        self.cert.refresh_from_db()
+        self.assertEqual(stale.status, GenerationJob.STATUS_PENDING)
+        self.assertEqual(self.cert.render_status, Certificate.STATUS_PENDING)
+        self.assertEqual(GenerationJob.objects.get(certificate=fresh).status, GenerationJob.STATUS_RUNNING)
+
+    def test_enqueue_keeps_one_pending_job(self):
+        enqueue_many(Certificate.objects.all())
+        enqueue_many(Certificate.objects.all())
+        self.assertEqual(GenerationJob.objects.filter(certificate=self.cert).count(), 1)
+
+        out = io.StringIO()
+        call_command('run_generation_worker', once=True, stdout=out)
+        self.assertIn("Обработано задач: 1", out.getvalue())
+        self.cert.refresh_from_db()
+        self.assertEqual(self.cert.render_status, Certificate.STATUS_DONE)
+
+
+# Раскладка и пиксели текста, снятые с исходного рендера (до layout.py) для обоих реестров: короткие и длинные
+# тексты и тексты, не влезающие даже минимальным кеглем. Осознанная правка раскладки меняет этот файл
+# вместе с RENDER_VERSION
+LAYOUT_GOLDEN = os.path.join(os.path.dirname(__file__), 'layout_golden.json')
+
+
+class LayoutGoldenTests(TestCase):
+    FIELD_ORDER = ('name', 'title', 'program', 'number', 'date')
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with open(LAYOUT_GOLDEN, encoding='utf-8') as f:
+            cls.golden = json.load(f)
+
+    def certificate(self, key):
+        company, case = key.split('/')
+        texts = self.golden['cases'][case]
+        seminar = Seminar(company=company, title=texts['title'], program=texts['program'],
+                          date_start=datetime.date(2025, 3, 1), date_end=datetime.date(2025, 3, 3))
+        return Certificate(seminar=seminar, full_name=texts['name'], order_number=1,
+                           certificate_number="№ 01-03032025")
+
+    def test_line_breaks_sizes_and_positions(self):
+        keys = [key for key, _, _ in utils.SEMINAR_FIELDS + utils.PARTICIPANT_FIELDS]
+        for key, expected in self.golden['layouts'].items():
+            fields = dict(zip(keys, utils.layout_certificate(self.certificate(key))))
+            layout = [[x, y, line, font.size] for field in self.FIELD_ORDER for x, y, line, font in fields[field][2]]
+            self.assertEqual(layout, expected, key)
+
+    def test_rendered_pixels(self):
+        for key, expected in self.golden['pixels'].items():
+            style = utils.get_style(key.split('/')[0])
+            layer = utils.render_text_layer(self.certificate(key))
+            digests = []
+            for template in ('tpl_clean', 'tpl_stamp'):
+                with utils.composed_template(style[template], layer) as image:
+                    digests.append(hashlib.md5(image.tobytes()).hexdigest())
+            self.assertEqual(digests, expected, key)
+
+
+@override_settings(CERTIFICATE_ASYNC_GENERATION=True, STORAGES=TEST_STORAGES)
+class DirtyTrackingTests(TestCase):
+    def setUp(self):
+        self.seminar = create_seminar(participants=3)
+        bulk.regenerate(self.seminar.certificates.all(), workers=1)
+        self.seminar = Seminar.objects.get(pk=self.seminar.pk)
+
+    def queued(self):
+        return set(GenerationJob.objects.filter(status=GenerationJob.STATUS_PENDING)
+                   .values_list('certificate_id', flat=True))
+
+    def test_seminar_edit_enqueues_only_stale(self):
+        self.assertFalse(self.queued())
+
+        # Поле, не влияющее на картинку
+        with self.captureOnCommitCallbacks(execute=True):
+            self.seminar.organization_name = "ООО Другое"
+            self.seminar.save()
+        self.assertFalse(self.queued())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.seminar.title = "Новое название"
+            self.seminar.save()
+        self.assertEqual(self.queued(), set(self.seminar.certificates.values_list('pk', flat=True)))
+
+        # Возврат названия: файлы снова соответствуют данным, новых задач нет
+        GenerationJob.objects.all().delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.seminar.title = "Семинар 1"
+            self.seminar.save()
+        self.assertFalse(self.queued())
+
+    def test_participant_edit_enqueues_itself(self):
+        cert = self.seminar.certificates.order_by('order_number').first()
+        cert.full_name = "Другое Имя"
+        cert.save()
+        self.assertEqual(self.queued(), {cert.pk})
+
+    def test_reconcile(self):
+        Certificate.objects.filter(pk=self.seminar.certificates.first().pk).update(render_key='')
+        Seminar.objects.filter(pk=self.seminar.pk).update(program="Другая программа")
+        call_command('reconcile_certificates', stdout=io.StringIO())
+        self.assertEqual(len(self.queued()), 3)
+
+
+@override_settings(CERTIFICATE_ASYNC_GENERATION=True, CERTIFICATE_LAZY_ARTIFACTS=True, STORAGES=TEST_STORAGES)
+class LazyArtifactTests(TestCase):
+    def setUp(self):
+        seminar = create_seminar(participants=1)
+        bulk.regenerate(seminar.certificates.all(), workers=1)
+        self.cert = seminar.certificates.get()
+
+    def test_only_web_pdf_rendered_eagerly(self):
+        self.assertTrue(self.cert.file_web)
+        self.assertFalse(self.cert.file_print)
+        self.assertFalse(self.cert.preview_image)
+        self.assertFalse(self.cert.needs_generation())
+
+    def test_preview_on_first_request(self):
+        url = f'/certificates/{self.cert.pk}/preview/'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.cert.refresh_from_db()
+        self.assertTrue(self.cert.preview_image)
+        self.assertEqual(response['Location'], self.cert.preview_image.url)
+
+        # Второй запрос отдаёт уже сохранённый файл
+        with mock.patch('core.models.generate_certificates') as render:
+            self.assertEqual(self.client.get(url)['Location'], self.cert.preview_image.url)
+        render.assert_not_called()
+
+    def test_thumbnails_render_with_preview(self):
+        response = self.client.get(f'/certificates/{self.cert.pk}/thumb/')
+        self.cert.refresh_from_db()
+        self.assertEqual(response['Location'], self.cert.thumbnail.url)
+        self.assertTrue(self.cert.preview_image and self.cert.thumbnail_jpeg)
+
+    def test_no_render_for_queued_or_failed(self):
+        url = f'/certificates/{self.cert.pk}/preview/'
+        with mock.patch('core.models.generate_certificates') as render:
+            for status in (Certificate.STATUS_PENDING, Certificate.STATUS_FAILED):
+                Certificate.objects.filter(pk=self.cert.pk).update(render_status=status)
+                self.assertEqual(self.client.get(url).status_code, 404)
+            Certificate.objects.filter(pk=self.cert.pk).update(render_status=Certificate.STATUS_DONE)
+            # Без ленивого режима недостающие файлы рисует только очередь
+            with self.settings(CERTIFICATE_LAZY_ARTIFACTS=False):
+                self.assertEqual(self.client.get(url).status_code, 404)
+        render.assert_not_called()
+        self.assertEqual(self.client.get('/certificates/0/preview/').status_code, 404)
+
+    def test_search_without_lazy_mode_shows_placeholder(self):
+        self.assertEqual(self.cert.preview_url, f'/certificates/{self.cert.pk}/preview/')
+        with self.settings(CERTIFICATE_LAZY_ARTIFACTS=False):
+            # Превью ещё не нарисовано, а по запросу его не рисуют: ссылка вела бы на 404
+            self.assertIsNone(self.cert.preview_url)
+            self.assertIsNone(self.cert.thumbnail_url)
+            content = self.client.get('/cse/', {'q': self.cert.seminar.organization_name}).content.decode()
+        self.assertIn('Нет фото', content)
+        self.assertNotIn(f'/certificates/{self.cert.pk}/', content)
+
+    def test_print_only_for_staff(self):
+        url = f'/certificates/{self.cert.pk}/print/'
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+
+@override_settings(CERTIFICATE_ASYNC_GENERATION=True, STORAGES=TEST_STORAGES)
+class BenchmarkTests(TestCase):
+    # Время и память зависят от машины и сверяются командой run_benchmarks; число запросов — нет
+    def test_search_queries_match_baseline(self):
+        benchmarks.build_registry(20, 3)
+        baseline = benchmarks.load_baseline()['results']
+        for case in benchmarks.search_cases(20):
+            self.assertEqual(benchmarks.measure(case, repeat=1)['queries'], baseline[case.name]['queries'], case.name)
+
+    def test_compare_reports_regressions(self):
+        base = {'median_ms': 100, 'py_peak_kb': 2048, 'rss_peak_kb': 10, 'queries': 2}
+        self.assertEqual(benchmarks.compare({'case': dict(base, median_ms=120, rss_peak_kb=900)}, {'case': base}, 0.25),
+                         [])
+        regressions = benchmarks.compare({'case': dict(base, median_ms=130, queries=3)}, {'case': base}, 0.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertEqual(benchmarks.compare({'case': dict(base, queries=1)}, {'case': base}, 0.25),
+                         ["case: запросов 1 вместо 2"])
+
+
+class RenderMemoryTests(TestCase):
+    def template_pixels(self, company):
+        return utils.load_template(utils.get_style(company)['tpl_stamp']).tobytes()
+
+    def test_peak_rss_within_budget(self):
+        for company, _ in Seminar.COMPANY_CHOICES:
+            cert = benchmarks.sample_certificate(company, long=True)
+            utils.generate_certificates(cert, backend='raster')  # шаблоны декодируются в кэш процесса
+            benchmarks.release_free_memory()
+            with benchmarks.PeakRSS() as rss:
+                self.assertTrue(all(utils.generate_certificates(cert, backend='raster')))
+            self.assertLess(rss.delta_kb, utils.RENDER_RSS_BUDGET_MB * 1024, company)
+
+    def test_cached_template_is_restored(self):
+        cert = benchmarks.sample_certificate('NIKA')
+        pristine = self.template_pixels('NIKA')
+        utils.generate_certificates(cert, backend='raster')
+        self.assertEqual(self.template_pixels('NIKA'), pristine)
+
+        # И после ошибки кодирования
+        with mock.patch('core.utils.encode_pdf', side_effect=OSError), self.assertLogs('core.utils', 'ERROR'):
+            self.assertEqual(utils.generate_certificates(cert, backend='raster'), utils.NO_FILES)
+        self.assertEqual(self.template_pixels('NIKA'), pristine)
+
+    def test_vector_background_stays_in_memory(self):
+        cert = benchmarks.sample_certificate('CSE')
+        with mock.patch('tempfile.mkstemp', side_effect=AssertionError):
+            utils.template_jpeg.cache_clear()
+            self.assertTrue(all(utils.generate_certificates(cert, backend='vector')))
+        page = fitz.open(stream=utils.generate_certificates(cert, backend='vector')[1].read())[0]
+        self.assertEqual(len(page.get_images()), 1)
+
+    def test_template_copy_waits_for_composition(self):
+        # Копия шаблона (фон векторного PDF) в другом потоке не должна захватить текст собираемого сертификата
+        cert = benchmarks.sample_certificate('NIKA')
+        pristine = self.template_pixels('NIKA')
+        with ThreadPoolExecutor(1) as pool:
+            with utils.composed_template(utils.get_style('NIKA')['tpl_stamp'], utils.render_text_layer(cert)):
+                copied = pool.submit(self.template_pixels, 'NIKA')
+                time.sleep(0.2)
+                self.assertFalse(copied.done())
+            self.assertEqual(copied.result(), pristine)
+
+
+@override_settings(CERTIFICATE_ASYNC_GENERATION=True, STORAGES=TEST_STORAGES)
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        caches['registry'].clear()
+        self.seminar = create_seminar(participants=2)
+        bulk.regenerate(self.seminar.certificates.all(), workers=1)
+
+    def test_search_serves_thumbnails(self):
+        cert = self.seminar.certificates.order_by('order_number').first()
+        self.assertEqual(Image.open(cert.thumbnail).size[0], utils.THUMBNAIL_WIDTH)
+        self.assertLess(cert.thumbnail.size * 10, cert.preview_image.size)
+
+        content = self.client.get('/cse/', {'q': self.seminar.organization_name}).content.decode()
+        self.assertIn(f'srcset="{cert.thumbnail.url} 240w"', content)
+        self.assertIn(f'src="{cert.thumbnail_jpeg.url}"', content)
+        self.assertIn(f'data-preview="{cert.preview_image.url}"', content)
+
+    def test_backfill_from_stored_preview(self):
+        rendered = {cert.pk: (cert.thumbnail.name, cert.thumbnail_jpeg.name) for cert in self.seminar.certificates.all()}
+        self.seminar.certificates.update(thumbnail='', thumbnail_jpeg='')
+        for names in rendered.values():
+            for name in names:
+                default_storage.delete(name)
+        # Старые сертификаты без миниатюр показывают в выдаче превью
+        self.assertIsNone(self.seminar.certificates.first().thumbnail_url)
+
+        with mock.patch('core.bulk.generate_certificates') as render:
+            call_command('backfill_thumbnails', stdout=io.StringIO())
+        render.assert_not_called()
+        # Имена те же, что дал бы рендер с тем же ключом: следующий рендер их не заменит
+        for cert in self.seminar.certificates.all():
+            self.assertEqual((cert.thumbnail.name, cert.thumbnail_jpeg.name), rendered[cert.pk])
+            self.assertEqual(Image.open(cert.thumbnail).size[0], utils.THUMBNAIL_WIDTH)
+        self.assertEqual(bulk.missing_thumbnails(Certificate.objects.all()).count(), 0)
+
+
+class StyleRegistryTests(TestCase):
+    def setUp(self):
+        self.addCleanup(styles.get_style.cache_clear)
+        self.addCleanup(utils._render_seminar_layer.cache_clear)
+
+    def manifest_with(self, company, **changes):
+        manifest = copy.deepcopy(styles.load_manifest())
+        entry = manifest[company]
+        spec = {**entry['versions'][str(entry['current'])], **changes}
+        entry['current'] = entry['current'] + 1
+        entry['versions'][str(entry['current'])] = spec
+        return manifest
+
+    def test_manifest_compiles(self):
+        for style in styles.all_styles():
+            self.assertTrue(os.path.isabs(style['font_main']))
+            self.assertEqual(utils.load_template(style['tpl_stamp']).size, style.size)
+        self.assertIs(styles.get_style('CSE'), styles.get_style('CSE'))
+
+    def test_compile_does_not_decode_templates(self):
+        # Ключ рендера считается в веб-процессе при каждом сохранении: пиксели шаблонов там не нужны
+        styles.get_style.cache_clear()
+        with mock.patch('core.styles.decode_template') as decode, mock.patch('PIL.Image.Image.load') as load:
+            utils.compute_render_key(benchmarks.sample_certificate('CSE'), 'raster')
+            styles.all_styles()
+        decode.assert_not_called()
+        load.assert_not_called()
+
+    def test_invalid_style_is_rejected(self):
+        spec = styles.load_manifest()['CSE']['versions']['1']
+        broken = [{'font_sec': 'missing.ttf'}, {'tpl_stamp': 'missing.png'},
+                  {'program': {**spec['program'], 'y_end': 10000}}, {'name': {**spec['name'], 'type': 'curved'}},
+                  {'color_text': [0, 0]}]
+        for changes in broken:
+            with self.assertRaises(ImproperlyConfigured, msg=changes):
+                styles.compile_style('CSE', 9, {**spec, **changes})
+
+    @override_settings(CERTIFICATE_ASYNC_GENERATION=True, STORAGES=TEST_STORAGES)
+    def test_certificates_record_template_version(self):
+        seminar = create_seminar(participants=1)
+        bulk.regenerate(seminar.certificates.all(), workers=1)
+        cert = seminar.certificates.get()
+        self.assertEqual(cert.template_version, 1)
+
+        # Та же раскладка под новым номером версии: файлы те же, версия записывается без перерендера
+        styles.get_style.cache_clear()
+        with mock.patch('core.styles.load_manifest', return_value=self.manifest_with('CSE')):
+            call_command('reconcile_certificates', stdout=io.StringIO())
+            cert.refresh_from_db()
+            self.assertEqual(cert.template_version, 2)
+            self.assertFalse(cert.is_stale())
+
+        # Новый дизайн меняет ключ рендера: сертификат перерисовывается и помечается новой версией
+        styles.get_style.cache_clear()
+        with mock.patch('core.styles.load_manifest', return_value=self.manifest_with('CSE', color_text=[0, 0, 90])):
+            self.assertTrue(cert.is_stale())
+            bulk.regenerate(seminar.certificates.all(), workers=1)
+            cert.refresh_from_db()
+            self.assertEqual(cert.template_version, 2)
+            self.assertFalse(cert.is_stale())
+
+
+def make_scan():
+    scan = io.BytesIO()
+    Image.new('RGB', (1240, 1754), (200, 220, 240)).save(scan, format='JPEG')
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_image(page.rect, stream=scan.getvalue())
+    return doc.tobytes()
+
+
+@override_settings(CERTIFICATE_ASYNC_GENERATION=True, STORAGES=TEST_STORAGES)
+class ManualUploadTests(TestCase):
+    def test_validation(self):
+        utils.validate_pdf(ContentFile(make_pdf("Скан"), 'scan.pdf'))
+        encrypted = fitz.open(stream=make_pdf("Скан")).tobytes(encryption=fitz.PDF_ENCRYPT_AES_256, user_pw='secret')
+        for data in (b'not a pdf', make_pdf("Скан")[:200], encrypted):
+            with self.assertRaises(ValidationError):
+                utils.validate_pdf(ContentFile(data, 'scan.pdf'))
+
+    def test_preview_is_rendered_by_worker(self):
+        cert = create_seminar(participants=0).certificates.create(full_name="Участник",
+                                                                  manual_upload=ContentFile(make_pdf("Скан"), 's.pdf'))
+        self.assertFalse(cert.preview_image)
+        self.assertEqual(cert.render_status, Certificate.STATUS_PENDING)
+
+        run_job(claim_next_job())
+        cert.refresh_from_db()
+        self.assertEqual(cert.render_status, Certificate.STATUS_DONE)
+        self.assertEqual(Image.open(cert.preview_image).size[0], utils.PREVIEW_WIDTH)
+        self.assertEqual(Image.open(cert.thumbnail).size[0], utils.THUMBNAIL_WIDTH)
+        self.assertEqual(cert.file_web.name, cert.manual_upload.name)
+
+    def test_scan_uses_embedded_jpeg(self):
+        with mock.patch('fitz.Page.get_pixmap') as rasterize:
+            preview, thumbnail, thumbnail_jpeg = utils.pdf_previews(ContentFile(make_scan(), 'scan.pdf'))
+        rasterize.assert_not_called()
+        self.assertEqual(Image.open(preview).size[0], utils.PREVIEW_WIDTH)
+        self.assertEqual(Image.open(thumbnail).format, 'WEBP')
+        self.assertEqual(Image.open(thumbnail_jpeg).size[0], utils.THUMBNAIL_WIDTH)
+
+        # Видимый текст поверх скана попадает в превью только при растеризации
+        doc = fitz.open(stream=make_scan())
+        doc[0].insert_text((72, 72), "Печать")
+        with mock.patch('core.utils.Image.open', wraps=Image.open) as decode:
+            self.assertTrue(all(utils.pdf_previews(ContentFile(doc.tobytes(), 'scan.pdf'))))
+        decode.assert_not_called()
+
+    def test_unusable_thumb_falls_back_to_rasterizing(self):
+        # /Thumb — однобитная маска (/ImageMask) без цветового пространства
+        doc = fitz.open(stream=make_pdf("Скан"))
+        width = utils.PREVIEW_WIDTH
+        xref = doc.get_new_xref()
+        doc.update_object(xref, f"<< /Type /XObject /Subtype /Image /Width {width} /Height 8 /ImageMask true "
+                                "/BitsPerComponent 1 >>")
+        doc.update_stream(xref, bytes(width))
+        doc.xref_set_key(doc[0].xref, 'Thumb', f"{xref} 0 R")
+        with self.assertNoLogs('core.utils', 'WARNING'):
+            preview, thumbnail, thumbnail_jpeg = utils.pdf_previews(ContentFile(doc.tobytes(), 'scan.pdf'))
+        self.assertEqual(Image.open(preview).size[0], utils.PREVIEW_WIDTH)
+        self.assertTrue(thumbnail and thumbnail_jpeg)
+
+        # Ошибка разбора в быстром пути — предупреждение в лог и растеризация, а не отказ
+        with mock.patch('core.utils._scan_image', side_effect=RuntimeError("битый поток")), \
+                self.assertLogs('core.utils', 'WARNING') as logs:
+            self.assertTrue(all(utils.pdf_previews(ContentFile(make_pdf("Скан"), 'scan.pdf'))))
+        self.assertIn('битый поток', logs.output[0])
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics._histograms.clear()
+
+    def test_render_stages_are_recorded_and_logged(self):
+        with self.assertLogs('core.metrics', 'INFO') as logs:
+            benchmarks.generate_certificates(benchmarks.sample_certificate('NIKA'), backend='raster')
+        self.assertIn('generate_certificates company=NIKA', logs.output[0])
+
+        stages = {stage for stage, company in metrics.snapshot() if company == 'NIKA'}
+        self.assertEqual(stages, {'generate_certificates', 'text_layer', 'print_pdf', 'web_pdf', 'preview'})
+
+    @override_settings(CERTIFICATE_ASYNC_GENERATION=True)
+    def test_render_error_reaches_log_and_job(self):
+        cert = create_seminar(participants=1).certificates.get()
+        job = claim_next_job()
+        with mock.patch('core.utils.encode_pdf', side_effect=OSError("диск переполнен")), \
+                self.assertLogs('core.utils', 'ERROR') as logs:
+            run_job(job)
+        self.assertIn('Traceback', logs.output[0])
+        job.refresh_from_db()
+        self.assertIn('OSError: диск переполнен', job.error)
+        self.assertEqual(job.certificate_id, cert.pk)
+
+    def test_histogram_buckets_are_cumulative(self):
+        metrics.observe('search_query', 0.02, 'CSE')
+        metrics.observe('search_query', 3, 'CSE')
+        text = metrics.render_prometheus()
+        self.assertIn('certificate_stage_seconds_bucket{stage="search_query",company="CSE",le="0.025"} 1', text)
+        self.assertIn('certificate_stage_seconds_bucket{stage="search_query",company="CSE",le="5.0"} 2', text)
+        self.assertIn('certificate_stage_seconds_count{stage="search_query",company="CSE"} 2', text)
+
+    def test_metrics_endpoint(self):
+        self.client.get('/cse/', {'q': 'Клиент'})
+        with self.settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'stage="search_view",company="CSE"', response.content)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_metrics_without_token_are_staff_only(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.client.force_login(User.objects.create_user('user', 'user@example.com', 'password'))
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    def test_dump_errors_are_logged(self):
+        with self.settings(CERTIFICATE_METRICS_DIR='/dev/null/metrics'), \
+                self.assertLogs('core.metrics', 'ERROR') as logs:
+            metrics.dump()
+        self.assertIn('Metrics Dump Error', logs.output[0])
+        self.assertIn('Traceback', logs.output[0])
@@ -1,7 +1,10 @@
 from django.urls import path
-from . import views
+from . import api, views
 
 urlpatterns = [
     path('cse/', views.cse_search, name='cse_search'),
     path('nika/', views.nika_search, name='nika_search'),
+    path('certificates/<int:pk>/<str:kind>/', views.certificate_file, name='certificate_file'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('api/<str:company>/verify/', api.verify, name='api_verify'),
 ]
\ No newline at end of file
@@ -1,291 +1,559 @@
+import hashlib
+import logging
+import math
 import os
+import django
 import fitz
+import tempfile
+import threading
+import traceback
 import uuid
+from contextlib import contextmanager
+from functools import lru_cache
 from io import BytesIO
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.files.base import File
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from . import metrics, vector
+from .styles import TEMPLATES_DIR, all_styles, decode_template, get_style
+from .storage import delete_files_later
+from .layout import (get_font, measure, text_width, text_height, fit_line, fit_block, LINE_SPACING,
+                     PARAGRAPH_SPACING)
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_WIDTH = 1000
+PREVIEW_REDUCING_GAP = 1.2
+# Миниатюры для выдачи поиска: .cert-thumb не шире 120 CSS-пикселей, вдвое — для плотных экранов
+THUMBNAIL_WIDTH = 240
+# Бюджет пика памяти (RSS) одного рендера сверх декодированных шаблонов в кэше процесса, МБ (см. тесты).
+# Полноразмерных копий листа рендер не делает: текст накладывается на шаблон из кэша (composed_template)
+RENDER_RSS_BUDGET_MB = 48
+
+
+# Декодированный шаблон из кэша процесса (styles.decode_template) — изменяемое общее состояние:
+# composed_template накладывает на него текст участника и восстанавливает после кодирования.
+# Любое чтение пикселей шаблона из кэша — только под _template_lock(path), иначе в копию попадёт чужой текст
+_template_locks = {}
+_template_locks_guard = threading.Lock()
+
+
+def _template_lock(path):
+    with _template_locks_guard:
+        return _template_locks.setdefault(path, threading.Lock())
+
+
+# Отдаём копию чистого шаблона: исходный остаётся в кэше процесса
+def load_template(template_name):
+    path = os.path.join(TEMPLATES_DIR, template_name)
+    if not os.path.exists(path): return None
+    image = decode_template(path)
+    with _template_lock(path):
+        return image.copy()
+
+
+# Прогрев кэшей в процессах, которые рендерят (run_generation_worker, процессы bulk): компиляция оформлений
+# проверяет манифест и загружает шрифты, а шаблоны декодируются только у текущих версий — старые рисуются редко
+def warm_render_caches():
+    all_styles()
+    for company, backend in getattr(settings, 'CERTIFICATE_PDF_BACKENDS', {}).items():
+        style = get_style(company)
+        for template in (style['tpl_clean'], style['tpl_stamp']):
+            decode_template(os.path.join(TEMPLATES_DIR, template))
+            if backend == 'vector':
+                template_jpeg(template)
+
+
+# Инициализатор процессов массового рендера (bulk._render_pool). Процесс из forkserver стартует с чистого
+# интерпретатора, без потоков и соединений родителя, поэтому сам поднимает Django и прогревает кэши
+def init_render_process():
+    django.setup()
+    warm_render_caches()
+
+
+# PDF до этого размера читается в память, крупнее (сканы) — копируется во временный файл,
+# который MuPDF читает с диска по мере надобности
+PDF_SPOOL_MAX = 4 * 1024 * 1024
+
+
+@contextmanager
+def spooled_pdf(file):
+    if file.closed:
+        file.open('rb')
+    # Загрузку, которую Django уже сохранил во временный файл, открываем прямо с диска
+    temporary_path = getattr(getattr(file, 'file', file), 'temporary_file_path', None)
+    if temporary_path:
+        doc = fitz.open(temporary_path(), filetype='pdf')
+    elif file.size <= PDF_SPOOL_MAX:
+        doc = fitz.open(stream=b''.join(file.chunks()), filetype='pdf')
+    else:
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as spool:
+            for chunk in file.chunks():
+                spool.write(chunk)
+            spool.flush()
+            with fitz.open(spool.name) as doc:
+                yield doc
+        return
+
+    with doc:
+        yield doc
+
+
+# Валидатор ручной загрузки: файл должен открываться как PDF с хотя бы одной страницей и без пароля
+def validate_pdf(file):
+    # Уже сохранённые файлы проверены при загрузке; иначе каждое сохранение скачивало бы их из хранилища
+    if getattr(file, '_committed', False): return
+    # Заголовок %PDF- по спецификации должен быть в первых 1024 байтах
+    if b'%PDF-' not in next(iter(file.chunks(1024)), b''):
+        raise ValidationError("Файл не является PDF.")
+    try:
+        with spooled_pdf(file) as doc:
+            if doc.needs_pass:
+                raise ValidationError("PDF защищён паролем.")
+            if not doc.page_count:
+                raise ValidationError("В PDF нет страниц.")
+            doc.load_page(0)
+    except ValidationError:
+        raise
+    except Exception as e:
+        raise ValidationError(f"Не удалось прочитать PDF: {e}")
+
+
+def _page_size(page, width):
+    return width, max(1, round(width * page.rect.height / page.rect.width))
+
+
+# Миниатюра страницы /Thumb, если она не меньше нужной ширины. Маски (/ImageMask) и прочие миниатюры
+# без цветового пространства не годятся — страница растеризуется
+def _thumb_image(doc, page, width):
+    kind, value = doc.xref_get_key(page.xref, 'Thumb')
+    if kind != 'xref': return None
+    thumb = fitz.Pixmap(doc, int(value.split()[0]))
+    # У маски нет цветовых каналов (n == alpha), а colorspace у неё — пустая обёртка, а не None
+    if thumb.width < width or thumb.colorspace is None or thumb.n == thumb.alpha: return None
+    if thumb.alpha or thumb.colorspace.n != 3:
+        thumb = fitz.Pixmap(fitz.csRGB, thumb, 0)
+    return Image.frombytes('RGB', (thumb.width, thumb.height), thumb.samples)
+
+
+# Скан: единственный JPEG на всю страницу без текста и графики поверх
+def _scan_image(doc, page, width):
+    if page.rotation or page.first_annot or page.get_drawings(): return None
+    # get_image_info(xrefs=True) декодирует картинки ради хешей, поэтому xref берём из ресурсов страницы
+    placements, resources = page.get_image_info(), page.get_images(full=True)
+    if len(placements) != 1 or len(resources) != 1: return None
+    a, b, c, d, _, _ = placements[0]['transform']
+    if b or c or a <= 0 or d <= 0: return None
+    bbox = fitz.Rect(placements[0]['bbox'])
+    if any(abs(edge) > 2 for edge in (bbox.x0 - page.rect.x0, bbox.y0 - page.rect.y0,
+                                      bbox.x1 - page.rect.x1, bbox.y1 - page.rect.y1)): return None
+    # Невидимый текст (режим 3) — OCR-слой скана, он на картинку не влияет
+    if any(span['type'] != 3 for span in page.get_texttrace()): return None
+
+    # Поток DCTDecode — это готовый JPEG-файл; берём его как есть, без декодирования в MuPDF
+    xref, smask, *_, image_filter, _ = resources[0]
+    if (image_filter != 'DCTDecode' or smask or placements[0]['colorspace'] != 3
+            or doc.xref_get_key(xref, 'Decode')[0] != 'null'):
+        return None
+    image = Image.open(BytesIO(doc.xref_stream_raw(xref)))
+    # DCT-масштабирование: JPEG сразу декодируется в 1/2–1/8 размера, полный скан в память не попадает
+    image.draft('RGB', _page_size(page, width))
+    return image.convert('RGB')
+
+
+# Готовая картинка страницы вместо растеризации. Быстрый путь не должен ронять превью: на любой ошибке
+# разбора (нестандартная миниатюра, битый поток) страница просто растеризуется
+def embedded_page_image(doc, page, width):
+    for extract in (_thumb_image, _scan_image):
+        try:
+            image = extract(doc, page, width)
+        except Exception:
+            logger.warning("PDF Embedded Image Error, растеризуем страницу", exc_info=True)
+            image = None
+        if image is not None:
+            return image
+    return None
+
+
+# Превью и миниатюры ручной загрузки: первая страница сразу в ширину превью, а не в фиксированном масштабе.
+# Возвращает (превью, миниатюра WebP, миниатюра JPEG)
+def pdf_previews(pdf_file_field):
+    try:
+        with metrics.timed('pdf_to_jpg'), spooled_pdf(pdf_file_field) as doc:
+            page = doc.load_page(0)
+            image = embedded_page_image(doc, page, PREVIEW_WIDTH)
+            if image is None:
+                scale = PREVIEW_WIDTH / page.rect.width
+                pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False, colorspace=fitz.csRGB)
+                image = Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+            if image.size != _page_size(page, PREVIEW_WIDTH):
+                image = image.resize(_page_size(page, PREVIEW_WIDTH), Image.Resampling.LANCZOS)
+
+            name = uuid.uuid4().hex[:8]
+            buf_preview, buf_webp, buf_jpeg = encode_previews(image)
+            return (encoded_file(buf_preview, f"preview_manual_{name}.jpg"),
+                    encoded_file(buf_webp, f"thumb_manual_{name}.webp"),
+                    encoded_file(buf_jpeg, f"thumb_manual_{name}.jpg"))
+    except Exception:
+        logger.exception("PDF Convert Error: %s", getattr(pdf_file_field, 'name', ''))
+        return None, None, None
 
 
-def get_font(path, size):
-    try:
-        return ImageFont.truetype(path, size)
-    except:
-        return ImageFont.load_default()
+# Нормализация для поисковых колонок (Seminar/Certificate *_search) и поисковых запросов
+def normalize_text(value):
+    return ' '.join(str(value or '').split()).casefold()
 
 
-def pdf_to_jpg(pdf_file_field):
-    try:
-        if pdf_file_field.closed:
-            pdf_file_field.open()
-        pdf_data = pdf_file_field.read()
-        doc = fitz.open(stream=pdf_data, filetype="pdf")
-        page = doc.load_page(0)
-        pix = page.get_pixmap(matrix=fitz.Matrix(1.5, 1.5))
-        img_data = pix.tobytes("jpg")
-        return ContentFile(img_data, name=f"preview_manual_{uuid.uuid4().hex[:8]}.jpg")
-    except Exception as e:
-        print(f"PDF Convert Error: {e}")
-        return None
+def normalize_code(value):
+    return ''.join(str(value or '').split()).casefold()
 
 
-def wrap_text(text, font, max_width, draw):
-    lines = []
-    words = text.split(' ')
-    current_line = []
-    for word in words:
-        test_line = ' '.join(current_line + [word])
-        bbox = draw.textbbox((0, 0), test_line, font=font)
-        if (bbox[2] - bbox[0]) <= max_width:
-            current_line.append(word)
+def normalize_number(value, prefixes=('№',)):
+    value = str(value or '')
+    for prefix in prefixes:
+        value = value.replace(prefix, '')
+    return normalize_code(value)
+
+
+# Удаляет старые версии файлов после перегенерации (в фоне, пачками DeleteObjects);
+# keep — имена, на которые уже ссылается запись
+def delete_stored_files(names, keep=()):
+    return delete_files_later([name for name in names if name and name not in keep])
+
+
+# Раскладка поля — список (x, y, строка, шрифт) в пикселях шаблона.
+# По ней рисуют оба PDF-бэкенда: растровый (маски PIL) и векторный (reportlab)
+def layout_field(img_w, text, key, cfg, font_path):
+    if not text: return []
+    ops = []
+
+    # 1. ONE LINE
+    if cfg['type'] == 'autofit_one_line':
+        final_font = fit_line(text, font_path, cfg)
+        bbox = measure(final_font, text)
+        text_w = bbox[2] - bbox[0]
+        text_h = bbox[3] - bbox[1]
+        x = (img_w - text_w) / 2
+        y = cfg['y_center'] - (text_h / 2)
+        ops.append((x, y, text, final_font))
+
+    elif cfg['type'] == 'autofit':
+        final_font, final_structure, final_h = fit_block(text, font_path, cfg)
+        max_h = cfg['y_end'] - cfg['y_start']
+
+        if key == 'program':
+            start_y = cfg['y_start']
         else:
-            if current_line:
-                lines.append(' '.join(current_line))
-                current_line = [word]
-            else:
-                lines.append(word)
-    if current_line:
-        lines.append(' '.join(current_line))
-    return lines
-
-
-def generate_certificates(certificate):
-    ASSETS_DIR = os.path.join(settings.BASE_DIR, 'assets')
-    company = certificate.seminar.company
+            start_y = cfg['y_start'] + (max_h - final_h) / 2
 
-    font_times = os.path.join(ASSETS_DIR, 'fonts', 'times.ttf')
-    font_times_bold = os.path.join(ASSETS_DIR, 'fonts', 'timesbd.ttf')
-    font_montserrat = os.path.join(ASSETS_DIR, 'fonts', 'Montserrat-Bold.ttf')
-    font_roboto = os.path.join(ASSETS_DIR, 'fonts', 'Roboto.ttf')
-
-    if company == 'CSE':
-        tpl_clean = 'template_cse_clean.png'
-        tpl_stamp = 'template_cse_stamp.png'
-
-        style = {
-            'font_main': font_times,
-            'font_title': font_times_bold,
-            'font_sec': font_times,
-            'color_title': (180, 0, 0),
-            'color_text': (0, 0, 0),
-
-            'name': {
-                'type': 'autofit',
-                'align': 'center',
-                'y_start': 465, 'y_end': 655,
-                'max_width': 1550, 'max_size': 110, 'min_size': 50
-            },
-            'title': {
-                'type': 'autofit',
-                'align': 'center',
-                'y_start': 860, 'y_end': 1185,
-                'max_width': 2200, 'max_size': 90, 'min_size': 40
-            },
-            'program': {
-                'type': 'autofit',
-                'align': 'left',
-                'y_start': 1370, 'y_end': 2685,
-                'max_width': 2200, 'max_size': 60, 'min_size': 25
-            },
-            'number': {'type': 'simple', 'y': 2975, 'x': 120, 'size': 50},
-            'date': {'type': 'simple', 'y': 3095, 'x': 60, 'size': 50},
-        }
-    else:
-        tpl_clean = 'template_nika_clean.png'
-        tpl_stamp = 'template_nika_stamp.png'
-
-        style = {
-            'font_main': font_montserrat,
-            'font_title': font_montserrat,
-            'font_sec': font_roboto,
-            'color_title': (0, 64, 153),
-            'color_text': (50, 50, 50),
-
-            'name': {
-                'type': 'autofit_one_line',
-                'y_center': 480,
-                'max_width': 1700,
-                'max_size': 130,
-                'min_size': 40
-            },
-            'title': {
-                'type': 'autofit',
-                'align': 'center',
-                'y_start': 770, 'y_end': 1155,
-                'max_width': 2300, 'max_size': 90, 'min_size': 40
-            },
-            'program': {
-                'type': 'autofit',
-                'align': 'left',
-                'y_start': 1300, 'y_end': 2840,
-                'max_width': 2300, 'max_size': 60, 'min_size': 25
-            },
-            'number': {'type': 'simple', 'y': 3030, 'x': 160, 'size': 50},
-            'date': {'type': 'simple', 'y': 3097, 'x': 230, 'size': 50},
-        }
-
-    def process_image(template_name):
-        path = os.path.join(ASSETS_DIR, 'templates', template_name)
-        if not os.path.exists(path): return None
-
-        image = Image.open(path).convert('RGB')
-        draw = ImageDraw.Draw(image)
-        img_w, img_h = image.size
-
-        def draw_field(text, key, font_path, color):
-            if not text: return
-            cfg = style[key]
-
-            # 1. ONE LINE
-            if cfg['type'] == 'autofit_one_line':
-                current_size = cfg['max_size']
-                min_size = cfg['min_size']
-                max_w = cfg['max_width']
-                final_font = None
-                while current_size >= min_size:
-                    font = get_font(font_path, current_size)
-                    bbox = draw.textbbox((0, 0), text, font=font)
-                    if (bbox[2] - bbox[0]) <= max_w:
-                        final_font = font
-                        break
-                    current_size -= 2
-                if not final_font: final_font = get_font(font_path, min_size)
-
-                bbox = draw.textbbox((0, 0), text, font=final_font)
-                text_w = bbox[2] - bbox[0]
-                text_h = bbox[3] - bbox[1]
-                x = (img_w - text_w) / 2
-                y = cfg['y_center'] - (text_h / 2)
-                draw.text((x, y), text, font=final_font, fill=color)
-
-            elif cfg['type'] == 'autofit':
-                current_size = cfg['max_size']
-                min_size = cfg['min_size']
-                max_h = cfg['y_end'] - cfg['y_start']
-
-                raw_paragraphs = str(text).replace('\r\n', '\n').split('\n')
-
-                line_spacing = 13
-                paragraph_spacing = 13
-
-                final_font = None
-                final_structure = []
-                final_h = 0
-
-                while current_size >= min_size:
-                    font = get_font(font_path, current_size)
-                    temp_structure = []
-                    total_h = 0
-
-                    for para in raw_paragraphs:
-                        if not para.strip(): continue
-                        lines = wrap_text(para, font, cfg['max_width'], draw)
-                        temp_structure.append(lines)
-
-                        for line in lines:
-                            bbox = draw.textbbox((0, 0), line, font=font)
-                            total_h += (bbox[3] - bbox[1]) + line_spacing
-
-                        total_h += paragraph_spacing
-
-                    if total_h > 0: total_h -= paragraph_spacing
-
-                    if total_h <= max_h:
-                        final_font = font
-                        final_structure = temp_structure
-                        final_h = total_h
-                        break
-                    current_size -= 2
-
-                if not final_font:
-                    final_font = get_font(font_path, min_size)
-                    final_structure = []
-                    final_h = 0
-                    for para in raw_paragraphs:
-                        if not para.strip(): continue
-                        lines = wrap_text(para, final_font, cfg['max_width'], draw)
-                        final_structure.append(lines)
-                        for line in lines:
-                            bbox = draw.textbbox((0, 0), line, final_font)
-                            final_h += (bbox[3] - bbox[1]) + line_spacing
-                        final_h += paragraph_spacing
-                    if final_h > 0: final_h -= paragraph_spacing
-
-                if key == 'program':
-                    start_y = cfg['y_start']
+        max_line_w = 0
+        for group in final_structure:
+            for line in group:
+                w = text_width(final_font, line)
+                if w > max_line_w: max_line_w = w
+
+        block_start_x = (img_w - max_line_w) / 2
+
+        curr_y = start_y
+        for group in final_structure:
+            for line in group:
+                line_w = text_width(final_font, line)
+
+                if cfg['align'] == 'center':
+                    draw_x = (img_w - line_w) / 2
                 else:
-                    start_y = cfg['y_start'] + (max_h - final_h) / 2
+                    draw_x = block_start_x
 
-                max_line_w = 0
-                for group in final_structure:
-                    for line in group:
-                        bbox = draw.textbbox((0, 0), line, font=final_font)
-                        w = bbox[2] - bbox[0]
-                        if w > max_line_w: max_line_w = w
+                ops.append((draw_x, curr_y, line, final_font))
+                curr_y += text_height(final_font, line) + LINE_SPACING
 
-                block_start_x = (img_w - max_line_w) / 2
+            curr_y += PARAGRAPH_SPACING
 
-                curr_y = start_y
-                for group in final_structure:
-                    for line in group:
-                        bbox = draw.textbbox((0, 0), line, font=final_font)
-                        line_w = bbox[2] - bbox[0]
+    elif cfg['type'] == 'simple':
+        font = get_font(font_path, cfg['size'])
+        ops.append((cfg['x'], cfg['y'], str(text), font))
 
-                        if cfg['align'] == 'center':
-                            draw_x = (img_w - line_w) / 2
-                        else:
-                            draw_x = block_start_x
+    return ops
 
-                        draw.text((draw_x, curr_y), line, font=final_font, fill=color)
-                        curr_y += (bbox[3] - bbox[1]) + line_spacing
 
-                    curr_y += paragraph_spacing
+SEMINAR_FIELDS = (('title', 'font_title', 'color_title'), ('program', 'font_sec', 'color_text'),
+                  ('date', 'font_sec', 'color_text'))
+PARTICIPANT_FIELDS = (('name', 'font_main', 'color_text'), ('number', 'font_sec', 'color_text'))
 
-            elif cfg['type'] == 'simple':
-                font = get_font(font_path, cfg['size'])
-                draw.text((cfg['x'], cfg['y']), str(text), font=font, fill=color)
 
-        draw_field(certificate.full_name, 'name', style['font_main'], style['color_text'])
-        draw_field(certificate.seminar.title, 'title', style['font_title'], style['color_title'])
-        draw_field(certificate.seminar.program, 'program', style['font_sec'], style['color_text'])
-        clean_num = certificate.certificate_number.replace('№', '').strip()
-        draw_field(clean_num, 'number', style['font_sec'], style['color_text'])
-        s_date = certificate.seminar.date_start.strftime('%d.%m.%Y')
+# Элемент раскладки сертификата: (цвет, путь к шрифту, раскладка поля)
+def layout_fields(style, img_w, fields, values):
+    return [(style[color_key], style[font_key], layout_field(img_w, values[key], key, style[key], style[font_key]))
+            for key, font_key, color_key in fields]
 
-        if certificate.seminar.date_end:
-            s_date += f" - {certificate.seminar.date_end.strftime('%d.%m.%Y')}"
-        draw_field(s_date, 'date', style['font_sec'], style['color_text'])
 
-        return image
+def format_seminar_dates(seminar):
+    s_date = seminar.date_start.strftime('%d.%m.%Y')
+    if seminar.date_end:
+        s_date += f" - {seminar.date_end.strftime('%d.%m.%Y')}"
+    return s_date
 
-    try:
-        unique_suffix = uuid.uuid4().hex[:8]
 
-        img_clean = process_image(tpl_clean)
-        if not img_clean: return None, None, None
+# Общая для всех участников часть: название + программа + даты.
+# Ключ кэша — содержимое семинара и версия оформления, так что правка семинара или смена дизайна дают новый слой.
+SEMINAR_LAYER_CACHE_SIZE = getattr(settings, 'CERTIFICATE_SEMINAR_LAYER_CACHE_SIZE', 4)
 
-        buf_print = BytesIO()
-        img_clean.save(buf_print, format='PDF', resolution=300.0)
-        file_print = ContentFile(buf_print.getvalue(), f"print_{certificate.certificate_number}_{unique_suffix}.pdf")
 
-        img_stamp = process_image(tpl_stamp)
-        if not img_stamp: return None, None, None
+@lru_cache(maxsize=SEMINAR_LAYER_CACHE_SIZE)
+def _layout_seminar(company, version, title, program, s_date):
+    style = get_style(company, version)
+    return layout_fields(style, style.size[0], SEMINAR_FIELDS, {'title': title, 'program': program, 'date': s_date})
 
-        buf_web = BytesIO()
-        img_stamp.save(buf_web, format='PDF', resolution=300.0)
-        file_web = ContentFile(buf_web.getvalue(), f"web_{certificate.certificate_number}_{unique_suffix}.pdf")
 
-        base_width = 1000
-        w_percent = (base_width / float(img_stamp.size[0]))
-        h_size = int((float(img_stamp.size[1]) * float(w_percent)))
-        img_preview = img_stamp.resize((base_width, h_size), Image.Resampling.LANCZOS)
+def layout_seminar(seminar):
+    return _layout_seminar(seminar.company, get_style(seminar.company).version, seminar.title, seminar.program,
+                           format_seminar_dates(seminar))
 
-        buf_jpg = BytesIO()
-        img_preview.save(buf_jpg, format='JPEG', quality=85)
-        file_preview = ContentFile(buf_jpg.getvalue(), f"preview_{certificate.certificate_number}_{unique_suffix}.jpg")
 
-        return file_print, file_web, file_preview
+def layout_participant(certificate):
+    style = get_style(certificate.seminar.company)
+    clean_num = certificate.certificate_number.replace('№', '').strip()
+    return layout_fields(style, style.size[0], PARTICIPANT_FIELDS, {'name': certificate.full_name, 'number': clean_num})
 
-    except Exception as e:
-        print(f"Gen Error: {e}")
-        return None, None, None
+
+def layout_certificate(certificate):
+    seminar_layout = layout_seminar(certificate.seminar)
+    if seminar_layout is None: return None
+    return seminar_layout + layout_participant(certificate)
+
+
+# Растровый текст рисуется один раз в маски покрытия и затем заливается цветом поверх обоих шаблонов —
+# чистого и с печатью. Это то же смешивание, что делает draw.text на RGB. Маска каждого поля
+# обрезается по тексту, чтобы наложение не проходило по всей странице.
+def render_masks(size, layout):
+    layer = []
+    for color, font_path, ops in layout:
+        # Маска рисуется только в пределах рамки текста, а не на весь лист: сдвиг на целые пиксели
+        # даёт те же пиксели, а лишние 8–9 МБ на поле не выделяются. Точка начала строки входит в рамку:
+        # при отрицательных дробных координатах Pillow округляет иначе
+        boxes = [(x + min(left, 0), y + min(top, 0), x + right, y + bottom)
+                 for x, y, line, font in ops for left, top, right, bottom in [font.getbbox(line)]]
+        if not boxes: continue
+        left = max(0, math.floor(min(box[0] for box in boxes)) - 1)
+        top = max(0, math.floor(min(box[1] for box in boxes)) - 1)
+        right = min(size[0], math.ceil(max(box[2] for box in boxes)) + 1)
+        bottom = min(size[1], math.ceil(max(box[3] for box in boxes)) + 1)
+        if left >= right or top >= bottom: continue
+
+        mask = Image.new('L', (right - left, bottom - top), 0)
+        draw = ImageDraw.Draw(mask)
+        for x, y, line, font in ops:
+            draw.text((x - left, y - top), line, font=font, fill=255)
+        box = mask.getbbox()
+        if box:
+            layer.append((color, (box[0] + left, box[1] + top, box[2] + left, box[3] + top), mask.crop(box)))
+    return layer
+
+
+def apply_text_layer(image, layer):
+    for color, box, mask in layer:
+        image.paste(color, box, mask)
+    return image
+
+
+# Текст накладывается прямо на декодированный шаблон из кэша процесса, а после кодирования участки под текстом
+# восстанавливаются из вырезок. Копия листа (~35 МБ на шаблон) не создаётся; пока шаблон собран,
+# другие потоки процесса ждут его на блокировке
+@contextmanager
+def composed_template(template_name, layer):
+    path = os.path.join(TEMPLATES_DIR, template_name)
+    if not os.path.exists(path):
+        yield None
+        return
+
+    image = decode_template(path)
+    with _template_lock(path):
+        # Вырезки снимаются до наложения, поэтому восстанавливать их можно в любом порядке
+        saved = [(box, image.crop(box)) for _, box, _ in layer]
+        try:
+            yield apply_text_layer(image, layer)
+        finally:
+            for box, crop in saved:
+                image.paste(crop, box)
+
+
+# Буфер кодировщика уходит в хранилище как есть, без копии через getvalue()
+def encoded_file(buf, name):
+    buf.seek(0)
+    return File(buf, name)
+
+
+def encode_pdf(image):
+    buf = BytesIO()
+    image.save(buf, format='PDF', resolution=300.0)
+    return buf
+
+
+def downscale(image, width):
+    height = int(image.size[1] * (width / image.size[0]))
+    # reducing_gap: сначала целочисленное уменьшение листа (reduce), и LANCZOS работает уже с ним —
+    # промежуточные изображения в разы меньше полноразмерных
+    return image.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=PREVIEW_REDUCING_GAP)
+
+
+def encode_image(image, format, **params):
+    buf = BytesIO()
+    image.save(buf, format=format, **params)
+    return buf
+
+
+# Миниатюры (WebP и JPEG для браузеров без WebP) уменьшаются из готового превью, а не из листа
+def encode_thumbnails(preview):
+    thumbnail = downscale(preview, THUMBNAIL_WIDTH)
+    return encode_image(thumbnail, 'WEBP', quality=80, method=2), encode_image(thumbnail, 'JPEG', quality=80)
+
+
+# Превью и миниатюры из одного уменьшения листа: (превью JPEG, миниатюра WebP, миниатюра JPEG)
+def encode_previews(image):
+    preview = image if image.size[0] == PREVIEW_WIDTH else downscale(image, PREVIEW_WIDTH)
+    return (encode_image(preview, 'JPEG', quality=85), *encode_thumbnails(preview))
+
+
+@lru_cache(maxsize=SEMINAR_LAYER_CACHE_SIZE)
+def _render_seminar_layer(company, version, title, program, s_date):
+    seminar_layout = _layout_seminar(company, version, title, program, s_date)
+    if seminar_layout is None: return None
+    return render_masks(get_style(company, version).size, seminar_layout)
+
+
+def render_text_layer(certificate):
+    seminar = certificate.seminar
+    style = get_style(seminar.company)
+    seminar_layer = _render_seminar_layer(seminar.company, style.version, seminar.title, seminar.program,
+                                          format_seminar_dates(seminar))
+    if seminar_layer is None: return None
+
+    return seminar_layer + render_masks(style.size, layout_participant(certificate))
+
+
+@lru_cache(maxsize=16)
+def template_jpeg(template_name):
+    # Фон векторного PDF: кодируется в JPEG один раз на процесс и хранится в памяти. reportlab вставляет JPEG
+    # в PDF как есть (DCTDecode), без декодирования и перекодирования
+    image = load_template(template_name)
+    if not image: return None
+    return vector.JPEGImage(encode_image(image, 'JPEG', quality=85).getvalue())
+
+
+def get_pdf_backend(company):
+    return getattr(settings, 'CERTIFICATE_PDF_BACKENDS', {}).get(company, 'raster')
+
+
+# Сгенерированные файлы адресуются хешем входных данных рендера. Одинаковые входы дают те же имена,
+# поэтому неизменившийся сертификат не рендерится и не загружается повторно, а файлы в хранилище
+# служат кэшем рендера между деплоями. RENDER_VERSION поднимать при любой правке кода рендера,
+# меняющей результат (раскладка, DPI, качество JPEG): шаблоны, шрифты и стиль учитываются сами.
+RENDER_VERSION = 2
+ARTIFACT_FIELDS = (('file_print', 'print', 'pdf'), ('file_web', 'web', 'pdf'), ('preview_image', 'preview', 'jpg'),
+                   ('thumbnail', 'thumb', 'webp'), ('thumbnail_jpeg', 'thumb', 'jpg'))
+# Превью и миниатюры рендерятся вместе, из одного уменьшения листа
+PREVIEW_FIELDS = ('preview_image', 'thumbnail', 'thumbnail_jpeg')
+NO_FILES = (None,) * len(ARTIFACT_FIELDS)
+
+
+def compute_render_key(certificate, backend=None):
+    seminar = certificate.seminar
+    backend = backend or get_pdf_backend(seminar.company)
+    # Стиль и содержимое шаблонов и шрифтов — готовой частью из скомпилированного оформления
+    payload = repr((RENDER_VERSION, backend, *get_style(seminar.company).key_parts,
+                    seminar.title, seminar.program, format_seminar_dates(seminar),
+                    certificate.full_name, certificate.certificate_number))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+def artifact_filenames(certificate, key):
+    return [f"{prefix}_{certificate.certificate_number}_{key}.{ext}" for _, prefix, ext in ARTIFACT_FIELDS]
+
+
+# Имена в хранилище (с upload_to), под которыми лежат файлы для данного ключа
+def artifact_names(certificate, key):
+    return [certificate._meta.get_field(field).generate_filename(certificate, filename)
+            for (field, _, _), filename in zip(ARTIFACT_FIELDS, artifact_filenames(certificate, key))]
+
+
+ARTIFACT_FIELD_NAMES = tuple(field for field, _, _ in ARTIFACT_FIELDS)
+
+
+# Что рендерится при сохранении. В ленивом режиме (CERTIFICATE_LAZY_ARTIFACTS) — только PDF для клиента,
+# а печатный PDF и превью рисуются при первом запросе (views.certificate_file)
+def eager_fields():
+    if getattr(settings, 'CERTIFICATE_LAZY_ARTIFACTS', False):
+        return ('file_web',)
+    return ARTIFACT_FIELD_NAMES
+
+
+# {поле: имя} уже отрендеренных файлов, если все запрошенные лежат в хранилище, иначе None.
+# Совпадение имён в полях принимается без запроса к хранилищу (сохранение, отдача файлов); verify — явная
+# перегенерация и очередь: существование проверяется всегда, и пропавший из хранилища объект рисуется заново
+def stored_artifacts(certificate, fields=ARTIFACT_FIELD_NAMES, backend=None, verify=False):
+    names = dict(zip(ARTIFACT_FIELD_NAMES, artifact_names(certificate, compute_render_key(certificate, backend))))
+    names = {field: names[field] for field in fields}
+    if not verify and all(getattr(certificate, field).name == name for field, name in names.items()):
+        return names
+    if all(default_storage.exists(name) for name in names.values()):
+        return names
+    return None
+
+
+# Возвращает файлы в порядке ARTIFACT_FIELDS (print, web, превью, миниатюры); поля не из fields — None
+def generate_certificates(certificate, backend=None, fields=ARTIFACT_FIELD_NAMES):
+    company = certificate.seminar.company
+    style = get_style(company)
+    backend = backend or get_pdf_backend(company)
+
+    try:
+        with metrics.trace('generate_certificates', company, number=certificate.certificate_number, backend=backend):
+            name_print, name_web, *names_preview = artifact_filenames(certificate,
+                                                                      compute_render_key(certificate, backend))
+            file_print = file_web = None
+            files_preview = [None] * len(PREVIEW_FIELDS)
+            wants_preview = any(field in fields for field in PREVIEW_FIELDS)
+
+            with metrics.timed('text_layer', company):
+                layer = render_text_layer(certificate)
+                if layer is None: return NO_FILES
+                layout = layout_certificate(certificate) if backend == 'vector' else None
+
+            if 'file_print' in fields:
+                with metrics.timed('print_pdf', company):
+                    if backend == 'vector':
+                        buf_print = vector.render_pdf(template_jpeg(style['tpl_clean']), style.size, layout)
+                    else:
+                        with composed_template(style['tpl_clean'], layer) as img_clean:
+                            if not img_clean: return NO_FILES
+                            buf_print = encode_pdf(img_clean)
+                    file_print = encoded_file(buf_print, name_print)
+
+            if 'file_web' in fields and backend == 'vector':
+                with metrics.timed('web_pdf', company):
+                    buf_web = vector.render_pdf(template_jpeg(style['tpl_stamp']), style.size, layout)
+                    file_web = encoded_file(buf_web, name_web)
+
+            # Растровому PDF для клиента и превью нужен шаблон с печатью; кодируем оба, пока он собран
+            if wants_preview or (file_web is None and 'file_web' in fields):
+                with composed_template(style['tpl_stamp'], layer) as img_stamp:
+                    if not img_stamp: return NO_FILES
+
+                    if file_web is None and 'file_web' in fields:
+                        with metrics.timed('web_pdf', company):
+                            file_web = encoded_file(encode_pdf(img_stamp), name_web)
+
+                    if wants_preview:
+                        with metrics.timed('preview', company):
+                            files_preview = [encoded_file(buf, name) if field in fields else None for field, buf, name
+                                             in zip(PREVIEW_FIELDS, encode_previews(img_stamp), names_preview)]
+
+            return file_print, file_web, *files_preview
+
+    except Exception:
+        # Трейсбек — в лог и в сам сертификат: run_job запишет его в GenerationJob.error
+        logger.exception("Gen Error: %s", certificate.certificate_number)
+        certificate.render_error = traceback.format_exc()
+        return NO_FILES
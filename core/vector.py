@@ -0,0 +1,58 @@
+import hashlib
+import os
+from functools import lru_cache
+from io import BytesIO
+from reportlab import rl_config
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+DPI = 300.0
+PT_PER_PX = 72.0 / DPI
+
+# Без C-ускорителя reportlab кодирует ASCII85 на чистом Python — для фона в сотни КБ это секунды
+rl_config.useA85 = 0
+
+
+@lru_cache(maxsize=None)
+def register_font(font_path):
+    # reportlab встраивает в PDF только использованные глифы (subset)
+    name = 'cert-' + os.path.splitext(os.path.basename(font_path))[0]
+    pdfmetrics.registerFont(TTFont(name, font_path))
+    return name
+
+
+# Фон из памяти без временного файла. drawImage принимает объект как "имя файла" (ImageReader декодировал бы
+# весь JPEG ради ключа повторного использования), а PDFImageXObject по jpeg_fh() вставляет байты как есть (DCTDecode)
+class JPEGImage:
+    def __init__(self, data):
+        self.data = data
+        self.name = hashlib.md5(data).hexdigest()
+
+    def jpeg_fh(self):
+        return BytesIO(self.data)
+
+    def __str__(self):
+        return self.name
+
+
+# background — JPEGImage шаблона, size — размер шаблона в пикселях, layout — раскладка из utils.layout_certificate
+def render_pdf(background, size, layout):
+    buf = BytesIO()
+    page_w, page_h = size[0] * PT_PER_PX, size[1] * PT_PER_PX
+
+    pdf = canvas.Canvas(buf, pagesize=(page_w, page_h))
+    pdf.drawImage(background, 0, 0, width=page_w, height=page_h)
+
+    for color, font_path, ops in layout:
+        pdf.setFillColorRGB(*(c / 255 for c in color))
+        font_name = register_font(font_path)
+        for x, y, line, font in ops:
+            # PIL рисует от линии верхних выносных (anchor 'la'), reportlab — от базовой линии
+            ascent = font.getmetrics()[0]
+            pdf.setFont(font_name, font.size * PT_PER_PX)
+            pdf.drawString(x * PT_PER_PX, page_h - (y + ascent) * PT_PER_PX, line)
+
+    pdf.showPage()
+    pdf.save()
+    return buf
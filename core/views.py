@@ -1,11 +1,23 @@
-from django.shortcuts import render
-from django.db.models import Q
-from .models import Seminar
+from django.core.files.storage import default_storage
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.shortcuts import render, redirect
+from . import metrics
+from .cache import acached_search, query_etag, registry_condition
+from .models import Certificate
+from .search import NUMBER_PREFIXES
 
+ARTIFACT_KINDS = {'print': 'file_print', 'web': 'file_web', 'preview': 'preview_image', 'thumb': 'thumbnail',
+                  'thumb-jpeg': 'thumbnail_jpeg'}
 
-def cse_search(request):
+
+# Поиск async: под ASGI (см. gunicorn.conf.py) ожидание базы и кэша не занимает воркер
+@metrics.timed('search_view', 'CSE')
+@registry_condition(lambda request: 'CSE', query_etag)
+async def cse_search(request):
     query = request.GET.get('q', '').strip()
     results = []
+    truncated = False
     error_message = None
 
     if 'q' in request.GET: 
@@ -14,27 +26,24 @@ def cse_search(request):
         elif len(query) < 3:
             error_message = "Введите минимум 3 символа."
         else:
-            
-            clean_query = query.replace('№', '').strip()
-            results = Seminar.objects.filter(company='CSE').filter(
-                Q(organization_name__iexact=query) |
-                Q(registration_number__iexact=query) |  
-                Q(certificates__full_name__iexact=query) |
-                Q(certificates__certificate_number__endswith=clean_query)
-            ).distinct()
+            results, truncated = await acached_search('CSE', query, number_prefixes=NUMBER_PREFIXES['CSE'])
 
        
 
     return render(request, 'cse_search.html', {
         'results': results,
+        'truncated': truncated,
         'query': query,
         'error_message': error_message
     })
 
 
-def nika_search(request):
+@metrics.timed('search_view', 'NIKA')
+@registry_condition(lambda request: 'NIKA', query_etag)
+async def nika_search(request):
     query = request.GET.get('q', '').strip()
     results = []
+    truncated = False
     error_message = None
 
     if 'q' in request.GET:
@@ -43,17 +52,41 @@ def nika_search(request):
         elif len(query) < 3:
             error_message = "Please enter at least 3 characters."
         else:
-            clean_query = query.replace('№', '').replace('No', '').strip()
-            results = Seminar.objects.filter(company='NIKA').filter(
-                Q(organization_name__iexact=query) |
-                Q(registration_number__iexact=query) |
-                Q(certificates__full_name__iexact=query) |
-                Q(certificates__certificate_number__iexact=query)|
-                Q(certificates__certificate_number__endswith=clean_query)
-            ).distinct()
+            results, truncated = await acached_search('NIKA', query, number_prefixes=NUMBER_PREFIXES['NIKA'])
 
     return render(request, 'nika_search.html', {
         'results': results,
+        'truncated': truncated,
         'query': query,
         'error_message': error_message
-    })
\ No newline at end of file
+    })
+
+
+# Файл сертификата по требованию: если его ещё нет (ленивый режим), рисуем, сохраняем и отдаём редирект
+def certificate_file(request, pk, kind):
+    field = ARTIFACT_KINDS.get(kind)
+    # Чистый бланк без печати — только для сотрудников
+    if not field or (field == 'file_print' and not request.user.is_staff):
+        raise Http404
+
+    # Готовый файл отдаётся без блокировки строки. Рисуется по запросу только в ленивом режиме
+    # и только у готовых сертификатов: иначе анонимный GET запускал бы рендер прямо в веб-воркере
+    name = Certificate.objects.filter(pk=pk).values_list(field, flat=True).first()
+    if not name and getattr(settings, 'CERTIFICATE_LAZY_ARTIFACTS', False):
+        try:
+            name = Certificate.ensure_file(pk, field, only_done=True)
+        except Certificate.DoesNotExist:
+            raise Http404
+    if not name:
+        raise Http404
+    return redirect(default_storage.url(name))
+
+
+# Гистограммы этапов в формате Prometheus. Если задан METRICS_TOKEN, нужен заголовок Authorization: Bearer <токен>,
+# без токена — только персоналу (вошедшему в админку)
+def metrics_view(request):
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    allowed = request.headers.get('Authorization') == f"Bearer {token}" if token else request.user.is_staff
+    if not allowed:
+        raise Http404
+    return HttpResponse(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
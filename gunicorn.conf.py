@@ -0,0 +1,17 @@
+# Gunicorn подхватывает этот файл автоматически из рабочей директории
+import os
+
+# ASGI_SERVER=1 — воркеры uvicorn (пакет uvicorn-worker) и config.asgi: async-поиск и API (core/views.py,
+# core/api.py) не занимают воркер, пока ждут базу и кэш, поэтому один процесс обслуживает много запросов сразу.
+# Команда запуска тогда без позиционного приложения — оно перекрыло бы wsgi_app:
+#   ASGI_SERVER=1 gunicorn --workers 2
+# Без gunicorn (локально): ASGI_SERVER=1 uvicorn config.asgi:application --workers 2
+# Синхронные представления (админка, файлы сертификатов) под ASGI работают в потоках, как и раньше
+if os.environ.get('ASGI_SERVER') == '1':
+    wsgi_app = 'config.asgi:application'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+
+
+# Кэши рендера (шаблоны, шрифты) в веб-воркерах не прогреваются: рендерит очередь (run_generation_worker) и процессы
+# массовой перегенерации, а веб-воркеру декодированные листы (~35 МБ каждый) не нужны. Если генерация синхронная
+# (CERTIFICATE_ASYNC_GENERATION=0) или включены ленивые файлы, шаблоны декодируются при первом рендере